@@ -5,16 +5,19 @@ import numpy,scipy,pickle
 # import numpy,scipy,cPickle # there is no cPickle in python 3
 from scipy import interpolate,ndimage
 from scipy import io as sio
+from multiprocessing import Pool
 from pickle import dump,load
 
-from .biastrim import make_bias,biastrim
+from .biastrim import make_bias,biastrim,trim_file
 
 from .flat import *
-from .straighten import startrace,straighten,fullSolution,getOrders
+from .straighten import startrace,straighten,curve,fullSolution,getOrders,\
+    get_rectmap
 from .wavesolve import solve
 import special_functions as sf
 
-from ..spectra import spectools, offset, measure_width
+from ..spectra import spectools, offset, measure_width, cosmics
+from ..spectra.calcache import CalibrationCache
 from ..spectra.extract import extract
 #from keckcode.spectra import spectools,offset,measure_width
 #from keckcode.spectra.extract import extract
@@ -56,30 +59,100 @@ def clip2(arr,nsig=3.,edge=0.01):
 
 
 def crFind(img,var,nsig=10.,sigfrac=0.3):
-    simg = img/var**0.5
-    deriv = ndimage.prewitt(abs(simg))
-    deriv = ndimage.sobel(deriv)
-
-    mean,std = clip(deriv[deriv!=0.])
-    crmask = numpy.where(abs(deriv)>15*std,1,0)
-    crmask = ndimage.maximum_filter(crmask,3)
-    #crmask = ndimage.minimum_filter(crmask,3)
-    crmask = numpy.where((crmask==1)&(simg>5),1,0)
-    return crmask
-    thresh = nsig*var**0.5
-    n = 5
-    blkimg = img.repeat(n,0).repeat(n,1)
-    deriv = ndimage.laplace(blkimg)*-1.
-    deriv[deriv<0] = 0.
-    d = iT.resamp(deriv,n)
-    m = numpy.where((d>thresh)&(img>thresh),1,0)
-    bmap = ndimage.maximum_filter(m,5)
-    cond = (bmap==1)&(d>thresh*sigfrac)&(img>thresh*sigfrac)
-    m[cond] = 1
-    return m
-
-
-def bgsub(dir,inname,out_prefix,cal_prefix):
+    """
+    Returns a map of the cosmic rays in img (1 for cosmic rays, 0
+    otherwise), found from the derivatives of the S/N image.
+    """
+    return numpy.where(cosmics.derivative_mask(img,var),1,0)
+
+
+def clip_columns(data,nsig=3.5):
+    """
+    Column-by-column version of clip(); returns the clipped mean and
+    standard deviation of every column of data (NaNs are ignored).
+    """
+    use = numpy.isfinite(data)
+    d = numpy.where(use,data,0.)
+    n = use.sum(0)
+    active = numpy.ones(n.size,dtype=bool)
+    m = numpy.empty(n.size)
+    s = numpy.empty(n.size)
+    with numpy.errstate(invalid='ignore',divide='ignore'):
+        while active.any():
+            u = use[:,active]
+            dd = d[:,active]
+            nn = n[active]
+            mm = dd.sum(0)/nn
+            ss = (((dd-mm)**2)*u).sum(0)/nn
+            ss = ss**0.5
+            m[active] = mm
+            s[active] = ss
+            u &= abs(dd-mm)<nsig*ss
+            newn = u.sum(0)
+            use[:,active] = u
+            idx = numpy.where(active)[0]
+            active[idx[newn==nn]] = False
+            n[active] = newn[newn!=nn]
+    return m,s
+
+
+def fit_columns(x,data,order=1,nsig=3.5,rej=4.,minpts=4):
+    """
+    Fits a Chebyshev polynomial (in the genfunc convention, ie with no
+    rescaling of x) to every column of data at once. Each column is first
+    clipped with clip_columns() and points more than rej sigma from the
+    clipped mean are excluded from the fit. Returns the coefficients as an
+    (order+1,ncols) array and a boolean array that is False for columns
+    with fewer than minpts usable points.
+    """
+    avg,std = clip_columns(data,nsig)
+    with numpy.errstate(invalid='ignore'):
+        w = numpy.isfinite(data)&(abs(data-avg)<rej*std)
+    ok = w.sum(0)>=minpts
+    A = numpy.polynomial.chebyshev.chebvander(x,order)
+    y = numpy.where(w,data,0.)
+    lhs = numpy.einsum('ik,ij,il->jkl',A,w.astype(A.dtype),A)
+    rhs = numpy.einsum('ik,ij->jk',A,y)
+    lhs[~ok] = numpy.identity(order+1)
+    coeff = numpy.linalg.solve(lhs,rhs[:,:,None])[:,:,0].T
+    coeff[:,~ok] = 0.
+    return coeff,ok
+
+
+def _order_background(job):
+    cut,mask,blue,red = job
+    cut = cut.copy()
+    slit = cut.copy()
+
+    cut[scipy.isinf(cut)] = numpy.nan
+    cut[mask==0] = numpy.nan
+    bg = numpy.nanmedian(cut,axis=0)
+
+    tmp = (cut-bg)*mask
+
+    T = tmp[3:-3,blue:red]
+    T = T[numpy.isfinite(T)]
+    avg,std = clip2(T)
+
+    slice = numpy.nanmedian(tmp[:,blue:red],axis=1)
+    slice[:3] = 0.
+    slice[-3:] = 0.
+    avg,std = clip2(slice[3:-3],3.5,0.05)
+    good = numpy.where(slice<2.*std,1.,0.)
+    good = ndimage.maximum_filter(good,5)
+    good = ndimage.minimum_filter(good,15)
+
+    good = good==1
+
+    # Fit a line along the slit to every column at once
+    xvals = numpy.arange(good.size).astype(scipy.float32)
+    coeff,ok = fit_columns(xvals[good].astype(numpy.float64),cut[good])
+    A = numpy.polynomial.chebyshev.chebvander(xvals.astype(numpy.float64),1)
+    bgsub = slit-numpy.dot(A,coeff)
+    return bgsub,cut
+
+
+def bgsub(dir,inname,out_prefix,cal_prefix,nproc=1,usecache=True):
     # Where things begin and end....
     blue = [1500,1400,1300,1200,1100,900,600,200,0,0,0]
     red = [3000,3400,3700,-1,-1,-1,-1,-1,-1,-1]
@@ -95,8 +168,7 @@ def bgsub(dir,inname,out_prefix,cal_prefix):
     fullsoln = numpy.load(cal_prefix+"_full.dat", allow_pickle=True)
 
     hdu = pyfits.open(dir+inname)
-    data = hdu[0].data.copy()
-    data = biastrim(data,bias,bpm)/flat
+    data = trim_file(dir+inname,bpm)/flat
 
     if data.shape[1]<3000:
         blue = [i/2 for i in blue]
@@ -117,51 +189,51 @@ def bgsub(dir,inname,out_prefix,cal_prefix):
         pyfits.PrimaryHDU(back).writeto(out_prefix+"_bg.fits")
     """
 
-    try:
-        sub = pyfits.open(out_prefix+"_crsub.fits")[0].data.copy()
-        masks = numpy.load(out_prefix+'_masks.dat', allow_pickle=True)
+    # The CR-subbed image and masks are cached, keyed by the raw frame, the
+    #   calibration products, and the code that makes them
+    products = None
+    if usecache:
+        calib = CalibrationCache(os.path.join(os.path.dirname(out_prefix),
+                                              'calib_cache'))
+        calfiles = [cal_prefix+ext for ext in ["_bias.fits","_bpm.fits",
+                    "_norm.fits","_ycor.dat","_full.dat"]]
+        code = [sys.modules[__name__],sys.modules[straighten.__module__],
+                sys.modules[biastrim.__module__],cosmics]
+        key = calib.key([dir+inname]+calfiles,code=code)
+        products = calib.get('crsub',key)
+    if products is not None:
+        crsub,masks = products['crsub'],products['masks']
         print('Opened CR-subbed image')
-    except:
+    else:
         print('Creating CR-subbed image and masks')
-        strt = straighten(data,y_soln,orders,wideorders)
+        rectmap = get_rectmap(cal_prefix,data.shape,y_soln,orders,wideorders)
+        strt = straighten(data,y_soln,orders,wideorders,rectmap=rectmap)
         back = scipy.zeros(strt.shape)
         for indx in range(len(orders)):
             i,j = orders[indx]
             bg = numpy.nanmedian(strt[i:j],axis=0)
             back[i:j] += bg
-        back = curve(back,y_soln,orders,wideorders)
+        back = curve(back,y_soln,orders,wideorders,rectmap=rectmap)
 
         bgsub = data-back
-        sub = bgsub.copy()
-        omap = sub*0.
-        for loop in range(3):
-            message('CR iteration %d ...'%(loop+1))
-            map = crFind(sub,data+readvar)
-            if map.sum()==0:
-                message(' no new CRs found.\n')
-                break
-            else:
-                message(' %d pixels flagged.\n'%(map.sum()))
-            inmask = sub.flatten()
-            cond = numpy.where(map.ravel()==1)[0]
-            inmask[cond] = numpy.where(cond%2==0,1e5,-1e5).astype(inmask.dtype)
-            med5 = ndimage.median_filter(inmask.reshape(sub.shape),7)
-            med5 *= map
-            sub = (1.-map)*sub + med5
-            omap += map
+        var = data+readvar
+        sub,crmask = cosmics.clean(bgsub,
+                                   lambda img: cosmics.derivative_mask(img,var),
+                                   niter=3,size=7,verbose=True)
         crsub = data-(bgsub-sub)
 
         bpm = ndimage.minimum_filter(numpy.where(bpm==1,1,0),3)
-        #mask = numpy.where(numpy.isnan(bpm)|(omap>0),0.,1.)
-        mask = numpy.where((bpm==0)|(omap>0),0,1)
+        mask = numpy.where((bpm==0)|crmask,0,1)
         masks = getOrders(mask,orders,wideorders,fullsoln,1)
         for i in range(len(masks)):
             masks[i][0] = numpy.where(masks[i][0]<0.7,0,1)
-        f = open(out_prefix+'_masks.dat','wb')
-        dump(masks,f,2)
-        f.close()
+        if usecache:
+            calib.put('crsub',key,{'crsub':crsub,'masks':masks})
 
-        pyfits.PrimaryHDU(crsub).writeto(out_prefix+"_crsub.fits")
+    f = open(out_prefix+'_masks.dat','wb')
+    dump(masks,f,2)
+    f.close()
+    pyfits.PrimaryHDU(crsub).writeto(out_prefix+"_crsub.fits",overwrite=True)
 
 
     hdulist = pyfits.HDUList([pyfits.PrimaryHDU()])
@@ -171,47 +243,18 @@ def bgsub(dir,inname,out_prefix,cal_prefix):
 
     print("Subtracting backgrounds")
     slits = getOrders(crsub,orders,wideorders,fullsoln)
+    jobs = [(slits[indx][0],masks[indx][0],int(blue[indx]),int(red[indx]))
+            for indx in range(len(orders))]
+    if nproc>1:
+        pool = Pool(nproc)
+        results = pool.map(_order_background,jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = [_order_background(job) for job in jobs]
     for indx in range(len(orders)):
         cut,wlo,whigh,disp = slits[indx]
-        slit = cut.copy()
-        mask = masks[indx][0]
-
-        cut[scipy.isinf(cut)] = numpy.nan
-        cut[mask==0] = numpy.nan
-        bg = numpy.nanmedian(cut,axis=0)
-
-        tmp = (cut-bg)*mask
-
-        T = tmp[3:-3,blue[indx]:red[indx]]
-        T = T[numpy.isfinite(T)]
-        avg,std = clip2(T)
-
-        slice = numpy.nanmedian(tmp[:,blue[indx]:red[indx]],axis=1)
-        slice[:3] = 0.
-        slice[-3:] = 0.
-        avg,std = clip2(slice[3:-3],3.5,0.05)
-        good = numpy.where(slice<2.*std,1.,0.)
-        good = ndimage.maximum_filter(good,5)
-        good = ndimage.minimum_filter(good,15)
-
-        good = good==1
-
-        xvals = numpy.arange(good.size).astype(scipy.float32)
-        fitdata = numpy.empty((slice[good].size,2))
-        fitdata[:,0] = xvals[good].copy()
-        bgsub = slit.copy()
-        for k in range(cut.shape[1]):
-            fitdata[:,1] = cut[:,k][good].copy()
-            if fitdata[:,1][numpy.isfinite(fitdata[:,1])].size<4:
-                continue
-            avg,std = clip(fitdata[:,1])
-            keep = numpy.where((abs(fitdata[:,1]-avg)<4.*std)&numpy.isfinite(fitdata[:,1]))[0]
-            fit = fitdata[keep]
-            if fit[:,1][scipy.isfinite(fit[:,1])].size<4:
-                continue
-            fit = sf.lsqfit(fit,'chebyshev',1)
-            bg = sf.genfunc(xvals,0,fit)
-            bgsub[:,k] -= bg
+        bgsub,cut = results[indx]
 
         hdu = pyfits.ImageHDU(bgsub)
         hdu.header.set('CTYPE1','LINEAR')
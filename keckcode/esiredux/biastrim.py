@@ -1,57 +1,124 @@
 import numpy
+from functools import partial
+from multiprocessing import Pool
 from astropy.io import fits as pyfits
 
-def make_bias(filelist):
-    count = 0
+from ..spectra.stack import combine,row_blocks
+
+def _trim_bias(lo,hi,data,start,end):
+    return data.T[lo:hi].astype(numpy.float32)
+
+
+def _trim_frame(bpm,data,start,end):
+    return biastrim(data,None,bpm[:,start:end])
+
+
+def make_bias(filelist,rows=256,nproc=1):
+    # The frames are median-combined a block of rows at a time
+    header = pyfits.getheader(filelist[0])
+    namps = header['NUMAMPS']
     n = 1
-    for file in filelist:
-        data = pyfits.open(file)[0]
-        namps = data.header['NUMAMPS']
-        data = data.data.astype(numpy.float32).T
-        if data.size<1500*3000:
-            n = 2
-        if count==0:
-            if namps==2:
-                bias = numpy.empty((len(filelist), int(2048/n), int(4096/n)))
-            else:
-                bias = numpy.empty((len(filelist), int(2046/n), int(4096/n)))
-        if namps==2:
-            bias[count] = data[int(24/n):int(2072/n)].copy()
-        else:
-            bias[count] = data[int(14/n):int(2060/n)].copy()
-        count += 1
-    bias = numpy.median(bias,axis=0)
+    if header['NAXIS1']*header['NAXIS2']<1500*3000:
+        n = 2
+    if namps==2:
+        lo,hi = int(24/n),int(2072/n)
+    else:
+        lo,hi = int(14/n),int(2060/n)
+    bias = combine(filelist,'median',rows,transform=partial(_trim_bias,lo,hi),
+                   axis=1,nproc=nproc)
     diff = bias.copy()
     diff[:int(1024/n)] -= numpy.median(bias[:int(1024/n)])
     diff[int(1024/n):] -= numpy.median(bias[int(1024/n):])
-    pix = diff.flatten()
-    pix.sort()
-    std = pix[int(10000/n):-int(10000/n)].std()
-    bpm = numpy.where(abs(diff)>10.*std,numpy.nan,1)
+    std = robust_std(diff,int(10000/n))
+    bpm = numpy.where(abs(diff)>10.*std,numpy.nan,1).astype(numpy.float32)
     return bias,bpm
 
 
-def biastrim(data,bias,bpm):
-    # The bias floats, so the overscan region is better than bias frames
-    if data.size>1500*3000:
-        data = data.T.astype(float)
-        b1 = numpy.median(data[2074:2150],0)
-        b2 = numpy.median(data[2152:2230],0)
-        data[24:1048] -= b1
-        data[1048:2072] -= b2
-
-        # There is a small gain difference between the amplifiers
-        off = numpy.median((data[1048]/data[1047])[data[1047]!=0])
-        off = 1.08
-        data[24:1048] *= off
-        return data[24:2072]*bpm*1.29
+def robust_std(data,ncut):
+    """
+    The standard deviation of data after rejecting the ncut lowest and ncut
+    highest values; the values are selected with a partial sort.
+    """
+    pix = data.ravel()
+    pix = numpy.partition(pix,(ncut,pix.size-ncut-1))
+    return pix[ncut:pix.size-ncut].std(dtype=numpy.float64)
+
+
+def stack_frames(filelist,bpmfile,norms=None,rows=256,nproc=1):
+    """
+    Median-combines biastrimmed frames, reading a block of rows of every
+    frame at a time rather than holding all of the frames in memory.
+    """
+    bpm = pyfits.getdata(bpmfile)
+    return combine(filelist,'median',rows,transform=partial(_trim_frame,bpm),
+                   axis=1,norms=norms,nproc=nproc)
+
+
+def biastrim(data,bias,bpm,dtype=numpy.float32):
+    # The bias floats, so the overscan region is better than bias frames.
+    #   Each (raw) row is trimmed independently, so data can also be a
+    #   block of rows (with the matching columns of bpm). The output is
+    #   transposed; only the trimmed region is converted to dtype.
+    #   There is a small gain difference between the amplifiers (measured
+    #   to be 1.08).
+    off = 1.08
+    if data.shape[1]>1500:
+        b1 = numpy.median(data[:,2074:2150],1)
+        b2 = numpy.median(data[:,2152:2230],1)
+        lo,mid,hi = 24,1048,2072
     else:
-        data = data.T.astype(float)
-        b1 = numpy.median(data[1037:1075],0)
-        b2 = numpy.median(data[1076:1115],0)
-        data[12:524] -= b1
-        data[524:1036] -= b2
-        off = numpy.median(data[524]/data[523])
-        off = 1.08
-        data[12:524] *= off
-        return data[12:1036]*bpm*1.29
+        b1 = numpy.median(data[:,1037:1075],1)
+        b2 = numpy.median(data[:,1076:1115],1)
+        lo,mid,hi = 12,524,1036
+    out = numpy.empty((hi-lo,data.shape[0]),dtype)
+    numpy.subtract(data[:,lo:mid].T,b1,out=out[:mid-lo],casting='unsafe')
+    numpy.subtract(data[:,mid:hi].T,b2,out=out[mid-lo:],casting='unsafe')
+    out[:mid-lo] *= off
+    out *= bpm
+    out *= 1.29
+    return out
+
+
+def trim_file(filename,bpm,rows=256,dtype=numpy.float32):
+    """
+    Reads and biastrims a raw frame a block of rows at a time. The raw
+    (unscaled) data are memory-mapped, so only one block of rows is held
+    in memory at a time (as well as the output).
+    """
+    hdulist = pyfits.open(filename,memmap=True,do_not_scale_image_data=True)
+    raw = hdulist[0].data
+    bscale = hdulist[0].header.get('BSCALE',1.)
+    bzero = hdulist[0].header.get('BZERO',0.)
+    out = None
+    for start,end in row_blocks(raw.shape[0],rows):
+        block = raw[start:end].astype(dtype)
+        if bscale!=1:
+            block *= bscale
+        if bzero!=0:
+            block += bzero
+        trim = biastrim(block,None,bpm[:,start:end],dtype)
+        if out is None:
+            out = numpy.empty((trim.shape[0],raw.shape[0]),dtype)
+        out[:,start:end] = trim
+    del raw
+    hdulist.close()
+    return out
+
+
+def _trim_job(args):
+    return trim_file(*args)
+
+
+def trim_frames(filelist,bpm,nproc=1,rows=256,dtype=numpy.float32):
+    """
+    Biastrims a list of raw frames (eg all of the frames of a night),
+    processing nproc frames at a time in parallel.
+    """
+    jobs = [(name,bpm,rows,dtype) for name in filelist]
+    if nproc>1 and len(jobs)>1:
+        pool = Pool(min(nproc,len(jobs)))
+        out = pool.map(_trim_job,jobs)
+        pool.close()
+        pool.join()
+        return out
+    return [_trim_job(job) for job in jobs]
@@ -1,11 +1,12 @@
-from .biastrim import make_bias,biastrim
+from .biastrim import make_bias,biastrim,trim_file
 
 from .flat import *
-from .straighten import startrace,straighten,fullSolution,getOrders
+from .straighten import startrace,straighten,fullSolution,getOrders,get_rectmap
 from . import wavesolve
 
-from keckcode.spectra import spectools,offset,measure_width
+from keckcode.spectra import spectools,offset,measure_width,stack
 from keckcode.spectra.extract import extract
+from keckcode.spectra.taskgraph import TaskGraph
 import special_functions as sf
 
 from pickle import dump,load
@@ -33,8 +34,151 @@ def clip(arr,nsig=3.5):
         m,s,l = a.mean(),a.std(),a.size
 
 
+def _writefits(data,filename):
+    pyfits.PrimaryHDU(data).writeto(filename,overwrite=True)
+
+
+def _dumpfile(obj,filename):
+    file = open(filename,"wb")
+    dump(obj,file,2)
+    file.close()
+
+
+def _load_orders(out_prefix):
+    return numpy.load(out_prefix+"_ycor.dat",allow_pickle=True)
+
+
+def _lamps(header):
+    arcs = {}
+    if header['LAMPCU1']=='on':
+        arcs['cuar'] = True
+    if header['LAMPNE1']=='on':
+        arcs['hgne'] = True
+    if header['LAMPAR1']=='on':
+        arcs['xe'] = True
+    return arcs
+
+
+"""
+The calibration tasks. Each reads its inputs from the products of the tasks
+that it depends on and writes its own products, so that independent tasks
+can run in separate processes.
+"""
+def make_bias_task(biasfiles,out_prefix,nproc):
+    bias,bpm = make_bias(biasfiles,nproc=nproc)
+    _writefits(bias,out_prefix+"_bias.fits")
+    _writefits(bpm,out_prefix+"_bpm.fits")
+
+
+def make_flat_task(flatfiles,out_prefix,nproc):
+    _writefits(make_flat(flatfiles,out_prefix,nproc=nproc),out_prefix+"_flat.fits")
+
+
+def make_trace_task(starfiles,out_prefix,nproc):
+    from .straighten import starstack
+    star = starstack(starfiles,out_prefix,nproc=nproc)
+    _writefits(star,out_prefix+"_trace.fits")
+
+
+def make_orders_task(out_prefix):
+    flat = pyfits.open(out_prefix+"_flat.fits")[0].data.copy()
+    star = pyfits.open(out_prefix+"_trace.fits")[0].data.astype(scipy.float32)
+    orders = find_orders(flat)
+    solutions,wideorders = startrace(star,orders)
+    _dumpfile([orders,solutions,wideorders],out_prefix+"_ycor.dat")
+
+
+def make_norm_task(out_prefix):
+    flat = pyfits.open(out_prefix+"_flat.fits")[0].data.copy()
+    orders,solutions,wideorders = _load_orders(out_prefix)
+    cflat = response(flat,orders,solutions,wideorders)
+    _writefits(cflat,out_prefix+"_norm.fits")
+
+
+def make_rectmap_task(out_prefix):
+    shape = pyfits.getdata(out_prefix+"_bias.fits").shape
+    orders,solutions,wideorders = _load_orders(out_prefix)
+    get_rectmap(out_prefix,shape,solutions,orders,wideorders)
+
+
+def straighten_arc_task(arcfile,name,out_prefix):
+    bpm = pyfits.open(out_prefix+"_bpm.fits")[0].data.copy()
+    orders,solutions,wideorders = _load_orders(out_prefix)
+    hdu = pyfits.open(arcfile)
+    arc = trim_file(arcfile,bpm)
+    rectmap = get_rectmap(out_prefix,arc.shape,solutions,orders,wideorders)
+    hdu[0].data = straighten(arc,solutions,orders,wideorders,rectmap=rectmap)
+    hdu[0].writeto(out_prefix+"_%s.fits"%name,overwrite=True)
+
+
+def wave_task(out_prefix,onearc):
+    orders,solutions,wideorders = _load_orders(out_prefix)
+    if onearc is False:
+        arcs = {}
+        for name in ['cuar','hgne','xe']:
+            arcs[name] = pyfits.open(out_prefix+"_%s.fits"%name)[0].data.astype(scipy.float32)
+        wave_solution = wavesolve.solve(arcs,orders)
+    else:
+        archdu = pyfits.open(out_prefix+"_arc.fits")[0]
+        arcs = _lamps(archdu.header)
+        arcs['arc'] = archdu.data.copy()
+        wave_solution = wavesolve.jointSolve(arcs,orders)
+    _dumpfile(wave_solution,out_prefix+"_wave.dat")
+
+
+def full_solution_task(out_prefix):
+    shape = pyfits.getdata(out_prefix+"_bias.fits").shape
+    orders,solutions,wideorders = _load_orders(out_prefix)
+    wave_solution = numpy.load(out_prefix+"_wave.dat",allow_pickle=True)
+    soln = fullSolution(shape,solutions,orders,wideorders,wave_solution)
+    _dumpfile(soln,out_prefix+"_full.dat")
+
+
+def calibration_graph(biasnums,starnums,flatnums,arcfiles,out_prefix,
+                      onearc=False,nproc=1):
+    """
+    Returns the TaskGraph of the calibration products; arcfiles is a
+    dictionary of the raw arc frames (keyed by 'hgne', 'cuar', and 'xe', or
+    by 'arc' if onearc is True). The stacking tasks use nproc processes
+    themselves only if the graph is run serially.
+    """
+    # Every task also depends on the task functions in this module, and the
+    #   stacking tasks on the combining code in spectra.stack
+    mod = lambda func: sys.modules[func.__module__]
+    here = sys.modules[__name__]
+    graph = TaskGraph(out_prefix+"_calib.dat")
+    graph.add('bias',make_bias_task,(biasnums,out_prefix,nproc),
+              inputs=biasnums,code=[here,mod(make_bias),stack],
+              outputs=[out_prefix+"_bias.fits",out_prefix+"_bpm.fits"])
+    graph.add('flat',make_flat_task,(flatnums,out_prefix,nproc),['bias'],
+              inputs=flatnums,code=[here,mod(make_flat),mod(biastrim),stack],
+              outputs=[out_prefix+"_flat.fits"])
+    graph.add('trace',make_trace_task,(starnums,out_prefix,nproc),['bias'],
+              inputs=starnums,code=[here,mod(startrace),mod(biastrim),stack],
+              outputs=[out_prefix+"_trace.fits"])
+    graph.add('orders',make_orders_task,(out_prefix,),['flat','trace'],
+              code=[here,mod(find_orders),mod(startrace)],
+              outputs=[out_prefix+"_ycor.dat"])
+    graph.add('norm',make_norm_task,(out_prefix,),['flat','orders'],
+              code=[here,mod(response)],outputs=[out_prefix+"_norm.fits"])
+    graph.add('rectmap',make_rectmap_task,(out_prefix,),['bias','orders'],
+              code=[here,mod(get_rectmap)],outputs=[out_prefix+"_rect.npz"])
+    arcs = sorted(arcfiles.keys())
+    for name in arcs:
+        graph.add(name,straighten_arc_task,(arcfiles[name],name,out_prefix),
+                  ['rectmap'],inputs=[arcfiles[name]],
+                  code=[here,mod(biastrim),mod(straighten)],
+                  outputs=[out_prefix+"_%s.fits"%name])
+    graph.add('wave',wave_task,(out_prefix,onearc),['orders']+arcs,
+              code=[here,wavesolve],extra=onearc,
+              outputs=[out_prefix+"_wave.dat"])
+    graph.add('full',full_solution_task,(out_prefix,),['bias','wave'],
+              code=[here,mod(fullSolution)],outputs=[out_prefix+"_full.dat"])
+    return graph
+
+
 def prepare(rawdir, prefix, bias, stars, hgne, cuar, xe, flat, out_prefix,
-            onearc=False, redoWave=False, arc=None):
+            onearc=False, redoWave=False, arc=None, nproc=1):
     biasnums = bias.split(",")
     starnums = stars.split(",")
     flatnums = flat.split(",")
@@ -49,158 +193,25 @@ def prepare(rawdir, prefix, bias, stars, hgne, cuar, xe, flat, out_prefix,
         tmpfile = prefix+flatnums[i]+".fits"
         flatnums[i] = os.path.join(rawdir, tmpfile)
 
-    hgne = os.path.join(rawdir, prefix+hgne+".fits")
-    cuar = os.path.join(rawdir, prefix+cuar+".fits")
-    xe = os.path.join(rawdir, prefix+xe+".fits")
-
-    message("Bias and bad pixel mask ... ")
-    try:
-        bias = pyfits.open(out_prefix+"_bias.fits")[0].data.copy()
-        bpm = pyfits.open(out_prefix+"_bpm.fits")[0].data.copy()
-        message("opened.\n")
-    except:
-        bias,bpm = make_bias(biasnums)
-        pyfits.PrimaryHDU(bias).writeto(out_prefix+"_bias.fits")
-        pyfits.PrimaryHDU(bpm).writeto(out_prefix+"_bpm.fits")
-        message("created.\n")
-
-    message("Flat field ... ")
-    try:
-        flat = pyfits.open(out_prefix+"_flat.fits")[0].data.copy()
-        message("opened.\n")
-    except:
-        flat = make_flat(flatnums,out_prefix)
-        pyfits.PrimaryHDU(flat).writeto(out_prefix+"_flat.fits")
-        message("created.\n")
-
-    message("Star traces ... ")
-    try:
-        star = pyfits.open(out_prefix+"_trace.fits")[0].data.astype(scipy.float32)
-        message("opened.\n")
-    except:
-        from .straighten import starstack
-        star = starstack(starnums,out_prefix)
-        pyfits.PrimaryHDU(star).writeto(out_prefix+"_trace.fits")
-        message("created.\n")
-
-    message("Order solutions ... ")
-    try:
-        orders,solutions,wideorders = numpy.load(out_prefix+"_ycor.dat",
-                                                 allow_pickle=True)
-        message("opened.\n")
-    except:
-        orders = find_orders(flat)
-        solutions,wideorders = startrace(star,orders)
-        file = open(out_prefix+"_ycor.dat","wb")
-        dump([orders,solutions,wideorders],file,2)
-        file.close()
-        message("created.\n")
-
-    message("Normalized flat ... ")
-    try:
-        respflat = pyfits.open(out_prefix+"_norm.fits")
-        message("opened.\n")
-    except:
-        cflat = response(flat,orders,solutions,wideorders)
-        pyfits.PrimaryHDU(cflat).writeto(out_prefix+"_norm.fits")
-        message("created.\n")
-
     if onearc is False:
-      try:
-          hgne = pyfits.open(out_prefix+"_hgne.fits")[0].data.astype(scipy.float32)
-      except:
-          print ("Straightening HgNe arc")
-          hdu = pyfits.open(hgne)
-          hgne = hdu[0].data.copy()
-          hgne = biastrim(hgne,bias,bpm)
-          hgne = straighten(hgne,solutions,orders,wideorders)
-          hdu[0].data = hgne
-          hdu[0].writeto(out_prefix+"_hgne.fits")
-
-      try:
-          cuar = pyfits.open(out_prefix+"_cuar.fits")[0].data.astype(scipy.float32)
-      except:
-          print("Straightening CuAr arc")
-          hdu = pyfits.open(cuar)
-          cuar = hdu[0].data.copy()
-          cuar = biastrim(cuar,bias,bpm)
-          cuar = straighten(cuar,solutions,orders,wideorders)
-          hdu[0].data = cuar
-          hdu[0].writeto(out_prefix+"_cuar.fits")
-      try:
-          xe = pyfits.open(out_prefix+"_xe.fits")[0].data.astype(scipy.float32)
-      except:
-          print("Straightening Xe arc")
-          hdu = pyfits.open(xe)
-          xe = hdu[0].data.copy()
-          xe = biastrim(xe,bias,bpm)
-          xe = straighten(xe,solutions,orders,wideorders)
-          hdu[0].data = xe 
-          hdu[0].writeto(out_prefix+"_xe.fits")
-
-      arcs = {}
-      arcs['cuar'] = cuar.copy()
-      arcs['hgne'] = hgne.copy()
-      arcs['xe'] = xe.copy()
+        arcfiles = {'hgne':hgne,'cuar':cuar,'xe':xe}
     else:
-        try:
-            archdu = pyfits.open(out_prefix+"_arc.fits")[0] 
-            arc = archdu.data.copy()
-            arcs = {}
-            if archdu.header['LAMPCU1']=='on':
-                arcs['cuar'] = True
-            if archdu.header['LAMPNE1']=='on':
-                arcs['hgne'] = True
-            if archdu.header['LAMPAR1']=='on':
-                arcs['xe'] = True
-            arcs['arc'] = arc
-        except:
-            print("Straightening arc")
-            arc = os.path.join(rawdir, prefix+arc+".fits")
-            archdu = pyfits.open(arc)[0]
-            arc = archdu.data.copy()
-            arc = biastrim(arc,bias,bpm)
-            arc = straighten(arc,solutions,orders,wideorders)
-            archdu.data = arc
-            archdu.writeto(out_prefix+"_arc.fits")
-            arcs = {}
-            if archdu.header['LAMPCU1']=='on':
-                arcs['cuar'] = True
-            if archdu.header['LAMPNE1']=='on':
-                arcs['hgne'] = True
-            if archdu.header['LAMPAR1']=='on':
-                arcs['xe'] = True
-            arcs['arc'] = arc
-
-    print(redoWave)
-    if redoWave==False:
-        try:
-            wave_solution = numpy.load(out_prefix+"_wave.dat",
-                                       allow_pickle=True)
-        except:
-            redoWave = True
+        arcfiles = {'arc':arc}
+    for name in arcfiles:
+        arcfiles[name] = os.path.join(rawdir, prefix+arcfiles[name]+".fits")
+
+    # Independent tasks (eg the three arcs) are run in parallel; the tasks
+    #   that stack frames only use several processes themselves when the
+    #   graph is run serially
+    graph = calibration_graph(biasnums,starnums,flatnums,arcfiles,out_prefix,
+                              onearc,nproc if nproc<2 else 1)
+    force = []
     if redoWave==True:
-        print("Determining wavelength solutions")
-        if onearc is False:
-            wave_solution = wavesolve.solve(arcs,orders)
-        else:
-            wave_solution = wavesolve.jointSolve(arcs,orders)
-
-        file = open(out_prefix+"_wave.dat","wb")
-        dump(wave_solution,file,2)
-        file.close()
-
-
-    print("Creating full slit solutions")
-    soln = fullSolution(bias.shape,solutions,orders,wideorders,wave_solution)
-    file = open(out_prefix+"_full.dat",'wb')
-    dump(soln,file,2)
-    file.close()
+        force = ['wave']
+    graph.run(nproc,force)
 
     print("")
     print("**********************")
     print("Preparations complete!")
     print("**********************")
     print("")
-
-
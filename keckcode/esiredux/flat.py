@@ -1,5 +1,5 @@
 from keckcode.spectra import ycorrect,id_slits,spectools
-from .biastrim import biastrim
+from .biastrim import biastrim,stack_frames
 from .straighten import straighten,curve
 
 from special_functions import lsqfit,genfunc
@@ -11,19 +11,11 @@ except:
     from astropy.io import fits as pyfits
 
 
-def make_flat(flatfiles,out_prefix):
-    # Read data from files, biastrim and coadd
-    weight = 0
-    bias = pyfits.open(out_prefix+"_bias.fits")[0].data.copy()
-    bpm = pyfits.open(out_prefix+"_bpm.fits")[0].data.copy()
-    imgs = []
-    for name in flatfiles:
-        flattmp = pyfits.open(name)
-        flatdata = biastrim(flattmp[0].data.copy(),bias,bpm) 
-        exptime = flattmp[0].header['elaptime']
-
-        imgs.append(flatdata/exptime)
-    return numpy.median(imgs,0)
+def make_flat(flatfiles,out_prefix,rows=256,nproc=1):
+    # Biastrim, normalise by exposure time, and median-combine the flats a
+    #   block of rows at a time
+    exptimes = [pyfits.getheader(name)['elaptime'] for name in flatfiles]
+    return stack_frames(flatfiles,out_prefix+"_bpm.fits",exptimes,rows,nproc)
 
 
 def response(flat,orders,solutions,wideorders):
@@ -1,5 +1,5 @@
 from keckcode.spectra import ycorrect,id_slits,spectools
-from .biastrim import biastrim
+from .biastrim import biastrim,stack_frames
 
 from special_functions import lsqfit,genfunc
 
@@ -10,16 +10,9 @@ try:
 except:
     from astropy.io import fits as pyfits
 
-def starstack(starfiles,out_prefix):
-    # Read data from files, biastrim and coadd
-    bias = pyfits.open(out_prefix+"_bias.fits")[0].data.copy()
-    bpm = pyfits.open(out_prefix+"_bpm.fits")[0].data.copy()
-    stars = []
-    for name in starfiles:
-        startmp = pyfits.open(name)[0].data.copy()
-        stardata = biastrim(startmp,bias,bpm) 
-        stars.append(stardata)
-    return numpy.median(stars,0)
+def starstack(starfiles,out_prefix,rows=256,nproc=1):
+    # Biastrim and median-combine the star frames a block of rows at a time
+    return stack_frames(starfiles,out_prefix+"_bpm.fits",rows=rows,nproc=nproc)
 
 
 def clip(arr,sig):
@@ -31,7 +24,188 @@ def clip(arr,sig):
             return m,s
 
 
-def startrace(stars,orders):
+def _column_percentile(data,percentile,size,cols=128):
+    """
+    ndimage.percentile_filter(data,percentile,(size,1)), computed a block
+    of columns at a time by partitioning sliding windows. Columns that
+    contain NaNs are passed to ndimage so that they are treated the same.
+    """
+    from numpy.lib.stride_tricks import sliding_window_view
+    rank = int(size*percentile/100.)
+    if rank==size:
+        rank = size-1
+    h = size//2
+    pad = numpy.pad(data,((h,size-1-h),(0,0)),mode='symmetric')
+    out = numpy.empty(data.shape,data.dtype)
+    for c in range(0,data.shape[1],cols):
+        w = sliding_window_view(pad[:,c:c+cols],size,axis=0)
+        out[:,c:c+cols] = numpy.partition(w,rank,axis=-1)[...,rank]
+    bad = numpy.where(numpy.isnan(data).any(0))[0]
+    if bad.size>0:
+        out[:,bad] = ndimage.percentile_filter(data[:,bad],percentile,(size,1))
+    return out
+
+
+def _median_filter(data,size,rows=64):
+    """
+    ndimage.median_filter(data,size) for finite data, computed a block of
+    rows at a time by partitioning sliding windows (about twice as fast).
+    """
+    from numpy.lib.stride_tricks import sliding_window_view
+    h = size//2
+    pad = numpy.pad(data,((h,size-1-h),(h,size-1-h)),mode='symmetric')
+    out = numpy.empty(data.shape,data.dtype)
+    n = size*size
+    for r in range(0,data.shape[0],rows):
+        w = sliding_window_view(pad[r:r+rows+size-1],(size,size))
+        w = w.reshape(w.shape[:2]+(n,))
+        out[r:r+rows] = numpy.partition(w,n//2,axis=-1)[...,n//2]
+    return out
+
+
+def _centroids(stars,lines,col,width):
+    """
+    Flux-weighted centroids of stars[:,col] in windows of +-width rows
+    about the (integer) rows in lines; also returns the window values.
+    """
+    rows = lines[:,None]+numpy.arange(-width,width+1)
+    vals = stars[rows,col]
+    with numpy.errstate(invalid='ignore',divide='ignore'):
+        return (vals*rows).sum(1)/vals.sum(1),vals
+
+
+def _peakflux(stars,lines,col):
+    """ stars[line-1:line+2,col].max() for each line """
+    rows = numpy.clip(lines[:,None]+numpy.arange(-1,2),0,stars.shape[0]-1)
+    return stars[rows,col].max(1)
+
+
+def follow_traces(stars,peaks,amps,skipdefects,width,step=1):
+    """
+    Follows traces that pass through the rows peaks at the central column,
+    all at once, one column at a time. The centroid in each column is
+    found in a window about the position in the previous column (which is
+    extrapolated from the previous two positions if only every step-th
+    column is traced), and a trace ends when it leaves the image or drops
+    below amps/20.
+
+    On the red side, a trace that runs into NaN defects either ends (if
+    skipdefects is False for that trace) or is predicted across the
+    defect from a fit to its positions so far.
+
+    Returns a list of [col,row,peak] arrays, one for each trace.
+    """
+    nrows,ncols = stars.shape
+    ntr = len(peaks)
+    peaks = numpy.asarray(peaks)
+    amps = numpy.asarray(amps)
+    limit = amps/20.
+    mid = int(ncols/2)
+    xvals = numpy.arange(ncols)*1.
+
+    # Go towards the blue side of the image
+    bcols = numpy.arange(mid,0,-step)
+    bpos = numpy.full((bcols.size,ntr),numpy.nan)
+    line = peaks*1.
+    slope = numpy.zeros(ntr)
+    active = numpy.ones(ntr,dtype=bool)
+    for k,col in enumerate(bcols):
+        j = numpy.where(active)[0]
+        if j.size==0:
+            break
+        l = (line[j]-slope[j]*step).astype(numpy.int64)
+        ok = (l>=width)&(l+width<nrows)
+        ok[ok] = ~(_peakflux(stars,l[ok],col)<limit[j[ok]])
+        cen = _centroids(stars,l[ok],col,width)[0]
+        good = numpy.isfinite(cen)
+        ok[ok] = good
+        active[j[~ok]] = False
+        j = j[ok]
+        cen = cen[good]
+        if step>1 and k>0:
+            slope[j] = (line[j]-cen)/step
+        line[j] = cen
+        bpos[k,j] = cen
+
+    # Go towards the red side of the image; the red side has some defects
+    rcols = numpy.arange(mid+1,ncols,step)
+    rpos = numpy.full((rcols.size,ntr),numpy.nan)
+    line = peaks*1.
+    slope = numpy.zeros(ntr)
+    active = numpy.ones(ntr,dtype=bool)
+    skipping = numpy.zeros(ntr,dtype=bool)
+    linepos = {}
+    for k,col in enumerate(rcols):
+        # Traces that are being predicted across a defect
+        for j in numpy.where(active&skipping)[0]:
+            l = linepos[j][col]
+            if col>=ncols-width or l<width or l+width>=nrows:
+                active[j] = False
+                continue
+            cen,vals = _centroids(stars,numpy.array([l]),col,width)
+            if numpy.isnan(vals).any():
+                continue
+            l = int(cen[0])
+            if _peakflux(stars,numpy.array([l]),col)[0]<limit[j]:
+                active[j] = False
+                continue
+            skipping[j] = False
+            line[j] = l
+            rpos[k,j] = l
+
+        j = numpy.where(active&~skipping&numpy.isnan(rpos[k]))[0]
+        if j.size==0:
+            if not active.any():
+                break
+            continue
+        l = (line[j]+slope[j]*step).astype(numpy.int64)
+        ok = (l>=width)&(l+width<nrows)
+        active[j[~ok]] = False
+        j,l = j[ok],l[ok]
+        cen,vals = _centroids(stars,l,col,width)
+        defect = numpy.isnan(vals).any(1)
+        for jj in j[defect]:
+            if not skipdefects[jj] or col>=ncols-width:
+                active[jj] = False
+                continue
+            fitData = _trace_points(bcols,bpos,rcols,rpos,jj)
+            fit = lsqfit(fitData,'chebyshev',3)
+            linepos[jj] = genfunc(xvals,0.,fit).astype(numpy.int32)
+            skipping[jj] = True
+        j,l,cen = j[~defect],l[~defect],cen[~defect]
+        good = numpy.isfinite(cen)
+        active[j[~good]] = False
+        j,cen = j[good],cen[good].astype(numpy.int64)
+        ok = ~(_peakflux(stars,cen,col)<limit[j])
+        active[j[~ok]] = False
+        j,cen = j[ok],cen[ok]
+        if step>1 and k>0:
+            slope[j] = (cen-line[j])/step
+        line[j] = cen
+        rpos[k,j] = cen
+
+    out = []
+    for j in range(ntr):
+        pts = _trace_points(bcols,bpos,rcols,rpos,j)
+        out.append(numpy.column_stack((pts,numpy.full(pts.shape[0],peaks[j]))))
+    return out
+
+
+def _trace_points(bcols,bpos,rcols,rpos,j):
+    """ The (col,row) points found so far for trace j """
+    b = numpy.isfinite(bpos[:,j])
+    r = numpy.isfinite(rpos[:,j])
+    return numpy.concatenate((numpy.column_stack((bcols[b],bpos[b,j])),
+                              numpy.column_stack((rcols[r],rpos[r,j]))))
+
+
+def startrace(stars,orders,step=1):
+    """
+    Finds the y-distortion solution of each order by following the star
+    traces across the detector. If step>1, the traces are only followed
+    (and fit) in every step-th column, which is faster for reruns where the
+    solution changes slowly with column.
+    """
     from scipy import ndimage
     if stars.shape[0]>1500:
         WIDTH = 6
@@ -44,9 +218,9 @@ def startrace(stars,orders):
     ncols = stars.shape[1]
 
     # This probably isn't necessary....
-    background = ndimage.percentile_filter(stars,10.,(37,1))
+    background = _column_percentile(stars,10.,37)
     background[numpy.isnan(background)] = 0.
-    background = ndimage.median_filter(background,7)
+    background = _median_filter(background,7)
 
     smooth = ndimage.gaussian_filter1d(stars-background,1.5,0)
 
@@ -62,64 +236,39 @@ def startrace(stars,orders):
     all = numpy.where((peaks==start)&(peaks>thresh)&(peaks==peaks2))[0]
     all = all.tolist()
 
-    yvals = numpy.arange(nrows)*1.
-    xvals = numpy.arange(ncols)*1.
-    wideorders = []
-    solutions = []
-    # Loop through the orders, following the traces in each order
+    # Assign the traces to orders
+    orderpeaks = []
     for i in range(len(orders)):
         start,end = orders[i]
         while all[0]<start:
             del all[0]
-        ordermatches = numpy.empty((0,3))
+        orderpeaks.append([])
         while all[0]<end:
-            peak = all[0]
-            col = int(ncols/2)
-            amp = smooth[peak,col]
-            line = peak
-            matches = []
-            # Go towards the blue side of the image
-            while col>0:
-                line = int(line)
-                if line<WIDTH or line+WIDTH>=nrows or stars[line-1:line+2,col].max()<amp/20.:
-                    break
-                s1 = slice(line-WIDTH,line+WIDTH+1)
-                line = (stars[s1,col]*yvals[s1]).sum()/stars[s1,col].sum()
-                matches.append([col,line,peak])
-                col -= 1
-            col = int(ncols/2)+1
-            line = peak
-            # Go towards the red side of the image
-            while col<ncols:
-                line = int(line)
-                if line<WIDTH or line+WIDTH>=nrows:
-                    break
-                s1 = slice(line-WIDTH,line+WIDTH+1)
-                # The red side has some defects....
-                if numpy.isnan(stars[s1,col]).any():
-                    if i==0:
-                        break
-                    fitData = numpy.array(matches)[:,:2]
-                    fit = lsqfit(fitData,'chebyshev',3)
-                    linePos = genfunc(xvals,0.,fit).astype(numpy.int32)
-                    while col<ncols-WIDTH and numpy.isnan(stars[s1,col]).any():
-                        col += 1
-                        s1 = slice(linePos[col]-WIDTH,linePos[col]+WIDTH+1)
-                    if col>=ncols-WIDTH:
-                        break
-                line = int((stars[s1,col]*yvals[s1]).sum()/stars[s1,col].sum())
-                if stars[line-1:line+2,col].max()<amp/20.:
-                    break
-                matches.append([col,line,peak])
-                col += 1
+            orderpeaks[i].append(all[0])
+            del all[0]
 
+    # Follow all of the traces together; traces in the first order end at
+    #   defects rather than being predicted across them
+    tracepeaks = sum(orderpeaks,[])
+    amps = smooth[tracepeaks,int(ncols/2)]
+    skipdefects = numpy.array(sum([[i>0]*len(p) for i,p in enumerate(orderpeaks)],[]),dtype=bool)
+    traces = follow_traces(stars,tracepeaks,amps,skipdefects,WIDTH,step)
+
+    xvals = numpy.arange(ncols)*1.
+    wideorders = []
+    solutions = []
+    n = 0
+    for i in range(len(orders)):
+        start,end = orders[i]
+        ordermatches = numpy.empty((0,3))
+        for peak in orderpeaks[i]:
+            matches = traces[n]
+            n += 1
             # Filter garbage; trace should be within ~2pix of the model
-            matches = numpy.array(matches)
             soln = lsqfit(matches[:,:2],'cheybshev',3)
             resid = matches[:,1]-genfunc(matches[:,0],0.,soln)
             good = abs(resid)<2.
             ordermatches = numpy.concatenate((ordermatches,matches[good]))
-            del all[0]
         matches = ordermatches
 
         ord1,ord2 = 3,3
@@ -149,51 +298,145 @@ def startrace(stars,orders):
     return solutions,wideorders
 
 
-def straighten(data,solutions,orders,wideorders,interp=5):
+class RectifyMap(object):
+    """
+    The coordinate maps used by straighten and curve for one set of order
+    solutions.  Evaluating the order solutions on every pixel of the frame
+    is the expensive part of building the maps, so each map is only
+    computed the first time that it is needed and is then reused for every
+    frame that is straightened or curved with the same solutions.  The maps
+    can be saved to, and loaded from, a .npz file (see get_rectmap).
+    """
+
+    def __init__(self,shape,solutions,orders,wideorders):
+        self.shape = tuple(shape)
+        self.solutions = solutions
+        self.orders = [tuple(o) for o in orders]
+        self.wideorders = [tuple(o) for o in wideorders]
+        self.key = rectmap_key(shape,solutions,orders,wideorders)
+        self.maps = {}
+
+    def matches(self,shape,solutions,orders,wideorders):
+        """ True if the map was made from the same shape and solutions """
+        return rectmap_key(shape,solutions,orders,wideorders)==self.key
+
+    def forward(self,i):
+        """ y-coordinates (relative to the wide order) for straighten """
+        name = 'forw%d'%i
+        if name not in self.maps:
+            low,high = self.orders[i]
+            wlow,whigh = self.wideorders[i]
+            ytrue,ymap = self.solutions[i]
+            coords = spectools.array_coords((high-low,self.shape[1]))
+            yforw = genfunc(coords[1].ravel(),coords[0].ravel()+low,ytrue)
+            self.maps[name] = yforw.reshape((high-low,self.shape[1]))-wlow
+        return self.maps[name]
+
+    def backward(self,i):
+        """ y-coordinates (relative to the order) for curve """
+        name = 'back%d'%i
+        if name not in self.maps:
+            low,high = self.orders[i]
+            wlow,whigh = self.wideorders[i]
+            ytrue,ymap = self.solutions[i]
+            coords = spectools.array_coords((whigh-wlow,self.shape[1]))
+            yback = genfunc(coords[1].ravel(),coords[0].ravel()+wlow,ymap)
+            self.maps[name] = yback.reshape((whigh-wlow,self.shape[1]))-low
+        return self.maps[name]
+
+    def coords(self,ymap):
+        """ Full (y,x) coordinate array for ndimage.map_coordinates """
+        out = numpy.empty((2,)+ymap.shape)
+        out[0] = ymap
+        out[1] = numpy.arange(ymap.shape[1],dtype='f8')
+        return out
+
+    def compute(self):
+        for i in range(len(self.orders)):
+            self.forward(i)
+            self.backward(i)
+
+    def save(self,filename):
+        self.compute()
+        arrays = dict(self.maps)
+        arrays['key'] = numpy.array(self.key)
+        numpy.savez(filename,**arrays)
+
+    def load(self,filename):
+        """ Loads saved maps if they were made with the same solutions """
+        try:
+            saved = numpy.load(filename)
+        except IOError:
+            return False
+        if 'key' not in saved.files or str(saved['key'])!=self.key:
+            return False
+        for name in saved.files:
+            if name!='key':
+                self.maps[name] = saved[name]
+        return True
+
+
+def rectmap_key(shape,solutions,orders,wideorders):
+    """ A hash that identifies the shape and order solutions of a map """
+    import hashlib
+    h = hashlib.md5()
+    h.update(repr((tuple(shape),[tuple(o) for o in orders],
+                   [tuple(o) for o in wideorders])).encode())
+    for soln in solutions:
+        for fit in soln:
+            h.update(repr((fit['type'],fit['coeff'].shape)).encode())
+            h.update(numpy.ascontiguousarray(fit['coeff'],dtype='f8').tobytes())
+    return h.hexdigest()
+
+
+def get_rectmap(prefix,shape,solutions,orders,wideorders):
+    """
+    Returns the RectifyMap for a calibration set, loading it from
+    prefix+"_rect.npz" if that file was made from the same solutions, or
+    creating (and saving) it otherwise.
+    """
+    rectmap = RectifyMap(shape,solutions,orders,wideorders)
+    if not rectmap.load(prefix+"_rect.npz"):
+        rectmap.save(prefix+"_rect.npz")
+    return rectmap
+
+
+def straighten(data,solutions,orders,wideorders,interp=5,rectmap=None):
     d = data.copy()
     shape = d.shape
     output = d*numpy.nan
     bad = ~numpy.isfinite(d)
     d[bad] = 0.
-    coords = spectools.array_coords(shape)
-    x = coords[1]#.flatten()
-    y = coords[0]#.flatten()
+    if rectmap is None:
+        rectmap = RectifyMap(shape,solutions,orders,wideorders)
+    elif not rectmap.matches(shape,solutions,orders,wideorders):
+        raise ValueError('RectifyMap does not match the data/solutions')
     for i in range(len(solutions)):
         low,high = orders[i]
         wlow,whigh = wideorders[i]
-        ytrue,ymap = solutions[i]
 
-        yforw = genfunc(x[low:high].ravel(),y[low:high].ravel(),ytrue)
-        yforw = yforw.reshape((high-low,shape[1]))
-
-        tmpcoords = coords[:,low:high,:].copy()
-        tmpcoords[0] = yforw-wlow
+        tmpcoords = rectmap.coords(rectmap.forward(i))
         tmp = ndimage.map_coordinates(d[wlow:whigh],tmpcoords,output=numpy.float64,cval=-2**15,order=interp)
         output[low:high] = tmp.copy()
     output[output==-2**15] = scipy.nan
     return output
 
 
-def curve(indata,solutions,orders,wideorders,interp=5):
+def curve(indata,solutions,orders,wideorders,interp=5,rectmap=None):
     d = indata.astype(numpy.float64)
 
     mid = scipy.median(d[scipy.isfinite(indata)])
     d[scipy.isnan(indata)] = mid
     output = scipy.zeros(d.shape) 
-    coords = spectools.array_coords(d.shape)
-    x = coords[1]#.flatten()
-    y = coords[0]#.flatten()
-    yorig = coords[0].copy()
+    if rectmap is None:
+        rectmap = RectifyMap(d.shape,solutions,orders,wideorders)
+    elif not rectmap.matches(d.shape,solutions,orders,wideorders):
+        raise ValueError('RectifyMap does not match the data/solutions')
     for i in range(len(solutions)):
         low,high = orders[i]
         wlow,whigh = wideorders[i]
-        ytrue,ymap = solutions[i]
-
-        yback = genfunc(x[wlow:whigh].ravel(),y[wlow:whigh].ravel(),ymap)
-        yback = yback.reshape((whigh-wlow,coords[0].shape[1]))
 
-        tmpcoords = coords[:,wlow:whigh,:].copy()
-        tmpcoords[0] = yback-low
+        tmpcoords = rectmap.coords(rectmap.backward(i))
         tmp = ndimage.map_coordinates(d[low:high],tmpcoords,output=numpy.float64,cval=0.,order=interp)
         output[wlow:whigh] += tmp.copy()
     return output
@@ -1,89 +1,341 @@
 """
 Helper routines to perform bias subtraction and overscan trimming of LRIS data.
+
+The CCD layout (number of amplifiers, prescan/overscan columns, binning,
+  and window) is described by a Geometry, which is read from the header
+  keywords NUMAMPS, PREPIX, POSTPIX, BINNING, and WINDOW when they are
+  present; otherwise the unbinned full-frame layout of each side is used.
+  Raw frames are stored as
+
+	[prescan amp 1]...[prescan amp n][data amp 1]...[data amp n]
+	  [overscan amp 1]...[overscan amp n]
+
+  along each row, and the bias level of each amplifier is estimated from
+  its prescan and overscan columns in that row. For unbinned full frames
+  the traditional (hardwired) prescan/overscan windows and weights of each
+  side are used by default; otherwise, or if pooled=True, the bias is the
+  mean of all of the prescan and overscan pixels of the amplifier
+  (skipping the columns at each end of the prescan).
 """
 
-import scipy
+import numpy
+from multiprocessing import Pool
+from astropy.io import fits as pyfits
+
+# Saturated (or otherwise screwed) pixels in trimmed data
+SATURATION = 56000.
+
+
+def _getint(header,key,default):
+	if header is None:
+		return default
+	try:
+		return int(header[key])
+	except:
+		return default
 
 
-def oneamp(data):
+def _getlist(header,key):
+	if header is None:
+		return None
+	try:
+		return [int(v) for v in str(header[key]).split(',')]
+	except:
+		return None
+
+
+class Geometry(object):
 	"""
-	Subtracts bias from data and returns the overscan region-subtracted
-	  image.
+	Geometry(namps,prepix,postpix,gains,edge=0,skip=1,flip=False,
+	         binning=(1,1),window=(0,0),badcols=[],biasregions=None)
+
+	Describes the layout of a raw LRIS frame.
+
+	  namps   - number of amplifiers (read out along the rows)
+	  prepix  - number of prescan columns per amplifier
+	  postpix - number of overscan columns per amplifier
+	  gains   - relative gain of each amplifier (this does *not* convert
+	              from DN to electrons)
+	  edge    - number of columns trimmed from each side of the data
+	  skip    - number of columns ignored at each end of the prescan
+	  flip    - True if the output is transposed and flipped (blueside)
+	  binning - (x,y) binning
+	  window  - (x,y) origin of the readout window in unbinned pixels
+	  badcols - list of (column,row start,row end) bad columns, in unbinned
+	              pixels of the (untrimmed) data region
+	  biasregions - optional list (one per amplifier) of (start,end,weight)
+	              column ranges of the raw frame; the bias level is the
+	              weighted average of the mean of each range. If None, the
+	              pooled mean of the prescan and overscan is used.
 	"""
-	bias = (data[:,2:21].mean(axis=1)*18+data[:,2069:2148].mean(axis=1)*80)/98.
-	out_data = data[:,21:2069]-bias
+	def __init__(self,namps,prepix,postpix,gains,edge=0,skip=1,flip=False,binning=(1,1),window=(0,0),badcols=[],biasregions=None):
+		self.namps = namps
+		self.prepix = prepix
+		self.postpix = postpix
+		self.gains = gains
+		self.edge = edge
+		self.skip = skip
+		self.flip = flip
+		self.binning = binning
+		self.window = window
+		self.badcols = badcols
+		self.biasregions = biasregions
 
-	return out_data
+	def amplifiers(self,ncols):
+		"""
+		Returns a list of (data,bias,out) column ranges for each
+		  amplifier of a raw frame with ncols columns; bias is a list of
+		  (start,end,weight) prescan and overscan ranges and out is the
+		  range of the amplifier in the trimmed data (along the output
+		  axis).
+		"""
+		n = self.namps
+		width = (ncols-n*(self.prepix+self.postpix))//n
+		start = n*self.prepix
+		end = start+n*width
+		amps = []
+		for i in range(n):
+			lo = max(start+i*width,start+self.edge)
+			hi = min(start+(i+1)*width,end-self.edge)
+			pre = (i*self.prepix+self.skip,(i+1)*self.prepix-self.skip)
+			post = (end+i*self.postpix,end+(i+1)*self.postpix)
+			if self.biasregions is not None:
+				bias = self.biasregions[i]
+			else:
+				bias = [(a,b,b-a) for a,b in [pre,post] if b>a]
+			out = (lo-start-self.edge,hi-start-self.edge)
+			amps.append(((lo,hi),bias,out))
+		return amps
 
+	def trimmed_shape(self,shape):
+		ncols = shape[1]-self.namps*(self.prepix+self.postpix)
+		ncols = self.namps*(ncols//self.namps)-2*self.edge
+		if self.flip:
+			return (ncols,shape[0])
+		return (shape[0],ncols)
 
-def redside(data):
-	"""
-	Subtracts bias from data and returns the overscan region-subtracted
-	  image. CCD geometry is currently hardwired, so this won't work for
-	  windowed or binned setups.
+	def bad_pixels(self,shape):
+		"""
+		Returns a boolean mask of the bad columns in the trimmed data
+		  (with the given trimmed shape).
+		"""
+		mask = numpy.zeros(shape,dtype=bool)
+		bx,by = self.binning
+		x0,y0 = self.window
+		for col,rlo,rhi in self.badcols:
+			x = (col-x0)//bx-self.edge
+			lo = max((rlo-y0)//by,0)
+			hi = min(-(-(rhi-y0)//by),shape[0])
+			if x<0 or x>=shape[1] or hi<=lo:
+				continue
+			mask[lo:hi,x] = True
+		return mask
+
+
+# The traditional bias windows, (start,end,weight) for each amplifier, of
+#   unbinned full frames, keyed on the side and the raw frame width
+FULLFRAME_BIAS = {
+	('red',2248):[[(1,20,19),(2088,2168,80)],[(20,38,18),(2168,2248,80)]],
+	('oneamp',2148):[[(2,21,18),(2069,2148,80)]],
+	('blue',4620):[[(0,50,1),(4300,4380,1)],[(52,101,1),(4380,4460,1)],
+			[(102,153,1),(4460,4540,1)],[(153,202,1),(4540,4620,1)]]}
+
+
+def geometry(header=None,shape=None,side='red',pooled=False):
 	"""
-	if data.shape[1]==2148:
-		return oneamp(data)
+	geometry(header=None,shape=None,side='red',pooled=False)
 
-	bias = scipy.empty((2,data.shape[0]))
+	Returns the Geometry of a raw frame from its header (and shape, which is
+	  used to choose the single-amplifier redside layout if NUMAMPS is not
+	  present), falling back on the default layout of each side. side is
+	  'red', 'blue', or 'oneamp' (the single-amplifier redside readout).
+	  Unbinned full frames use the traditional bias windows and weights
+	  unless pooled is True, in which case (as for binned or windowed
+	  frames) the pooled mean of the prescan and overscan is used.
+	"""
+	geom = _geometry(header,shape,side)
+	if not pooled and shape is not None and geom.binning==(1,1):
+		if side!='blue' and geom.namps==1:
+			side = 'oneamp'
+		key = (side,shape[1])
+		if key in FULLFRAME_BIAS and len(FULLFRAME_BIAS[key])==geom.namps:
+			geom.biasregions = FULLFRAME_BIAS[key]
+	return geom
 
-	bias[0] = (data[:,1:20].mean(axis=1)*19+data[:,2088:2168].mean(axis=1)*80)/99.
-	bias[1] = (data[:,20:38].mean(axis=1)*18+data[:,2168:2248].mean(axis=1)*80)/98.
 
+def _geometry(header,shape,side):
+	binning = _getlist(header,'BINNING')
+	if binning is None or len(binning)!=2:
+		binning = (1,1)
+	binning = tuple(binning)
+	# WINDOW is 'chip,x,y,nx,ny' (or 'x,y,nx,ny')
+	window = _getlist(header,'WINDOW')
+	if window is None or len(window)<4:
+		window = (0,0)
+	else:
+		window = (window[-4],window[-3])
 
-	out_data = scipy.empty((2046,2048))
+	if side=='blue':
+		return Geometry(_getint(header,'NUMAMPS',4),_getint(header,'PREPIX',51),
+				_getint(header,'POSTPIX',80),[1.,1.,1.,1.],flip=True,
+				binning=binning,window=window)
 
+	namps = 2
+	if side=='oneamp' or (shape is not None and shape[1]==2148):
+		namps = 1
+	if side!='oneamp':
+		namps = _getint(header,'NUMAMPS',namps)
+	if namps==1:
+		return Geometry(1,_getint(header,'PREPIX',21),_getint(header,'POSTPIX',79),
+				[1.],binning=binning,window=window)
 	"""
 	Mask out the bad columns. Note this might not be appropriate for older
 	  data (or if the CCDs change).
 	"""
-	mask = (data[0:1490,995]+data[0:1490,997])/2.
-	data[0:1490,996] = mask.copy()
-	mask = (data[0:1493,999]+data[0:1493,1001])/2.
-	data[0:1493,1000] = mask.copy()
+	badcols = [(956,0,1490),(960,0,1493)]
+	"""
+	Fix difference in amplifier gains. Note this differs from the LRIS
+	  website that would suggest 1.0960.
+	"""
+	gains = [1.,1.0765]
+	return Geometry(namps,_getint(header,'PREPIX',20),_getint(header,'POSTPIX',80),
+			gains,edge=1,binning=binning,window=window,badcols=badcols)
+
+
+def fix_pixels(data,mask):
+	"""
+	fix_pixels(data,mask)
+
+	Replaces the masked pixels of data (in place) by linearly interpolating
+	  along each row between the nearest unmasked pixels; masked pixels at
+	  the ends of a row take the value of the nearest unmasked pixel.
+	"""
+	rows = numpy.where(mask.any(1))[0]
+	if rows.size==0:
+		return data
+	# Only the columns spanned by the bad pixels (and their neighbours)
+	#   are needed
+	cols = numpy.where(mask[rows].any(0))[0]
+	c0 = max(cols[0]-1,0)
+	c1 = min(cols[-1]+2,mask.shape[1])
+	sub = data[rows,c0:c1]
+	bad = mask[rows,c0:c1]
+	ncols = sub.shape[1]
+	cols = numpy.arange(ncols)
+	left = numpy.maximum.accumulate(numpy.where(bad,-1,cols),1)
+	right = numpy.where(bad,ncols,cols)[:,::-1]
+	right = numpy.minimum.accumulate(right,1)[:,::-1]
 
-	data = data.transpose()
+	r,c = numpy.where(bad)
+	lo = left[r,c]
+	hi = right[r,c]
+	ok = (lo>=0)|(hi<ncols)
+	r,c,lo,hi = r[ok],c[ok],lo[ok],hi[ok]
+	lo = numpy.where(lo<0,hi,lo)
+	hi = numpy.where(hi>=ncols,lo,hi)
+	frac = numpy.where(hi>lo,(c-lo)/numpy.maximum(hi-lo,1.),0.)
+	sub[r,c] = sub[r,lo]*(1.-frac)+sub[r,hi]*frac
+	data[rows,c0:c1] = sub
+	return data
 
-	out_data[0:1023,:] = data[41:1064,:] - bias[0]
-	out_data[1023:2046,:] = data[1064:2087,:] - bias[1]
 
+def fix_saturated(data,level=SATURATION):
 	"""
-	Fix difference in amplifier gains. This does *not* convert from DN
-	  to electrons.
+	Interpolates over pixels above level (in place).
 	"""
-	out_data[1023:2046,:] *= 1.0765 # Note this differs from the LRIS
-					#  website that would suggest 1.0960
+	return fix_pixels(data,data>level)
 
-	out_data = out_data.transpose()
 
-	return out_data
+def biastrim(data,geom,dtype=numpy.float64):
+	"""
+	biastrim(data,geom,dtype=numpy.float64)
 
-def blueside(data):
+	Subtracts the bias level of each amplifier (row by row), applies the
+	  relative amplifier gains, trims the prescan/overscan regions, and
+	  interpolates over the bad columns of the detector. The input data
+	  are not modified.
+	"""
+	out = numpy.empty(geom.trimmed_shape(data.shape),dtype)
+	gains = list(geom.gains)+[1.]*geom.namps
+	for ((lo,hi),bias,(olo,ohi)),gain in zip(geom.amplifiers(data.shape[1]),gains):
+		level = numpy.zeros(data.shape[0])
+		weight = 0.
+		for a,b,w in bias:
+			level += data[:,a:b].mean(1,dtype=numpy.float64)*w
+			weight += w
+		level /= weight
+		if geom.flip:
+			numpy.subtract(data[:,lo:hi].T[:,::-1],level[::-1],out=out[olo:ohi],casting='unsafe')
+			if gain!=1.:
+				out[olo:ohi] *= gain
+		else:
+			numpy.subtract(data[:,lo:hi],level[:,None],out=out[:,olo:ohi],casting='unsafe')
+			if gain!=1.:
+				out[:,olo:ohi] *= gain
+	if len(geom.badcols)>0:
+		fix_pixels(out,geom.bad_pixels(out.shape))
+	return out
+
+
+def oneamp(data,header=None,pooled=False):
 	"""
 	Subtracts bias from data and returns the overscan region-subtracted
 	  image.
 	"""
-	data = data.T
-	data = data[:,::-1]
-	size = data.shape[1]
+	return biastrim(data,geometry(header,data.shape,'oneamp',pooled))
+
+
+def redside(data,header=None,pooled=False):
+	"""
+	Subtracts bias from data and returns the overscan region-subtracted
+	  image. The CCD geometry is taken from the header if it is given.
+	"""
+	return biastrim(data,geometry(header,data.shape,'red',pooled))
 
-	bias = scipy.empty((4,size))
-	bias[0] = (data[0:50,:].mean(axis=0) + data[4300:4380,:].mean(axis=0))/2.
-	bias[1] = (data[52:101,:].mean(axis=0) + data[4380:4460,:].mean(axis=0))/2.
-	bias[2] = (data[102:153,:].mean(axis=0) + data[4460:4540,:].mean(axis=0))/2.
-	bias[3] = (data[153:202,:].mean(axis=0) + data[4540:4620,:].mean(axis=0))/2.
 
+def blueside(data,header=None,pooled=False):
 	"""
-	Conversion factor from DN to electrons (from LRIS website; disabled for
-	  now).
+	Subtracts bias from data and returns the overscan region-subtracted
+	  image. The CCD geometry is taken from the header if it is given.
 	"""
-	gain = [1.55,1.56,1.63,1.70]
-	outdata = scipy.empty((4096,4096))
-	for i in range(4):
-		outstart = i*1024
-		datastart = i*1024 + 204
-		outdata[outstart:outstart+1024,:] = data[datastart:datastart+1024,:] - bias[i]
-	#	outdata[outstart:outstart+1024,:] *= gain[i]
-	del bias
+	return biastrim(data,geometry(header,data.shape,'blue',pooled))
+
+
+def _trim_file(args):
+	filename,side,level,dtype,pooled = args
+	hdu = pyfits.open(filename)[0]
+	data = biastrim(hdu.data,geometry(hdu.header,hdu.data.shape,side,pooled),dtype)
+	if level is not None:
+		fix_saturated(data,level)
+	return data
+
 
-	return outdata
+def trim_frames(filenames,side='red',nproc=1,level=SATURATION,dtype=numpy.float32,pooled=False):
+	"""
+	trim_frames(filenames,side='red',nproc=1,level=SATURATION,
+	            dtype=numpy.float32,pooled=False)
+
+	Bias-subtracts and trims a list of raw frames, interpolating over pixels
+	  above level (use None to skip this). The frames are processed in
+	  parallel if nproc>1.
+
+	Inputs:
+	  filenames - list of FITS files
+	  side      - 'red' or 'blue'
+	  nproc     - number of processes
+	  level     - saturation level of the trimmed data
+	  dtype     - type of the output arrays
+	  pooled    - use the pooled prescan/overscan mean for the bias even
+	                for unbinned full frames (see geometry)
+
+	Outputs:
+	  list of trimmed arrays
+	"""
+	jobs = [(f,side,level,dtype,pooled) for f in filenames]
+	if nproc>1 and len(jobs)>1:
+		pool = Pool(min(nproc,len(jobs)))
+		out = pool.map(_trim_file,jobs)
+		pool.close()
+		pool.join()
+		return out
+	return [_trim_file(job) for job in jobs]
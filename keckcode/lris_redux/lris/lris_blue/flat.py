@@ -7,12 +7,15 @@ NOTES:	The pipeline treats the two CCDs as independent (since they are...).
 	  side to make them worthwhile), so no normalization is performed.
 """
 
-import scipy,pickle
+import scipy,pickle,os,sys
 from astropy.io import fits as pyfits
 
-def flatpipe(flatfiles,out_prefix):
+# Header keywords that describe the configuration of a flat
+CONFIG_KEYWORDS = ['GRISNAME','DICHNAME','SLITNAME','BINNING','WINDOW']
+
+def flatpipe(flatfiles,out_prefix,cache=None):
 	"""
-	flatpipe(flatfiles,out_prefix)
+	flatpipe(flatfiles,out_prefix,cache=None)
 
 	Processes the spectroscopic flats by:
 	  coadding
@@ -32,13 +35,24 @@ def flatpipe(flatfiles,out_prefix):
 	from lris.lris_biastrim import blueside as biastrim
 	from mostools import ycorrect,id_slits,spectools
 	from special_functions import lsqfit,genfunc
+	import special_functions
+	from lris import lris_biastrim
+
+	if cache is not None:
+		code = [sys.modules[__name__],lris_biastrim,ycorrect,id_slits,spectools,special_functions]
+		key = cache.key(flatfiles,CONFIG_KEYWORDS,code)
+		products = cache.get('blueflat',key)
+		if products is not None:
+			print "Using cached flat products"
+			flatsave(out_prefix,**products)
+			return products['yforw'],products['yback'],products['slits'],products['starboxes']
 
 
 	# Read data from files, biastrim and coadd
 	weight = 0
 	for name in flatfiles:
 		flattmp = pyfits.open(name)
-		flatdata = biastrim(flattmp[0].data.copy())
+		flatdata = biastrim(flattmp[0].data,flattmp[0].header)
 		exptime = flattmp[0].header['elaptime']
 
 		if weight==0:
@@ -104,11 +118,29 @@ def flatpipe(flatfiles,out_prefix):
 			print "[:,%d:%d]" % (a+add,b+add)
 		print ""
 
-		# Output coefficient arrays
-		outname = out_prefix+"_yforw_%s.fits" % i
-		pyfits.PrimaryHDU(yforw[i]).writeto(outname)
-		outname = out_prefix+"_yback_%s.fits" % i
-		pyfits.PrimaryHDU(yback[i]).writeto(outname)
+	products = {'yforw':yforw,'yback':yback,'slits':slits,
+		'starboxes':starboxes,'ytrue':ytrue,'ymap':ymap}
+	if cache is not None:
+		cache.put('blueflat',key,products)
+	flatsave(out_prefix,**products)
+
+	return yforw,yback,slits,starboxes
+
+
+def _writefits(data,filename):
+	if os.path.exists(filename):
+		os.remove(filename)
+	pyfits.PrimaryHDU(data).writeto(filename)
+
+
+def flatsave(out_prefix,yforw,yback,slits,starboxes,ytrue,ymap):
+	"""
+	Writes the outputs of flatpipe(), replacing existing files.
+	"""
+	# Output coefficient arrays
+	for i in ['bottom','top']:
+		_writefits(yforw[i],out_prefix+"_yforw_%s.fits" % i)
+		_writefits(yback[i],out_prefix+"_yback_%s.fits" % i)
 
 	# Output distortion solutions and slit definitions
 	outname = out_prefix+"_ygeom.dat"
@@ -119,7 +151,6 @@ def flatpipe(flatfiles,out_prefix):
 	pickle.dump(ymap,outfile)
 	outfile.close()
 
-	return yforw,yback,slits,starboxes
 
 # For flatfield reductions that have already been performed.
 def flatload(out_prefix):
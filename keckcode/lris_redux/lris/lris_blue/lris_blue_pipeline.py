@@ -12,21 +12,29 @@ Inputs:
   cache       - 1 to cache data to disk (useful for blueside with RAM
   offsets     - a list/array of relative offsets between masks (in pixels)
   logfile     - name of the output logfile (out_prefix.log is used otherwise)
+  nproc       - number of processes used to bias trim the science frames
+                and to reduce the slits
+  usecache    - 1 to reuse flat/distortion and arc products from the
+                calibration cache (out_prefix directory/calib_cache) if
+                they were made from the same raw frames and code
 """
 
 import lris
 from lris.lris_biastrim import blueside as biastrim
+from lris.lris_biastrim import trim_frames
 
 from lris.lris_blue.flat import *
 from lris.lris_blue.skysub import doskysub
 from lris.lris_blue.arc import make_arc,make_linelist
 
 from mostools import spectools,offset,measure_width
+from mostools.slitpool import map_slits
+from mostools.calcache import CalibrationCache,array_hash
 from mostools.extract import extract
 import special_functions
 
 from math import ceil,fabs
-import time,pickle
+import time,pickle,os
 
 import scipy
 from scipy import stats,interpolate,ndimage
@@ -51,10 +59,35 @@ def get_yback(out_prefix,side='top'):
 	name = out_prefix+"_yback_%s.fits" % side
 	return pyfits.open(name)[0].data.astype(scipy.float32)
 
+"""
+Determine the wavelength solution of slit k of one detector, then resample
+  and background subtract it; s holds the (read-only) data shared by all of
+  the slits. The log entries for the slit are written to a separate file
+  and returned, so that the main log is kept in slit order.
+"""
+def reduce_slit(k,s):
+	i,j = s['slits'][k]
+	a,b = s['wide_slits'][k]
+	off = s['off']
+	count = s['first']+k
+	print "Working on slit %d (%d to %d)" % (count,i+off,j+off)
+	logfile = open('%s.slit%d' % (s['logname'],count),'w')
+	logfile.write("Working on slit %d (%d to %d)\n" % (count,i+off,j+off))
+	logfile.close()
+	sky2x,sky2y,ccd2wave = s['wavematch'](a,s['scidata'][:,a+off:b+off],s['arc_ycor'][i:j],s['yforw'][i:j],s['widemodel'],s['finemodel'],s['goodmodel'],s['linemodel'],s['scale'],s['mswave'],s['extra'],logfile)
+	logfile = open(logfile.name,'a')
+	logfile.write("\n")
+	logfile.close()
+	strt,bgsub,varimg = doskysub(i,j-i,s['outlength'],s['scidata'][:,a+off:b+off],s['yback'][a:b],sky2x,sky2y,ccd2wave,s['scale'],s['mswave'],s['center'],s['extra2'])
+	log = open(logfile.name).read()
+	os.remove(logfile.name)
+	return strt,bgsub,varimg,log
+
+
 """
 Main pipeline. The blueside currently includes logging.
 """
-def lris_pipeline(prefix,dir,scinames,arcname,flatnames,out_prefix,useflat=0,usearc=0,cache=0,offsets=None,logfile=None):
+def lris_pipeline(prefix,dir,scinames,arcname,flatnames,out_prefix,useflat=0,usearc=0,cache=0,offsets=None,logfile=None,nproc=1,usecache=1):
 	# Create a logfile for this session
 	if logfile is None:
 		logfile = open('%s.log' % out_prefix,'w')
@@ -72,13 +105,17 @@ def lris_pipeline(prefix,dir,scinames,arcname,flatnames,out_prefix,useflat=0,use
 	nsci = len(scinames)
 	YMID = 2048  # offset for the second detector
 
+	calib = None
+	if usecache==1:
+		calib = CalibrationCache(os.path.join(os.path.dirname(out_prefix),'calib_cache'))
+
 	print "Preparing flatfields"
 	if useflat==1:
 		logfile.write('Using pre-made flats\n')
 		yforw,yback,slits,starboxes = flatload(out_prefix)
 	else:
 		logfile.write('Making new flats\n')
-		yforw,yback,slits,starboxes = flatpipe(flatnames,out_prefix)
+		yforw,yback,slits,starboxes = flatpipe(flatnames,out_prefix,calib)
 
 
 	print "Preparing arcs for line identification"
@@ -93,37 +130,49 @@ def lris_pipeline(prefix,dir,scinames,arcname,flatnames,out_prefix,useflat=0,use
 			filter = arc_tmp[0].header['BLUFILT']
 			del arc_tmp
 	else:
-		logfile.write('Making new arcs\n')
-		""" Load arc data from fits file """
-		arc_tmp = pyfits.open(arcname)
-		arcdata = arc_tmp[0].data.copy()
+		"""
+		The straightened arcs depend on the raw arc and on the
+		  distortion maps.
+		"""
+		products = None
+		if calib is not None:
+			code = [lris.lris_biastrim,spectools]
+			arckey = calib.key([arcname],CONFIG_KEYWORDS+['LAMPS','BLUFILT'],code,array_hash(yforw['bottom'],yforw['top']))
+			products = calib.get('bluearc',arckey)
+		if products is not None:
+			logfile.write('Using cached arcs\n')
+			arc_ycor,lamps,filter = products['arc_ycor'],products['lamps'],products['filter']
+		else:
+			logfile.write('Making new arcs\n')
+			""" Load arc data from fits file """
+			arc_tmp = pyfits.open(arcname)
+			arcdata = biastrim(arc_tmp[0].data,arc_tmp[0].header)
 
-		""" Determine which lamps were used """
-		lamps = arc_tmp[0].header['LAMPS']
-		try:
-			filter = arc_tmp[0].header['BLUFILT']
-		except:
-			filter = 'clear'
-		del arc_tmp
+			""" Determine which lamps were used """
+			lamps = arc_tmp[0].header['LAMPS']
+			try:
+				filter = arc_tmp[0].header['BLUFILT']
+			except:
+				filter = 'clear'
+			del arc_tmp
 
-		""" Process arcs for the top and bottom separately """
-		arcdata = biastrim(arcdata)
-		arc_ycor = {}
-		arc_ycor['bottom'] = spectools.resampley(arcdata[:YMID],yforw['bottom']).astype(scipy.float32)
-		arcname = out_prefix+"_arc_bottom.fits"
-		arc_hdu = pyfits.PrimaryHDU(arc_ycor['bottom'])
-		arc_hdu.header.update('LAMPS',lamps)
-		arc_hdu.header.update('BLUFILT',filter)
-		arc_hdu.writeto(arcname)
-
-		arc_ycor['top'] = spectools.resampley(arcdata[YMID:],yforw['top']).astype(scipy.float32)
-		arcname = out_prefix+"_arc_top.fits"
-		arc_hdu = pyfits.PrimaryHDU(arc_ycor['top'])
-		arc_hdu.header.update('LAMPS',lamps)
-		arc_hdu.header.update('BLUFILT',filter)
-		arc_hdu.writeto(arcname)
-
-		del arc_hdu,arcdata
+			""" Process arcs for the top and bottom separately """
+			arc_ycor = {}
+			arc_ycor['bottom'] = spectools.resampley(arcdata[:YMID],yforw['bottom']).astype(scipy.float32)
+			arc_ycor['top'] = spectools.resampley(arcdata[YMID:],yforw['top']).astype(scipy.float32)
+			del arcdata
+			if calib is not None:
+				calib.put('bluearc',arckey,{'arc_ycor':arc_ycor,'lamps':lamps,'filter':filter})
+
+		for i in ['bottom','top']:
+			arcname = out_prefix+"_arc_%s.fits" % i
+			if os.path.exists(arcname):
+				os.remove(arcname)
+			arc_hdu = pyfits.PrimaryHDU(arc_ycor[i])
+			arc_hdu.header.update('LAMPS',lamps)
+			arc_hdu.header.update('BLUFILT',filter)
+			arc_hdu.writeto(arcname)
+		del arc_hdu
 
 	axis1 = 4096
 	axis2 = 4096
@@ -156,23 +205,17 @@ def lris_pipeline(prefix,dir,scinames,arcname,flatnames,out_prefix,useflat=0,use
 	scidata = scipy.zeros((nsci,axis1,axis2),'f4')
 	center = scipy.zeros((nsci,nstars),'f4')
 	flux = scipy.zeros((nsci),'f4')
+	"""
+	Bias trim the frames (in parallel if nproc>1) and remove screwed
+	  columns/saturated pixels.
+	"""
+	trimmed = trim_frames(scinames,'blue',nproc)
 	for i in range(nsci):
 		filename = scinames[i]
 		scitmp = pyfits.open(filename)
 
-		scidatatmp = scitmp[0].data.copy()
-		scidatatmp = biastrim(scidatatmp).astype(scipy.float32)
-
-		"""
-		Remove screwed columns (this should already be done by biastrim
-		  though...).
-		"""
-		bad = scipy.where(scidatatmp>56000.)
-		nbad = bad[0].size
-		for k in range(nbad):
-			y = bad[0][k]
-			x = bad[1][k]
-			scidatatmp[y,x] = (scidatatmp[y,x-1]+scidatatmp[y,x+1])/2.
+		scidatatmp = trimmed[i]
+		trimmed[i] = None
 		"""
 		We don't flatfield blueside data because of ghosts and
 		  reflections. Milan Bogosavljevic has data that show that
@@ -492,113 +535,100 @@ def lris_pipeline(prefix,dir,scinames,arcname,flatnames,out_prefix,useflat=0,use
           determine all wavelength solutions, then jointly determine a 'master'
           solution.... posc stores the current (starting) position of the
           coadded array, and posn stores the current position of the straight
-          array. off is 0 while looping over the bottom and YMID for the top. n
-	  is the number of bottom slits, so that the 1st top slit is n+1.
+          array. off is 0 while looping over the bottom and YMID for the top.
+	  The slits of each detector are reduced by nproc processes (see
+	  reduce_slit), and the results are stored here in slit order.
         """
-	nbottom = len(slits['bottom'])
-	nslits = nbottom+len(slits['top'])
 	posc = 0
 	posn = 0
 	count = 1
-	off = 0
-	n = 0
-	narrow = slits['bottom']
-	wide = wide_slits['bottom']
 
 	""" Debugging feature; set to 1 to skip background subtraction """
 	lris.lris_blue.skysub.RESAMPLE = 0
-	for k in range(nslits):
+	for l,off in [['bottom',0],['top',YMID]]:
 		"""
 		When we have finished all of the bottom slits, switch
 		  parameters over to their top values.
 		"""
-		if k==nbottom:
+		if l=='top':
+			del shared
 			arc_ycor = get_arc(out_prefix)
 			yforw = get_yforw(out_prefix)
 			yback = get_yback(out_prefix)
-			n = nbottom
-			off = YMID
-			narrow = slits['top']
-			wide = wide_slits['top']
-		i,j = narrow[k-n]
-		a,b = wide[k-n]
-
-		""" Debugging feature; change number to skip initial slits """
-		if count<1:
-			count += 1
-			continue
-		
-		print "Working on slit %d (%d to %d)" % (count,i+off,j+off)
-		logfile = open(logfile.name,'a')
-		logfile.write("Working on slit %d (%d to %d)\n" % (count,i+off,j+off))
-		logfile.close()
-		sky2x,sky2y,ccd2wave = wavematch(a,scidata[:,a+off:b+off],arc_ycor[i:j],yforw[i:j],widemodel,finemodel,goodmodel,linemodel,scale,mswave,extra,logfile)
-		logfile = open(logfile.name,'a')
-		logfile.write("\n")
-		logfile.close()
-		strt,bgsub,varimg = doskysub(i,j-i,outlength,scidata[:,a+off:b+off],yback[a:b],sky2x,sky2y,ccd2wave,scale,mswave,center,extra2)
-
-		""" Store the resampled 2d spectra """
-		h = strt.shape[1]
-		if cache:
-			file = pyfits.open(strtfile,mode="update")
-			out = file[0].data
-		out[:,posn:posn+h] = strt.copy()
-		if cache:
-			file.close()
-			del file,out
-		posn += h+5
-
-		if lris.lris_blue.skysub.RESAMPLE==1:
+		shared = {'slits':slits[l],'wide_slits':wide_slits[l],'off':off,
+			'first':count,'scidata':scidata,'arc_ycor':arc_ycor,
+			'yforw':yforw,'yback':yback,'wavematch':wavematch,
+			'widemodel':widemodel,'finemodel':finemodel,
+			'goodmodel':goodmodel,'linemodel':linemodel,
+			'scale':scale,'mswave':mswave,'extra':extra,
+			'extra2':extra2,'outlength':outlength,'center':center,
+			'logname':logfile.name}
+		for strt,bgsub,varimg,log in map_slits(reduce_slit,len(slits[l]),shared,nproc):
+			logfile = open(logfile.name,'a')
+			logfile.write(log)
+			logfile.close()
+
+			""" Store the resampled 2d spectra """
+			h = strt.shape[1]
+			if cache:
+				file = pyfits.open(strtfile,mode="update")
+				out = file[0].data
+			out[:,posn:posn+h] = strt.copy()
+			if cache:
+				file.close()
+				del file,out
+			posn += h+5
+
+			if lris.lris_blue.skysub.RESAMPLE==1:
+				count += 1
+				continue
+
+			""" Store the resampled, background subtracted 2d spectra """
+			h = bgsub.shape[0]
+			if cache:
+				file = pyfits.open(bgfile,mode="update")
+				out2 = file[0].data
+			out2[0,posc:posc+h] = bgsub.copy()
+			out2[1,posc:posc+h] = varimg.copy()
+			if cache:
+				file.close()
+				del file,out2
+			posc += h+5
+
+
+			""" Find and extract object traces """
+			tmp = scipy.where(scipy.isnan(bgsub),0.,bgsub)
+			filter = tmp.sum(axis=0)
+			mod = scipy.where(filter!=0)
+			start = mod[0][0]
+			end = mod[0][-1]+1
+			del tmp
+			slit = bgsub[:,start:end]
+			spectra = extract(slit,varimg[:,start:end],extractwidth)
+			num = 1
+			crval = mswave-(0.5*bgsub.shape[1]-start)*scale
+			for spec in spectra:
+				for item in spec:
+					if item.size==4:
+						hdu = pyfits.PrimaryHDU()
+						hdu.header.update('CENTER',item[2])
+						hdu.header.update('WIDTH',item[3])
+						hdulist = pyfits.HDUList([hdu])
+					else:
+						thdu = pyfits.ImageHDU(item)
+						thdu.header.update('CRVAL1',crval)
+						thdu.header.update('CD1_1',scale)
+						thdu.header.update('CRPIX1',1)
+						thdu.header.update('CRVAL2',1)
+						thdu.header.update('CD2_2',1)
+						thdu.header.update('CRPIX2',1)
+						thdu.header.update('CTYPE1','LINEAR')
+						hdulist.append(thdu)
+				outname = out_prefix+"_spec_%02d_%02d.fits" % (count,num)
+				hdulist.writeto(outname)
+				num += 1
+
 			count += 1
-			continue
-
-		""" Store the resampled, background subtracted 2d spectra """
-		h = bgsub.shape[0]
-		if cache:
-			file = pyfits.open(bgfile,mode="update")
-			out2 = file[0].data
-		out2[0,posc:posc+h] = bgsub.copy()
-		out2[1,posc:posc+h] = varimg.copy()
-		if cache:
-			file.close()
-			del file,out2
-		posc += h+5
-
-
-		""" Find and extract object traces """
-		tmp = scipy.where(scipy.isnan(bgsub),0.,bgsub)
-		filter = tmp.sum(axis=0)
-		mod = scipy.where(filter!=0)
-		start = mod[0][0]
-		end = mod[0][-1]+1
-		del tmp
-		slit = bgsub[:,start:end]
-		spectra = extract(slit,varimg[:,start:end],extractwidth)
-		num = 1
-		crval = mswave-(0.5*bgsub.shape[1]-start)*scale
-		for spec in spectra:
-			for item in spec:
-				if item.size==4:
-					hdu = pyfits.PrimaryHDU()
-					hdu.header.update('CENTER',item[2])
-					hdu.header.update('WIDTH',item[3])
-					hdulist = pyfits.HDUList([hdu])
-				else:
-					thdu = pyfits.ImageHDU(item)
-					thdu.header.update('CRVAL1',crval)
-					thdu.header.update('CD1_1',scale)
-					thdu.header.update('CRPIX1',1)
-					thdu.header.update('CRVAL2',1)
-					thdu.header.update('CD2_2',1)
-					thdu.header.update('CRPIX2',1)
-					thdu.header.update('CTYPE1','LINEAR')
-					hdulist.append(thdu)
-			outname = out_prefix+"_spec_%02d_%02d.fits" % (count,num)
-			hdulist.writeto(outname)
-			num += 1
-
-		count += 1
 
 
 
@@ -4,7 +4,7 @@ Background subtract, resample, and coadd 2d spectra.
 
 
 from mostools import spectools,skysub
-from special_functions import genfunc
+from special_functions import genfunc,gridfunc
 
 import scipy
 from scipy import interpolate,ndimage,stats
@@ -70,6 +70,8 @@ def doskysub(straight,ylen,xlen,sci,yback,sky2x,sky2y,ccd2wave,disp,mswave,offse
 	outcoords[1] += mswave - disp*xlen/2.
 	xout = outcoords[1].flatten()
 	yout = outcoords[0].flatten()
+	outx = outcoords[1][0]
+	outy = outcoords[0][:,0]
 
 	out = scipy.zeros((nsci,ylen,xlen))
 
@@ -110,8 +112,8 @@ def doskysub(straight,ylen,xlen,sci,yback,sky2x,sky2y,ccd2wave,disp,mswave,offse
 		# Only resample if flag set
 		if RESAMPLE==1:
 			coords = outcoords.copy()
-			samp_x = genfunc(xout,yout,sky2x[k])
-			samp_y = genfunc(xout,yout,sky2y[k])
+			samp_x = gridfunc(outx,outy,sky2x[k])
+			samp_y = gridfunc(outx,outy,sky2y[k])
 			coords[0] = samp_y.reshape(coords[0].shape)
 			coords[1] = samp_x.reshape(coords[1].shape)
 			out[k] = scipy.ndimage.map_coordinates(sci[k],coords,output=scipy.float64,order=5,cval=-32768,prefilter=False)
@@ -123,13 +125,9 @@ def doskysub(straight,ylen,xlen,sci,yback,sky2x,sky2y,ccd2wave,disp,mswave,offse
 		bgfit = skysub.skysub(x,y,z,disp)
 
 		background = zfit.copy()
-		for indx in range(background.size):
-			x0 = xfit[indx]
-			y0 = yfit[indx]
-			if x0<locutoff-10 or x0>hicutoff+10:
-				background[indx] = scipy.nan
-			else:
-				background[indx] = interpolate.bisplev(x0,y0,bgfit)
+		bgcond = (xfit>=locutoff-10)&(xfit<=hicutoff+10)
+		background[bgcond] = skysub.bgeval(xfit[bgcond],yfit[bgcond],bgfit)
+		background[~bgcond] = scipy.nan
 		sub = zfit-background
 		sub[scipy.isnan(sub)] = 0.
 		sky = sub*0.
@@ -150,8 +148,8 @@ def doskysub(straight,ylen,xlen,sci,yback,sky2x,sky2y,ccd2wave,disp,mswave,offse
 
 		# Create straightened slit
 		coords = outcoords.copy()
-		samp_x = genfunc(xout,yout,sky2x[k])
-		samp_y = genfunc(xout,yout,sky2y[k])
+		samp_x = gridfunc(outx,outy,sky2x[k])
+		samp_y = gridfunc(outx,outy,sky2y[k])
 		coords[0] = samp_y.reshape(coords[0].shape)
 		coords[1] = samp_x.reshape(coords[1].shape)
 		out[k] = scipy.ndimage.map_coordinates(sci[k],coords,output=scipy.float64,order=5,cval=magicnum,prefilter=False)
@@ -161,10 +159,10 @@ def doskysub(straight,ylen,xlen,sci,yback,sky2x,sky2y,ccd2wave,disp,mswave,offse
 
 		# Output bgsub image
 		coords = bgcoords.copy()
-		bgy = bgcoords[0].flatten()+offsets[k]
-		bgx = bgcoords[1].flatten()
-		samp_x = genfunc(bgx,bgy,sky2x[k])
-		samp_y = genfunc(bgx,bgy,sky2y[k])
+		bgy = bgcoords[0][:,0]+offsets[k]
+		bgx = bgcoords[1][0]
+		samp_x = gridfunc(bgx,bgy,sky2x[k])
+		samp_y = gridfunc(bgx,bgy,sky2y[k])
 		coords[0] = samp_y.reshape(coords[0].shape)
 		coords[1] = samp_x.reshape(coords[1].shape)
 
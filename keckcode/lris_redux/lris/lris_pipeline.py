@@ -1,5 +1,5 @@
 """
-lris_pipeline(prefix,dir,science,arc,flats,out_prefix,useflat,usearc,cache,offsets)
+lris_pipeline(prefix,dir,science,arc,flats,out_prefix,useflat,usearc,cache,offsets,nproc,usecache)
 
 Pipeline to reduce LRIS red or blueside spectra. Automatically performs almost
   *all* operations, including: removing the instrumental signature (bias,
@@ -18,6 +18,10 @@ Inputs:
   usearc    - 1 to use arc data from a previous run
   cache     - 1 to cache data to disk (useful for blueside with RAM<2GB)
   offsets   - a list/array of relative y-offsets between masks (in pixels)
+  nproc     - number of processes used to bias trim the science frames
+                and to reduce the slits
+  usecache  - 1 to reuse flat/distortion and arc products from the
+                calibration cache if their raw frames have not changed
 
 Outputs:
   straightened, wavelength calibrated, cosmic-ray cleaned 2d spectra
@@ -29,7 +33,7 @@ Outputs:
 
 from astropy.io import fits as pyfits
 
-def lris_pipeline(prefix,dir,science,arc,flats,out_prefix,useflat=0,usearc=0,cache=0,offsets=None):
+def lris_pipeline(prefix,dir,science,arc,flats,out_prefix,useflat=0,usearc=0,cache=0,offsets=None,nproc=1,usecache=1):
 	""" Batch files will have a prefix """
 	if prefix is not None:
 		arcname = dir+prefix+arc+".fits"
@@ -94,4 +98,4 @@ def lris_pipeline(prefix,dir,science,arc,flats,out_prefix,useflat=0,usearc=0,cac
 	else:
 		from lris.lris_red.lris_red_pipeline import lris_pipeline as pipeline
 
-	pipeline(prefix,dir,scinames,arcname,flatnames,out_prefix,useflat,usearc,cache,offsets)
+	pipeline(prefix,dir,scinames,arcname,flatnames,out_prefix,useflat,usearc,cache,offsets,nproc=nproc,usecache=usecache)
@@ -3,12 +3,15 @@ Module to process the LRIS redside flat files. flatpipe() processes new files
   and flatload() loads pre-existing files.
 """
 
-import scipy,pickle
+import scipy,pickle,os,sys
 from astropy.io import fits as pyfits
 
-def flatpipe(flatfiles,out_prefix):
+# Header keywords that describe the configuration of a flat
+CONFIG_KEYWORDS = ['GRANAME','DICHNAME','SLITNAME','BINNING','WINDOW']
+
+def flatpipe(flatfiles,out_prefix,cache=None):
 	"""
-	flatpipe(flatfiles,out_prefix)
+	flatpipe(flatfiles,out_prefix,cache=None)
 
 	Processes the spectroscopic flats by:
 	  coadding
@@ -20,6 +23,9 @@ def flatpipe(flatfiles,out_prefix):
 	  flatfiles  - a list of the files to be processed
 	  out_prefix - the output prefix of the distortion maps, normalized
 	                 flat, and slit descriptors
+	  cache      - optional CalibrationCache; if the products of the same
+	                 flats (and code) are in the cache they are used
+	                 instead of being recomputed
 
 	Output:
 	  pickled description of the slits, star boxes, and distortion
@@ -32,12 +38,23 @@ def flatpipe(flatfiles,out_prefix):
 	from lris.lris_biastrim import redside as biastrim
 	from special_functions import lsqfit,genfunc
 	from scipy import ndimage,stats
+	import special_functions
+	from lris import lris_biastrim
+
+	if cache is not None:
+		code = [sys.modules[__name__],lris_biastrim,ycorrect,id_slits,spectools,special_functions]
+		key = cache.key(flatfiles,CONFIG_KEYWORDS,code)
+		products = cache.get('redflat',key)
+		if products is not None:
+			print "Using cached flat products"
+			flatsave(out_prefix,**products)
+			return products['yforw'],products['yback'],products['slits'],products['starboxes'],products['flatnorm']
 
 	# Read data from files, biastrim and coadd
 	weight = 0
 	for name in flatfiles:
 		flattmp = pyfits.open(name)
-		flatdata = biastrim(flattmp[0].data.astype(scipy.float32))
+		flatdata = biastrim(flattmp[0].data,flattmp[0].header)
 		exptime = flattmp[0].header['elaptime']
 
 		if weight==0:
@@ -100,15 +117,33 @@ def flatpipe(flatfiles,out_prefix):
 	flatnorm = spectools.resampley(flatmodel,yback,cval=1.)
 	del flatmodel
 
+	products = {'flatnorm':flatnorm.astype(scipy.float32),
+		'yforw':yforw.astype(scipy.float32),
+		'yback':yback.astype(scipy.float32),'slits':slits,
+		'starboxes':starboxes,'ytrue':ytrue,'ymap':ymap}
+	if cache is not None:
+		cache.put('redflat',key,products)
+	flatsave(out_prefix,**products)
+
+	return products['yforw'],products['yback'],slits,starboxes,products['flatnorm']
+
+
+def _writefits(data,filename):
+	if os.path.exists(filename):
+		os.remove(filename)
+	pyfits.PrimaryHDU(data).writeto(filename)
+
+
+def flatsave(out_prefix,flatnorm,yforw,yback,slits,starboxes,ytrue,ymap):
+	"""
+	Writes the outputs of flatpipe(), replacing existing files.
+	"""
 	# Output normalized flat
-	flatname = out_prefix+"_flat.fits"
-	pyfits.PrimaryHDU(flatnorm.astype(scipy.float32)).writeto(flatname)
+	_writefits(flatnorm,out_prefix+"_flat.fits")
 
 	# Output coefficient/slit definition arrays
-	outname = out_prefix+"_yforw.fits"
-	pyfits.PrimaryHDU(yforw.astype(scipy.float32)).writeto(outname)
-	outname = out_prefix+"_yback.fits"
-	pyfits.PrimaryHDU(yback.astype(scipy.float32)).writeto(outname)
+	_writefits(yforw,out_prefix+"_yforw.fits")
+	_writefits(yback,out_prefix+"_yback.fits")
 	outname = out_prefix+"_ygeom.dat"
 	outfile = open(outname,"w")
 	pickle.dump(slits,outfile)
@@ -117,8 +152,6 @@ def flatpipe(flatfiles,out_prefix):
 	pickle.dump(ymap,outfile)
 	outfile.close()
 
-	return yforw.astype(scipy.float32),yback.astype(scipy.float32),slits,starboxes,flatnorm.astype(scipy.float32)
-
 
 
 def flatload(out_prefix):
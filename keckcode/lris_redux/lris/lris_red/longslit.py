@@ -4,6 +4,7 @@ This code doesn't work (yet).
 
 import lris
 from lris.lris_biastrim import redside as biastrim
+from lris.lris_biastrim import trim_frames
 
 import lris_red
 from lris_red.flat import *
@@ -36,7 +37,7 @@ from astropy.io import fits as pyfits
 #   cache	- 1 to cache data to disk (useful for blueside with RAM<2GB)
 #   offsets     - a list/array of relative offsets between masks (in pixels)
 
-def lris_pipeline(prefix,dir,science,arc,flats,out_prefix,useflat=0,usearc=0,cache=0,offsets=None):
+def lris_pipeline(prefix,dir,science,arc,flats,out_prefix,useflat=0,usearc=0,cache=0,offsets=None,nproc=1):
 	print "Processing mask",out_prefix
 
 	scinums = science.split(",")
@@ -71,10 +72,9 @@ def lris_pipeline(prefix,dir,science,arc,flats,out_prefix,useflat=0,usearc=0,cac
 	else:
 		arcname = dir + prefix + arc + ".fits"
 		arc_tmp = pyfits.open(arcname)
-		arcdata = arc_tmp[0].data.copy()
+		arcdata = biastrim(arc_tmp[0].data,arc_tmp[0].header)
 		lamps = arc_tmp[0].header['LAMPS']
 		del arc_tmp
-		arcdata = biastrim(arcdata)
 		arc_ycor = spectools.resampley(arcdata,yforw).astype(scipy.float32)
 		arcname = out_prefix+"_arc.fits"
 		arc_hdu = pyfits.PrimaryHDU(arc_ycor)
@@ -98,20 +98,14 @@ def lris_pipeline(prefix,dir,science,arc,flats,out_prefix,useflat=0,usearc=0,cac
 	center = scipy.zeros((nsci,len(starboxes)),'f4')
 	flux = scipy.zeros((nsci),'f4')
 	airmass = []
+	# Bias trim and remove screwed columns/saturated pixels
+	trimmed = trim_frames(scinames,'red',nproc)
 	for i in range(nsci):
 		filename = scinames[i]
 		scitmp = pyfits.open(filename)
 
-		scidatatmp = scitmp[0].data.copy()
-		scidatatmp = biastrim(scidatatmp).astype(scipy.float32)
-
-		#Remove screwed columns (this should already be done though...)
-		bad = scipy.where(scidatatmp>56000.)
-		nbad = bad[0].size
-		for k in range(nbad):
-			y = bad[0][k]
-			x = bad[1][k]
-			scidatatmp[y,x] = (scidatatmp[y,x-1]+scidatatmp[y,x+1])/2.
+		scidatatmp = trimmed[i]
+		trimmed[i] = None
 		# Don't flatfield blueside data
 		scidatatmp = scidatatmp/flatnorm
 		scidata[i,:,:] = scidatatmp.copy()
@@ -11,23 +11,31 @@ Pipeline to reduce LRIS redside spectra.
    usearc      - 1 to use arc data from a previous run, otherwise 0
    cache       - 1 to cache data to disk (useful for blueside with RAM<2GB)
    offsets     - a list/array of relative offsets between masks (in pixels); this will be unnecessary if the stars remained in the starboxes for all masks.
+   nproc       - number of processes used to bias trim the science frames
+                 and to reduce the slits
+   usecache    - 1 to reuse flat/distortion and arc products from the
+                 calibration cache (out_prefix directory/calib_cache) if
+                 they were made from the same raw frames and code
 
 """
 
 
 import lris
 from lris.lris_biastrim import redside as biastrim
+from lris.lris_biastrim import trim_frames
 
 from lris.lris_red.flat import *
 from lris.lris_red.skymatch import skymatch as wavematch
 from lris.lris_red.skysub import doskysub
 
 from mostools import spectools,offset,measure_width
+from mostools.slitpool import map_slits
+from mostools.calcache import CalibrationCache,array_hash
 from mostools.extract import extract
 import special_functions
 
 from math import ceil,fabs
-import pickle
+import pickle,os
 
 import numpy as np
 import scipy
@@ -36,18 +44,37 @@ from scipy import io as sio
 from astropy.io import fits as pyfits
 
 
+"""
+Determine the wavelength solution of slit k, then resample and background
+  subtract it; s holds the (read-only) data shared by all of the slits.
+"""
+def reduce_slit(k,s):
+	i,j = s['slits'][k]
+	a,b = s['wide_slits'][k]
+	print "Working on slit %d (%d to %d)" % (k+1,i,j)
+	# Determine the wavelength solution
+	sky2x,sky2y,ccd2wave = wavematch(a,s['scidata'][:,a:b],s['arc_ycor'][i:j],s['yforw'][i:j],s['widemodel'],s['finemodel'],s['goodmodel'],s['scale'],s['mswave'],s['redcutoff'])
+	# Resample and background subtract
+	print 'Doing background subtraction'
+	return doskysub(i,j-i,s['outlength'],s['scidata'][:,a:b],s['yback'][a:b],sky2x,sky2y,ccd2wave,s['scale'],s['mswave'],s['center'],s['redcutoff'],s['airmass'])
+
+
 """ A control routine to encapsulate the pipeline. """
-def lris_pipeline(prefix,dir,scinames,arcname,flatnames,out_prefix,useflat=0,usearc=0,cache=0,offsets=None):
+def lris_pipeline(prefix,dir,scinames,arcname,flatnames,out_prefix,useflat=0,usearc=0,cache=0,offsets=None,nproc=1,usecache=1):
 	print "Processing mask",out_prefix
 
 
 	nsci = len(scinames)
 
+	calib = None
+	if usecache==1:
+		calib = CalibrationCache(os.path.join(os.path.dirname(out_prefix),'calib_cache'))
+
 	print "Preparing flatfields"
 	if useflat==1:
 		yforw,yback,slits,starboxes,flatnorm = flatload(out_prefix)
 	else:
-		yforw,yback,slits,starboxes,flatnorm = flatpipe(flatnames,out_prefix)
+		yforw,yback,slits,starboxes,flatnorm = flatpipe(flatnames,out_prefix,calib)
 	axis1 = flatnorm.shape[0]
 	axis2 = flatnorm.shape[1]
 
@@ -58,20 +85,37 @@ def lris_pipeline(prefix,dir,scinames,arcname,flatnames,out_prefix,useflat=0,use
 	"""
 	print "Preparing arcs for line identification"
 	if usearc==1:
-		arcdata = biastrim(pyfits.open(arcname)[0].data)
+		arc_tmp = pyfits.open(arcname)
+		arcdata = biastrim(arc_tmp[0].data,arc_tmp[0].header)
 		arcname = out_prefix+"_arc.fits"
 		arc_tmp = pyfits.open(arcname)
 		arc_ycor = arc_tmp[0].data.astype(scipy.float32)
 		lamps = arc_tmp[0].header['LAMPS']
 		del arc_tmp
 	else:
-		arc_tmp = pyfits.open(arcname)
-		arcdata = arc_tmp[0].data.copy()
-		lamps = arc_tmp[0].header['LAMPS']
-		del arc_tmp
-		arcdata = biastrim(arcdata)
-		arc_ycor = spectools.resampley(arcdata,yforw).astype(scipy.float32)
+		"""
+		The straightened arc depends on the raw arc and on the
+		  distortion map.
+		"""
+		products = None
+		if calib is not None:
+			code = [lris.lris_biastrim,spectools]
+			arckey = calib.key([arcname],CONFIG_KEYWORDS+['LAMPS'],code,array_hash(yforw))
+			products = calib.get('redarc',arckey)
+		if products is None:
+			arc_tmp = pyfits.open(arcname)
+			arcdata = biastrim(arc_tmp[0].data,arc_tmp[0].header)
+			lamps = arc_tmp[0].header['LAMPS']
+			del arc_tmp
+			arc_ycor = spectools.resampley(arcdata,yforw).astype(scipy.float32)
+			if calib is not None:
+				calib.put('redarc',arckey,{'arc_ycor':arc_ycor,'lamps':lamps})
+		else:
+			print "Using cached arc"
+			arc_ycor,lamps = products['arc_ycor'],products['lamps']
 		arcname = out_prefix+"_arc.fits"
+		if os.path.exists(arcname):
+			os.remove(arcname)
 		arc_hdu = pyfits.PrimaryHDU(arc_ycor)
 		arc_hdu.header.update('LAMPS',lamps)
 		arc_hdu.writeto(arcname)
@@ -99,34 +143,17 @@ def lris_pipeline(prefix,dir,scinames,arcname,flatnames,out_prefix,useflat=0,use
 	center = scipy.zeros((nsci,len(starboxes)),'f4')
 	flux = scipy.zeros((nsci),'f4')
 	airmass = []
+	"""
+	The frames are bias trimmed (in parallel if nproc>1) and saturated
+	  pixels are interpolated over along the rows.
+	"""
+	trimmed = trim_frames(scinames,'red',nproc)
 	for i in range(nsci):
 		filename = scinames[i]
 		scitmp = pyfits.open(filename)
 
-		scidatatmp = scitmp[0].data.copy()
-		scidatatmp = biastrim(scidatatmp).astype(scipy.float32)
-
-		"""
-		The biastrim routine should take care of bad columns, but this
-		  is just in case; we do a simple linear interpolation over
-		  bad columns.
-		"""
-		bad = scipy.where(scidatatmp>56000.)
-		nbad = bad[0].size
-		for k in range(nbad):
-			y = bad[0][k]
-			x = bad[1][k]
-			if x==0:
-				x1 = x+1
-				x2 = x+1
-			elif x == scidatatmp.shape[1]-1:
-				x1 = x-1
-				x2 = x-1
-			else:
-				x1 = x-1
-				x2 = x+1
-			scidatatmp[y,x] = \
-			    (scidatatmp[y,x1]+scidatatmp[y,x2])/2.
+		scidatatmp = trimmed[i]
+		trimmed[i] = None
 
 		"""
 		Apply the flatfield and copy the data into the working array.
@@ -392,7 +419,9 @@ def lris_pipeline(prefix,dir,scinames,arcname,flatnames,out_prefix,useflat=0,use
 	  determine all wavelength solutions, then jointly determine a 'master'
 	  solution.... posc stores the current (starting) position of the
 	  coadded array, and posn stores the current position of the straight
-	  array.
+	  array. The slits are independent, so they are reduced by nproc
+	  processes (see reduce_slit), and the results are stored here in
+	  slit order.
 	"""
 	posc = 0
 	posn = 0
@@ -403,23 +432,13 @@ def lris_pipeline(prefix,dir,scinames,arcname,flatnames,out_prefix,useflat=0,use
 	""" Extract 1d spectra? """
 	do_extract = False
 
-	for k in range(len(slits)):
-		i,j = slits[k]
-		a,b = wide_slits[k]
-
-		""" Debugging feature; change number to skip initial slits """
-		if count<1:
-			count += 1
-			continue
-
-		print "Working on slit %d (%d to %d)" % (count,i,j)
-		# Determine the wavelength solution
-		sky2x,sky2y,ccd2wave = wavematch(a,scidata[:,a:b],arc_ycor[i:j],yforw[i:j],widemodel,finemodel,goodmodel,scale,mswave,redcutoff)
-		# Resample and background subtract
-		print 'Doing background subtraction'
-		#scidata[0,a:b] = arcdata[a:b] # This line may be a debugging step that MWA put in.  See what happens with it missing.
-		strt,bgsub,varimg = doskysub(i,j-i,outlength,scidata[:,a:b],yback[a:b],sky2x,sky2y,ccd2wave,scale,mswave,center,redcutoff,airmass)
-
+	shared = {'slits':slits,'wide_slits':wide_slits,'scidata':scidata,
+		'arc_ycor':arc_ycor,'yforw':yforw,'yback':yback,
+		'widemodel':widemodel,'finemodel':finemodel,
+		'goodmodel':goodmodel,'scale':scale,'mswave':mswave,
+		'redcutoff':redcutoff,'outlength':outlength,'center':center,
+		'airmass':airmass}
+	for strt,bgsub,varimg in map_slits(reduce_slit,len(slits),shared,nproc):
 		# Store the resampled 2d spectra
 		h = strt.shape[1]
 		if cache:
@@ -172,37 +172,27 @@ def findlines(x,z,nsigma=5.):
 	threshold = bg+nsigma*(bg**0.5)
 	peaks = scipy.where((tmp==z)&(z>threshold))[0]
 
-	""" Centroid the lines, fixing the bias level of the gaussians """
-	fit = scipy.ones(8)
-	fit[4] = 0.
-	datalines = []
-	for i in peaks:
-		if i-14<0 or i+15>x.size:
-			continue
-		fit[0] = bg[i]
-		fit[1] = z[i]
-		fit[2] = x[i]
-		fit[3] = 1.
+	""" Centroid all of the lines at once """
+	peaks = scipy.asarray([i for i in peaks if i-14>=0 and i+15<=x.size],dtype=int)
+	if peaks.size==0:
+		return scipy.zeros(0)
+	xw,zw = special_functions.linewindows(x,z,peaks,12)
 
-		"""
-		Deal with saturated lines appropriately (ie skipping the
-		  non-linear pixels)
-		"""
-		if z[i]<SATURATED:
-			fitdata = scipy.empty((9,2))
-			fitdata[:,0] = x[i-4:i+5].copy()
-			fitdata[:,1] = z[i-4:i+5].copy()
-		else:
-			fitdata = scipy.empty((25,2))
-			fitdata[:,0] = x[i-12:i+13].copy()
-			fitdata[:,1] = z[i-12:i+13].copy()
-			fitdata = fitdata[fitdata[:,1]<SATURATED*0.8]
-
-		""" A simple weighted sum would probably be robust.... """
-		gfit,chi2 = special_functions.ngaussfit(fitdata,fit)
-		datalines.append(gfit[2])
-
-	return scipy.asarray(datalines)
+	"""
+	Deal with saturated lines appropriately (ie skipping the
+	  non-linear pixels); other lines are fit within +/-4 pixels.
+	"""
+	saturated = z[peaks]>=SATURATED
+	offset = abs(scipy.arange(-12,13))
+	weight = scipy.where(saturated[:,None],zw<SATURATED*0.8,offset<=4)
+
+	start = scipy.empty((peaks.size,4))
+	start[:,0] = bg[peaks]
+	start[:,1] = z[peaks]
+	start[:,2] = x[peaks]
+	start[:,3] = 1.
+	fit,ok = special_functions.gaussfit_lines(xw,zw,start,weight)
+	return fit[:,2]
 
 
 
@@ -3,7 +3,7 @@ Background subtract, resample, and coadd 2d spectra.
 """
 
 from mostools import spectools,correct_telluric,skysub
-from special_functions import genfunc
+from special_functions import genfunc,gridfunc
 
 import scipy
 from scipy import optimize,interpolate,ndimage,signal,stats
@@ -52,15 +52,14 @@ def doskysub(straight,ylen,xlen,sci,yback,sky2x,sky2y,ccd2wave,disp,mswave,offse
 	width = sci.shape[2]
 
 	# Perform telluric correction
-	coords = spectools.array_coords(sci[0].shape)
-	x = coords[1].flatten()
-	y = coords[0].flatten()
+	x = scipy.arange(sci[0].shape[1],dtype='f8')
+	y = scipy.arange(sci[0].shape[0],dtype='f8')
 
 	for k in range(nsci):
-		w = genfunc(x,y,ccd2wave[k])
+		w = gridfunc(x,y,ccd2wave[k]).ravel()
 		telluric = correct_telluric.correct(w,airmass[k],disp)
 		sci[k] *= telluric.reshape(sci[k].shape)
-	del coords,x,y,telluric
+	del x,y,telluric
 
 	# Create arrays for output images
 	outcoords = spectools.array_coords((ylen,xlen))
@@ -68,6 +67,8 @@ def doskysub(straight,ylen,xlen,sci,yback,sky2x,sky2y,ccd2wave,disp,mswave,offse
 	outcoords[1] += mswave - disp*xlen/2.
 	xout = outcoords[1].flatten()
 	yout = outcoords[0].flatten()
+	outx = outcoords[1][0]
+	outy = outcoords[0][:,0]
 
 	out = scipy.zeros((nsci,ylen,xlen))
 
@@ -108,8 +109,8 @@ def doskysub(straight,ylen,xlen,sci,yback,sky2x,sky2y,ccd2wave,disp,mswave,offse
 		# If only resampling...
 		if RESAMPLE==1:
 			coords = outcoords.copy()
-			samp_x = genfunc(xout,yout,sky2x[k])
-			samp_y = genfunc(xout,yout,sky2y[k])
+			samp_x = gridfunc(outx,outy,sky2x[k])
+			samp_y = gridfunc(outx,outy,sky2y[k])
 			coords[0] = samp_y.reshape(coords[0].shape)
 			coords[1] = samp_x.reshape(coords[1].shape)
 			out[k] = scipy.ndimage.map_coordinates(sci[k],coords,output=scipy.float64,order=5,cval=-32768,prefilter=False)
@@ -122,13 +123,9 @@ def doskysub(straight,ylen,xlen,sci,yback,sky2x,sky2y,ccd2wave,disp,mswave,offse
 		bgfit = skysub.skysub(x,y,z,disp)
 
 		background = zfit.copy()
-		for indx in range(background.size):
-			x0 = xfit[indx]
-			y0 = yfit[indx]
-			if x0<locutoff-10 or x0>hicutoff+10:
-				background[indx] = scipy.nan
-			else:
-				background[indx] = interpolate.bisplev(x0,y0,bgfit)
+		bgcond = (xfit>=locutoff-10)&(xfit<=hicutoff+10)
+		background[bgcond] = skysub.bgeval(xfit[bgcond],yfit[bgcond],bgfit)
+		background[~bgcond] = scipy.nan
 		sub = zfit-background
 		sub[scipy.isnan(sub)] = 0.
 		sky = sub*0.
@@ -149,8 +146,8 @@ def doskysub(straight,ylen,xlen,sci,yback,sky2x,sky2y,ccd2wave,disp,mswave,offse
 
 		# Create straightened slit
 		coords = outcoords.copy()
-		samp_x = genfunc(xout,yout,sky2x[k])
-		samp_y = genfunc(xout,yout,sky2y[k])
+		samp_x = gridfunc(outx,outy,sky2x[k])
+		samp_y = gridfunc(outx,outy,sky2y[k])
 		coords[0] = samp_y.reshape(coords[0].shape)
 		coords[1] = samp_x.reshape(coords[1].shape)
 		out[k] = scipy.ndimage.map_coordinates(sci[k],coords,output=scipy.float64,order=5,cval=magicnum,prefilter=False)
@@ -160,10 +157,10 @@ def doskysub(straight,ylen,xlen,sci,yback,sky2x,sky2y,ccd2wave,disp,mswave,offse
 
 		# Output bgsub image
 		coords = bgcoords.copy()
-		bgy = bgcoords[0].flatten()+offsets[k]
-		bgx = bgcoords[1].flatten()
-		samp_x = genfunc(bgx,bgy,sky2x[k])
-		samp_y = genfunc(bgx,bgy,sky2y[k])
+		bgy = bgcoords[0][:,0]+offsets[k]
+		bgx = bgcoords[1][0]
+		samp_x = gridfunc(bgx,bgy,sky2x[k])
+		samp_y = gridfunc(bgx,bgy,sky2y[k])
 		coords[0] = samp_y.reshape(coords[0].shape)
 		coords[1] = samp_x.reshape(coords[1].shape)
 
@@ -3,5 +3,5 @@ A set of scripts to help reduce, analyze, and manipulate data from multi-
   object spectrographs.
 """
 
-import correct_telluric,extract,id_slits,measure_width,offset,skysub
-import spectools,spextract,velocity,ycorrect
+import calcache,correct_telluric,extract,id_slits,measure_width,offset,skysub
+import slitpool,spectools,spextract,velocity,ycorrect
@@ -0,0 +1,168 @@
+"""
+A content-addressed cache for calibration products.
+
+Products (eg distortion maps, slit definitions, normalized flats, or
+  straightened arcs) are stored in .npz files named by a hash of everything
+  they were made from: the contents of the input frames, the instrument
+  configuration in their headers, the source code of the modules that made
+  them, and any extra parameters. Products are therefore reused whenever
+  (and only when) all of these match, independent of the output prefix.
+"""
+
+import os,hashlib,pickle
+import numpy
+from astropy.io import fits as pyfits
+
+# Hashes of files that have already been read, keyed by name/size/mtime
+_file_hashes = {}
+
+
+def file_hash(filename):
+	"""
+	Returns the sha1 hash of the contents of filename.
+	"""
+	st = os.stat(filename)
+	tag = (os.path.abspath(filename),st.st_size,st.st_mtime)
+	if tag not in _file_hashes:
+		h = hashlib.sha1()
+		f = open(filename,'rb')
+		block = f.read(1<<20)
+		while len(block)>0:
+			h.update(block)
+			block = f.read(1<<20)
+		f.close()
+		_file_hashes[tag] = h.hexdigest()
+	return _file_hashes[tag]
+
+
+def array_hash(*arrays):
+	"""
+	Returns the sha1 hash of the contents (and shapes and types) of arrays,
+	  eg to key products that depend on other calibration products.
+	"""
+	h = hashlib.sha1()
+	for arr in arrays:
+		arr = numpy.ascontiguousarray(arr)
+		h.update(repr((arr.shape,arr.dtype.str)).encode())
+		h.update(arr.tobytes())
+	return h.hexdigest()
+
+
+def code_version(*modules):
+	"""
+	Returns a hash of the source code of the given modules.
+	"""
+	h = hashlib.sha1()
+	for module in modules:
+		name = getattr(module,'__file__',None)
+		if name is not None and name[-4:] in ['.pyc','.pyo']:
+			name = name[:-1]
+		try:
+			f = open(name,'rb')
+			h.update(f.read())
+			f.close()
+		except:
+			h.update(repr(getattr(module,'__name__',module)).encode())
+	return h.hexdigest()
+
+
+def header_config(filename,keywords,ext=0):
+	"""
+	Returns a list of (keyword,value) pairs from the header of filename;
+	  missing keywords have empty values.
+	"""
+	header = pyfits.getheader(filename,ext)
+	config = []
+	for key in keywords:
+		try:
+			config.append((key,str(header[key]).strip()))
+		except KeyError:
+			config.append((key,''))
+	return config
+
+
+def _isarray(value):
+	return isinstance(value,numpy.ndarray) and value.dtype!=object
+
+
+class CalibrationCache(object):
+	"""
+	CalibrationCache(directory)
+
+	Stores and retrieves calibration products in directory. A product is a
+	  dictionary of arrays, dictionaries of arrays (eg for the two LRIS
+	  blueside detectors), and (picklable) python objects, and is looked
+	  up by name and by a key from CalibrationCache.key().
+	"""
+	def __init__(self,directory):
+		self.directory = directory
+
+	def key(self,files,keywords=[],code=[],extra=None):
+		"""
+		key(files,keywords=[],code=[],extra=None)
+
+		Returns the key for products made from the input files (using
+		  their contents and the header keywords), the modules in code,
+		  and the extra parameters (which must have a stable repr).
+		"""
+		h = hashlib.sha1()
+		for name in files:
+			h.update(file_hash(name).encode())
+			if len(keywords)>0:
+				h.update(repr(header_config(name,keywords)).encode())
+		h.update(code_version(*code).encode())
+		h.update(repr(extra).encode())
+		return h.hexdigest()
+
+	def filename(self,name,key):
+		return os.path.join(self.directory,'%s_%s.npz' % (name,key))
+
+	def get(self,name,key):
+		"""
+		Returns the cached product (a dictionary), or None if there is no
+		  product for this key.
+		"""
+		filename = self.filename(name,key)
+		if not os.path.exists(filename):
+			return None
+		try:
+			saved = numpy.load(filename)
+			products = {}
+			for item in saved.files:
+				if item=='__objects__':
+					products.update(pickle.loads(saved[item].tobytes()))
+				elif '/' in item:
+					base,sub = item.split('/',1)
+					products.setdefault(base,{})[sub] = saved[item]
+				else:
+					products[item] = saved[item]
+			saved.close()
+		except Exception:
+			return None
+		return products
+
+	def put(self,name,key,products):
+		"""
+		Stores a product. Arrays (and dictionaries of arrays) are saved
+		  directly and everything else is pickled; the file is written
+		  under a temporary name and then renamed, so an interrupted write
+		  is never used.
+		"""
+		arrays = {}
+		objects = {}
+		for item,value in products.items():
+			if _isarray(value):
+				arrays[item] = value
+			elif isinstance(value,dict) and len(value)>0 and \
+			    all([_isarray(v) for v in value.values()]):
+				for sub in value:
+					arrays['%s/%s' % (item,sub)] = value[sub]
+			else:
+				objects[item] = value
+		arrays['__objects__'] = numpy.frombuffer(pickle.dumps(objects,2),numpy.uint8)
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+		filename = self.filename(name,key)
+		tmpname = filename[:-4]+'.%d.tmp.npz' % os.getpid()
+		numpy.savez(tmpname,**arrays)
+		os.rename(tmpname,filename)
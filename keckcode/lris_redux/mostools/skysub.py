@@ -125,3 +125,100 @@ def skysub(x,y,z,scale):
 	bgfit = interpolate.bisplrep(x,y,z,w,tx=tx,ty=ty,kx=kx,ky=ky,task=-1,nxest=tx.size,nyest=ty.size,s=0)
 
 	return bgfit
+
+
+def _bspline_basis(t,k,x):
+	"""
+	Evaluates the k+1 non-zero B-spline basis functions (with knots t) at
+	  each position in x, following FITPACK's fpbspl. Points outside of the
+	  interior knots are clamped to the edges, as in bisplev. Returns the
+	  index of the first non-zero basis function for each point and an
+	  (npoints,k+1) array of basis values.
+	"""
+	x = scipy.clip(x,t[k],t[t.size-k-1])
+	l = scipy.searchsorted(t,x,side='right')-1
+	l = scipy.clip(l,k,t.size-k-2)
+	h = scipy.zeros((x.size,k+1))
+	h[:,0] = 1.
+	for j in range(1,k+1):
+		hh = h[:,:j].copy()
+		h[:,0] = 0.
+		for i in range(1,j+1):
+			tli = t[l+i]
+			tlj = t[l+i-j]
+			denom = tli-tlj
+			f = scipy.where(denom!=0.,hh[:,i-1]/scipy.where(denom!=0.,denom,1.),0.)
+			h[:,i-1] += f*(tli-x)
+			h[:,i] = f*(x-tlj)
+	return l-k,h
+
+
+def bgeval(x,y,bgfit,chunk=100000):
+	"""
+	bgeval(x,y,bgfit,chunk=100000)
+
+	Evaluates the spline background model returned by skysub() at each of
+	  the (x,y) positions. This gives the same result as calling
+	  interpolate.bisplev(x[i],y[i],bgfit) for every point, but evaluates
+	  the tensor-product spline for all of the points at once.
+
+	Inputs:
+	  x     - 1d array of x-coordinates, usually wavelength
+	  y     - 1d array of y-coordinates, usually corrected spatial position
+	  bgfit - spline model (tx,ty,c,kx,ky) from skysub()
+	  chunk - number of points to evaluate at a time (limits memory use)
+
+	Outputs:
+	  1d array of the background at each (x,y)
+	"""
+	tx,ty,c,kx,ky = bgfit
+	tx = scipy.asarray(tx,dtype=scipy.float64)
+	ty = scipy.asarray(ty,dtype=scipy.float64)
+	x = scipy.asarray(x,dtype=scipy.float64).ravel()
+	y = scipy.asarray(y,dtype=scipy.float64).ravel()
+	nky = ty.size-ky-1
+	c = scipy.asarray(c)[:(tx.size-kx-1)*nky]
+
+	out = scipy.empty(x.size)
+	for start in range(0,x.size,chunk):
+		end = min(start+chunk,x.size)
+		ix,wx = _bspline_basis(tx,kx,x[start:end])
+		iy,wy = _bspline_basis(ty,ky,y[start:end])
+		val = scipy.zeros(end-start)
+		for i in range(kx+1):
+			row = (ix+i)*nky+iy
+			tmp = scipy.zeros(end-start)
+			for j in range(ky+1):
+				tmp += c[row+j]*wy[:,j]
+			val += wx[:,i]*tmp
+		out[start:end] = val
+	return out
+
+
+def benchmark(nx=4096,ny=40,scale=1.2):
+	"""
+	Times bgeval() against per-pixel bisplev() calls for a synthetic slit
+	  of ny rows and nx columns.
+	"""
+	import time
+	yy,xx = scipy.mgrid[0:ny,0:nx].astype(scipy.float64)
+	x = (5000.+scale*xx+0.3*yy).ravel()
+	y = yy.ravel()
+	z = (100.+20.*scipy.sin(x/37.)+0.5*y)
+	z += scipy.random.normal(0.,1.,z.size)
+	bgfit = skysub(x,y,z,scale)
+
+	start = time.time()
+	loop = scipy.empty(x.size)
+	for indx in range(x.size):
+		loop[indx] = interpolate.bisplev(x[indx],y[indx],bgfit)
+	tloop = time.time()-start
+	start = time.time()
+	vec = bgeval(x,y,bgfit)
+	tvec = time.time()-start
+	print("bisplev loop: %6.2fs  bgeval: %6.3fs  max difference: %g" %
+		(tloop,tvec,abs(loop-vec).max()))
+
+
+if __name__=='__main__':
+	benchmark()
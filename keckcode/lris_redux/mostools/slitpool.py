@@ -0,0 +1,66 @@
+"""
+Distribute independent per-slit work over a pool of processes.
+
+Once the flat, distortion maps, and science stack are known, each slit of a
+  mask is reduced independently. map_slits() calls a per-slit function for
+  every slit and returns the results in slit order, so the output of a
+  parallel reduction is identical to a serial one. The (read-only) shared
+  data are made available to the workers by forking the parent process, so
+  large arrays like the science stack are not pickled or copied. Anything
+  the workers print is collected and printed by the parent in slit order.
+"""
+
+import sys
+from multiprocessing import Pool
+try:
+	from StringIO import StringIO
+except ImportError:
+	from io import StringIO
+
+_shared = {}
+
+
+def _run(k):
+	stdout = sys.stdout
+	sys.stdout = StringIO()
+	try:
+		result = _shared['func'](k,_shared['data'])
+		text = sys.stdout.getvalue()
+	finally:
+		sys.stdout = stdout
+	return result,text
+
+
+def map_slits(func,nslits,shared,nproc=1):
+	"""
+	map_slits(func,nslits,shared,nproc=1)
+
+	Calls func(k,shared) for each slit k in range(nslits), and yields the
+	  results in slit order.
+
+	Inputs:
+	  func   - per-slit function; it should not modify shared
+	  nslits - number of slits
+	  shared - dictionary of data needed by func
+	  nproc  - number of processes
+
+	Outputs:
+	  generator of the results of func for each slit
+	"""
+	global _shared
+	if nproc<2 or nslits<2:
+		for k in range(nslits):
+			yield func(k,shared)
+		return
+
+	# The workers are forked after _shared is set, so they inherit it
+	_shared = {'func':func,'data':shared}
+	pool = Pool(min(nproc,nslits))
+	try:
+		for result,text in pool.imap(_run,range(nslits)):
+			sys.stdout.write(text)
+			yield result
+	finally:
+		pool.close()
+		pool.join()
+		_shared = {}
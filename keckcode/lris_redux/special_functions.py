@@ -1,15 +1,23 @@
-import scipy
+import scipy,numpy,hashlib
 from scipy import optimize
 
 #
 # Basic (polynomial) fitting routine frontends
 #
-def lsqfit(input,fittype,xorder,yorder=0):
+def lsqfit(input,fittype,xorder,yorder=0,weight=None,nsig=None,niter=10):
 	p = scipy.ones((xorder+1,yorder+1))
 	par = {'coeff':p,'type':fittype}
-	return lsqfitter(input,par)
+	return lsqfitter(input,par,weight,nsig,niter)
 
-def lsqfitter(input,par):
+#
+# The models are linear in their coefficients, so the fit is a direct
+#   linear least-squares solution of the design matrix. The input par is
+#   only used for the order and type of the fit (it used to be the starting
+#   guess for an optimize.leastsq fit). Points can be weighted, and if nsig
+#   is set points more than nsig standard deviations from the fit are
+#   iteratively rejected (for at most niter iterations).
+#
+def lsqfitter(input,par,weight=None,nsig=None,niter=10):
 	par = par.copy()
 	p = par['coeff']
 	# If only one array is input, assume they are z-values
@@ -34,6 +42,10 @@ def lsqfitter(input,par):
 		z = input[:,2]
 
 	good = scipy.isfinite(z)
+	if weight is not None:
+		weight = numpy.asarray(weight,dtype=numpy.float64)
+		good &= scipy.isfinite(weight)
+		weight = weight[good]
 	x = x[good]
 	z = z[good]
 
@@ -42,12 +54,117 @@ def lsqfitter(input,par):
 	except:
 		pass
 
-	coeffs = unpack_coeff(par)
-
-	fit,ier = optimize.leastsq(dolsqfit,coeffs,args=(x,y,z,par),maxfev=6000)
+	A = design_matrix(x,y,xorder,yorder,par['type'])
+	fit = clipfit(A,z,weight,nsig,niter)
 
 	return build_coeff(fit,par)
 
+
+# The design matrix for a fit, with the columns in unpack_coeff() order
+def design_matrix(x,y,xorder,yorder,type):
+	x = scipy.atleast_1d(x)
+	y = scipy.atleast_1d(y)
+	p_x = basis(x,xorder+1,type)
+	p_y = basis(y,yorder+1,type)
+	order = min(xorder,yorder)
+	cols = []
+	for i in range(yorder+1):
+		for j in range(xorder+1):
+			if i+j>order and i>0 and j>0:
+				break
+			cols.append(p_x[j]*p_y[i])
+	A = numpy.empty((max(x.size,y.size),len(cols)))
+	for k in range(len(cols)):
+		A[:,k] = cols[k]
+	return A
+
+
+# Weighted linear least-squares solution of A.coeffs = z; z can be 2d, in
+#   which case each column is solved for independently. The columns of A
+#   are normalised first, as the (unscaled) basis functions can differ by
+#   many orders of magnitude.
+def linfit(A,z,weight=None):
+	if weight is not None:
+		w = numpy.sqrt(weight)
+		A = A*w[:,None]
+		z = (z.T*w).T
+	norm = numpy.sqrt((A**2).sum(0))
+	norm[norm==0] = 1.
+	coeffs = numpy.linalg.lstsq(A/norm,z,rcond=-1)[0]
+	return (coeffs.T/norm).T
+
+
+# Fit with iterative sigma-clipping of the residuals
+def clipfit(A,z,weight=None,nsig=None,niter=10):
+	keep = numpy.ones(z.size,dtype=bool)
+	for iter in range(max(niter,1)):
+		if weight is None:
+			fit = linfit(A[keep],z[keep])
+		else:
+			fit = linfit(A[keep],z[keep],weight[keep])
+		if nsig is None:
+			break
+		resid = z-numpy.dot(A,fit)
+		newkeep = abs(resid)<nsig*resid[keep].std()
+		if (newkeep==keep).all() or newkeep.sum()<A.shape[1]:
+			break
+		keep = newkeep
+	return fit
+
+
+def batchfit(x,y,z,fittype,xorder,yorder=0,weight=None,nsig=None,niter=10):
+	"""
+	batchfit(x,y,z,fittype,xorder,yorder=0,weight=None,nsig=None,niter=10)
+
+	Fits many independent datasets that share the same (x,y) positions,
+	  building the design matrix only once. Equivalent to calling lsqfit
+	  on each dataset. If there are no NaNs, weights, or clipping, all of
+	  the datasets are solved for in a single least-squares call.
+
+	Inputs:
+	  x       - 1d array of x-coordinates
+	  y       - 1d array of y-coordinates (or 0 for 1d fits)
+	  z       - (npoints,nsets) array of data; NaNs are ignored
+	  fittype - 'polynomial', 'chebyshev', 'legendre' or 'hermite'
+	  xorder  - order of the fit in x
+	  yorder  - order of the fit in y
+	  weight  - optional weights, either 1d (shared) or the shape of z
+	  nsig    - clipping threshold (None for no clipping)
+	  niter   - maximum number of clipping iterations
+
+	Outputs:
+	  list of {'coeff','type'} fits, one for each dataset (None if a
+	    dataset has too few points to fit)
+	"""
+	par = {'coeff':scipy.ones((xorder+1,yorder+1)),'type':fittype}
+	z = numpy.asarray(z,dtype=numpy.float64)
+	if z.ndim==1:
+		z = z[:,None]
+	A = design_matrix(x,y,xorder,yorder,fittype)
+	if weight is not None:
+		weight = numpy.asarray(weight,dtype=numpy.float64)
+		if weight.ndim==1:
+			weight = numpy.tile(weight[:,None],(1,z.shape[1]))
+
+	if weight is None and nsig is None and scipy.isfinite(z).all():
+		fits = linfit(A,z)
+		return [build_coeff(fits[:,k],par) for k in range(z.shape[1])]
+
+	out = []
+	for k in range(z.shape[1]):
+		good = scipy.isfinite(z[:,k])
+		if weight is not None:
+			good &= scipy.isfinite(weight[:,k])
+		if good.sum()<A.shape[1]:
+			out.append(None)
+			continue
+		w = None
+		if weight is not None:
+			w = weight[good,k]
+		fit = clipfit(A[good],z[good,k],w,nsig,niter)
+		out.append(build_coeff(fit,par))
+	return out
+
 # Convert from leastsq par array to coeffs array
 def build_coeff(p,par):
 	xorder = par['coeff'].shape[0]-1
@@ -97,101 +214,142 @@ def dolsqfit(coeffs,x,y,z,par):
 	return z - genfunc(x,y,p)
 
 
+# Recurrence coefficients for the basis functions: the i-th function is
+#   a*x*f[i-1] - c*f[i-2] (with f[0] = 1 and f[1] = x)
+def recurrence(type,i):
+	if type=="legendre":
+		return (2.*i-1.)/i,1./i
+	elif type=="hermite":
+		return 2.,2.*i-2.
+	elif type=="chebyshev":
+		return 2.,1.
+	return 1.,0.
+
+
+# The (norder,npoints) matrix of basis functions evaluated at v
+def basis(v,norder,type):
+	v = numpy.asarray(v,dtype=numpy.float64)
+	out = numpy.empty((norder,v.size))
+	out[0] = 1.
+	if norder>1:
+		out[1] = v
+	for i in range(2,norder):
+		a,c = recurrence(type,i)
+		out[i] = a*v*out[i-1]-c*out[i-2]
+	return out
+
+
+# Coefficient array with the cross-terms that genfunc skips set to zero
+def mask_coeff(p):
+	p = scipy.atleast_2d(p).astype(numpy.float64)
+	order = min(p.shape)-1
+	j,i = numpy.indices(p.shape)
+	p[(i+j>order)&(i>0)&(j>0)] = 0.
+	return p
+
+
+# Basis matrices for regular grids (eg the axes of array_coords(shape)) are
+#   cached, keyed on the grid values, so that repeated evaluations on the
+#   same grid only do the final matrix products.
+_basis_cache = {}
+BASIS_CACHE_SIZE = 32
+
+def cached_basis(v,norder,type):
+	v = numpy.ascontiguousarray(v,dtype=numpy.float64)
+	key = (type,norder,v.size,hashlib.md5(v).hexdigest())
+	if key not in _basis_cache:
+		if len(_basis_cache)>=BASIS_CACHE_SIZE:
+			_basis_cache.clear()
+		_basis_cache[key] = basis(v,norder,type)
+	return _basis_cache[key]
+
+
 # Generic curve/surface making routine (returns an array)
-#   This is about 2x faster than using the scipy.special package.
+#   The basis functions for each axis are built for a block of points at a
+#   time and contracted with the coefficient array; blocks of ~16000
+#   points keep the basis matrices in cache and are faster than doing all
+#   points at once.
+NPOINTS = 16384
+
 def genfunc(x,y,par):
-	p = scipy.atleast_2d(par['coeff'])
+	p = mask_coeff(par['coeff'])
 	type = par['type']
 	x = scipy.atleast_1d(x)
 	y = scipy.atleast_1d(y)
 
 	# If fitting a constant x or y to a two-d fit, make the correct array
-	if p.ndim==2:
-		if x.size==1:
-			xtmp = x[0]
-			x = y*0. + xtmp
-		elif y.size==1:
-			ytmp = y[0]
-			y = x*0. + ytmp
+	if x.size==1:
+		xtmp = x[0]
+		x = y*0. + xtmp
+	elif y.size==1:
+		ytmp = y[0]
+		y = x*0. + ytmp
 
 	value = scipy.zeros(x.size)
-
-	# These arrays can end up being huge, so only do NPOINTS points
-	#   at a time. After a lot of time trials, segments of 5000 are about
-	#   the optimal size (a factor of 2 faster than 2000000, for example).
-	NPOINTS = 5000
-	start = 0
-	while start<x.size:
-		end = start+NPOINTS
-		if end>x.size:
-			end = x.size
-		len = end-start
-		xfit = x[start:end]
-		# Ensure we are fitting in both dimensions!
-		if y.size==x.size:
-			yfit = y[start:end]
-		p_x = scipy.zeros((p.shape[0],len))
-		p_y = scipy.zeros((p.shape[1],len))
-		for i in range(p.shape[0]):
-			if i==0:
-				p_x[i] = 1.
-			elif i==1:
-				p_x[i] = xfit
-			else:
-				if type=="legendre":
-					a = (2.*i-1.)/i
-					c = 1./i
-				elif type=="hermite":
-					a = 2.
-					c = 2.*i-2.
-				elif type=="chebyshev":
-					a = 2.
-					c = 1.
-				elif type=="polynomial":
-					a = 1.
-					c = 0.
-				else:
-					a = 1.
-					c = 0.
-				p_x[i] = a*xfit*p_x[i-1]-c*p_x[i-2]
-
-		for i in range(p.shape[1]):
-			if i==0:
-				p_y[i] = 1.
-			elif i==1:
-				p_y[i] = yfit
-			else:
-				if type=="legendre":
-					a = (2.*i-1.)/i
-					c = 1./i
-				elif type=="hermite":
-					a = 2.
-					c = 2.*i-2.
-				elif type=="chebyshev":
-					a = 2.
-					c = 1.
-				elif type=="polynomial":
-					a = 1.
-					c = 0.
-				else:
-					a = 1.
-					c = 0.
-				p_y[i] = a*yfit*p_y[i-1] - c*p_y[i-2]
-
-		if p.shape[1]>p.shape[0]:
-			order = p.shape[0]-1
+	for start in range(0,x.size,NPOINTS):
+		end = min(start+NPOINTS,x.size)
+		p_x = basis(x[start:end],p.shape[0],type)
+		if p.shape[1]==1:
+			value[start:end] = numpy.dot(p[:,0],p_x)
 		else:
-			order = p.shape[1]-1
-		for i in  range(p.shape[1]):
-			for j in range(p.shape[0]):
-				if i+j>order and i>0 and j>0:
-					break
-				value[start:end] += p[j,i]*p_x[j]*p_y[i]
-		start = end
-
+			p_y = basis(y[start:end],p.shape[1],type)
+			value[start:end] = (p_y*numpy.dot(p.T,p_x)).sum(0)
 	return value
 
 
+def gridfunc(x,y,par,dtype=numpy.float64):
+	"""
+	gridfunc(x,y,par,dtype=numpy.float64)
+
+	Evaluates a genfunc model on the regular grid defined by the 1d x and
+	  y axes, ie the same as
+	    genfunc(X.ravel(),Y.ravel(),par).reshape(X.shape)
+	  with Y,X = numpy.meshgrid(y,x,indexing='ij'). Because the model is
+	  separable on a grid, this is just two small matrix products of the
+	  (cached) basis matrices of each axis with the coefficient array.
+
+	Inputs:
+	  x     - 1d array of x-coordinates (output columns)
+	  y     - 1d array of y-coordinates (output rows)
+	  par   - {'coeff','type'} dictionary, eg from lsqfit
+	  dtype - output data type (eg numpy.float32 to halve the memory)
+
+	Outputs:
+	  (y.size,x.size) array of the model
+	"""
+	p = mask_coeff(par['coeff'])
+	type = par['type']
+	p_x = cached_basis(scipy.atleast_1d(x),p.shape[0],type)
+	p_y = cached_basis(scipy.atleast_1d(y),p.shape[1],type)
+	tmp = numpy.dot(p.T,p_x).astype(dtype)
+	return numpy.dot(p_y.T.astype(dtype),tmp)
+
+
+def gridfunc_benchmark(shape=(4096,4096),order=4,type='chebyshev'):
+	"""
+	Times genfunc on flattened array_coords(shape) against gridfunc on the
+	  corresponding axes.
+	"""
+	import time
+	par = {'coeff':numpy.random.random((order+1,order+1)),'type':type}
+	y,x = numpy.indices(shape,dtype=numpy.float64)
+	start = time.time()
+	old = genfunc(x.ravel(),y.ravel(),par).reshape(shape)
+	told = time.time()-start
+	del x,y
+	xaxis = numpy.arange(shape[1],dtype=numpy.float64)
+	yaxis = numpy.arange(shape[0],dtype=numpy.float64)
+	start = time.time()
+	new = gridfunc(xaxis,yaxis,par)
+	tnew = time.time()-start
+	start = time.time()
+	new32 = gridfunc(xaxis,yaxis,par,numpy.float32)
+	tnew32 = time.time()-start
+	diff = abs(new-old).max()/abs(old).max()
+	print "genfunc: %.3fs  gridfunc: %.3fs  (float32 %.3fs)  rel. diff: %g" % \
+		(told,tnew,tnew32,diff)
+
+
 # Fit "n" 1d gaussians!
 def ngaussfit(data,p,weight=0):
 	return nmodelfit(data,p,"gauss",weight)
@@ -249,6 +407,107 @@ def nmodelfit(data,p,model,weight=0):
 			p[i] = scipy.fabs(p[i])
 	return p,chi2
 
+def linewindows(x,z,peaks,width):
+	"""
+	linewindows(x,z,peaks,width)
+
+	Cuts out the (npeaks,2*width+1) windows of x and z centered on each of
+	  the pixel indices in peaks (which must be at least width pixels from
+	  the ends of the arrays).
+	"""
+	idx = scipy.asarray(peaks,dtype=int)[:,None]+scipy.arange(-width,width+1)
+	return x[idx],z[idx]
+
+
+def gaussfit_lines(x,z,p,weight=None,maxiter=100,tol=1e-10):
+	"""
+	gaussfit_lines(x,z,p,weight=None,maxiter=100,tol=1e-10)
+
+	Fits a single gaussian plus a constant background to each row of z at
+	  once, with a Levenberg-Marquardt iteration that is vectorised over
+	  the lines. This replaces calling ngaussfit once per line.
+
+	Inputs:
+	  x       - (nlines,npix) array of positions, eg from linewindows()
+	  z       - (nlines,npix) array of data
+	  p       - (nlines,4) array of starting guesses: background, amplitude,
+	              center, and sigma
+	  weight  - optional (nlines,npix) weights; points with zero weight
+	              (or non-finite data) are not used in the fit
+	  maxiter - maximum number of iterations
+	  tol     - convergence tolerance for the fractional change in chi2
+
+	Outputs:
+	  (nlines,4) array of the best-fit background, amplitude, center, and
+	    sigma, and a boolean array flagging good fits (converged, positive
+	    amplitude, and center within the window)
+	"""
+	x = scipy.asarray(x,dtype=numpy.float64)
+	z = scipy.asarray(z,dtype=numpy.float64)
+	p = scipy.array(p,dtype=numpy.float64)
+	if weight is None:
+		w = scipy.ones(z.shape)
+	else:
+		w = scipy.asarray(weight,dtype=numpy.float64).copy()
+	w[~scipy.isfinite(z)] = 0.
+	z = scipy.where(w>0,z,0.)
+	nlines = z.shape[0]
+	fitted = (w>0).sum(1)>=4
+
+	def model(p,rows):
+		u = (x[rows]-p[:,2,None])/p[:,3,None]
+		g = scipy.exp(-0.5*u*u)
+		return p[:,0,None]+p[:,1,None]*g,g,u
+
+	m,g,u = model(p,slice(None))
+	chi = (w*(z-m)**2).sum(1)
+	lam = scipy.zeros(nlines)+1e-3
+	active = fitted.copy()
+	converged = scipy.zeros(nlines,dtype=bool)
+	eye = numpy.identity(4)
+	for iter in range(maxiter):
+		if not active.any():
+			break
+		a = numpy.where(active)[0]
+		pa = p[a]
+		amp = pa[:,1,None]
+		sig = pa[:,3,None]
+		J = scipy.empty(z[a].shape+(4,))
+		J[:,:,0] = 1.
+		J[:,:,1] = g[a]
+		J[:,:,2] = amp*g[a]*u[a]/sig
+		J[:,:,3] = amp*g[a]*u[a]*u[a]/sig
+		wa = w[a]
+		JTJ = numpy.einsum('nki,nk,nkj->nij',J,wa,J)
+		JTr = numpy.einsum('nki,nk->ni',J,wa*(z[a]-m[a]))
+		diag = JTJ[:,eye>0]
+		lhs = JTJ+(lam[a,None]*diag+1e-12)[:,:,None]*eye
+		try:
+			step = numpy.linalg.solve(lhs,JTr[:,:,None])[:,:,0]
+		except numpy.linalg.LinAlgError:
+			step = scipy.array([numpy.linalg.lstsq(l,r,rcond=-1)[0] for l,r in zip(lhs,JTr)])
+		trial = pa+step
+		mt,gt,ut = model(trial,a)
+		chit = (wa*(z[a]-mt)**2).sum(1)
+		better = scipy.isfinite(chit)&(chit<=chi[a])
+		b = a[better]
+		done = better&((chi[a]-chit)<=tol*chit)
+		p[b] = trial[better]
+		m[b] = mt[better]
+		g[b] = gt[better]
+		u[b] = ut[better]
+		chi[b] = chit[better]
+		lam[a] = scipy.where(better,lam[a]/10.,lam[a]*10.)
+		done |= lam[a]>1e10
+		converged[a[done]] = True
+		active[a[done]] = False
+
+	p[:,3] = abs(p[:,3])
+	ok = fitted&converged&(p[:,1]>0)&scipy.isfinite(p).all(1)
+	ok &= (p[:,2]>=x.min(1))&(p[:,2]<=x.max(1))
+	return p,ok
+
+
 def dogauss(p,x,z,mask,static):
 	par = scipy.zeros(mask.size)
 	j = 0
@@ -12,7 +12,13 @@ import nirspec,crsub
 
 
 def niredux(flats,stars,imgpairs,oname,isstar=False,
-            docrrej=True,userlow=0.,userhigh=0.):
+            docrrej=True,userlow=0.,userhigh=0.,exact=True):
+
+    #
+    # exact=False interpolates the frames directly rather than through a 2x
+    #   upsampled copy; this is faster but changes the output slightly (see
+    #   sampleOversampled)
+    #
 
     #
     # Set detector characteristics. Numbers from NIRSPEC specs web site:  
@@ -69,13 +75,7 @@ def niredux(flats,stars,imgpairs,oname,isstar=False,
         print ""
         print "Making initial flat"
         print "-------------------"
-        nflat = len(flats)
-        flat = numpy.empty((nflat,ny,nx))
-        count = 0
-        for img in flats:
-            flat[count] = nirspecOpen(img,verbose=True)[0].data.copy()
-            count += 1
-        flat = numpy.median(flat,0)
+        flat = medianStack(flats)
 
         #
         # Get good edges
@@ -107,7 +107,7 @@ def niredux(flats,stars,imgpairs,oname,isstar=False,
     # DOES NOT ACCOUNT FOR TILTED WAVELENGTH SOLUTION
     #
     if doflat:
-        flat = getFlatNorm(flat,ysoln,low,high)
+        flat = getFlatNorm(flat,ysoln,low,high,exact)
         flat[flat<=0] = 1.
         pyfits.PrimaryHDU(flat).writeto('flat.fits',clobber=True)
 
@@ -158,7 +158,7 @@ def niredux(flats,stars,imgpairs,oname,isstar=False,
         # Find line-straigtening solution
         #
         print "Finding x-distortion so sky lines can be straightened"
-        sky = getStraight(pimg,ysoln,low,False)
+        sky = getStraight(pimg,ysoln,low,False,exact=exact)
         if wsolution is None:
             xsoln = spf.new_xsoln(sky,xord=3,yord=3,tol=2.)
         else:
@@ -189,9 +189,14 @@ def niredux(flats,stars,imgpairs,oname,isstar=False,
 
         # Resample to output grid
         print "Resampling to output wavelength grid"
-        img = resampleData(img,owgrid,low,high,ysoln,xsoln,rwsoln)
-        pimg = resampleData(pimg,owgrid,low,high,ysoln,xsoln,rwsoln)
-        nimg = resampleData(nimg,owgrid,low,high,ysoln,xsoln,rwsoln)
+        coords = resampleCoords(owgrid,low,high,ysoln,xsoln,rwsoln)
+        img = resampleData(img,owgrid,low,high,ysoln,xsoln,rwsoln,coords,
+                           exact)
+        pimg = resampleData(pimg,owgrid,low,high,ysoln,xsoln,rwsoln,coords,
+                            exact)
+        nimg = resampleData(nimg,owgrid,low,high,ysoln,xsoln,rwsoln,coords,
+                            exact)
+        del coords
 
         # Subtraction isn't perfect, so do one more
         bg = numpy.median(img,0)
@@ -1,3 +1,4 @@
+import os
 import pyfits,numpy
 from scipy import ndimage,signal,interpolate,optimize
 from mostools import spectools as st,specfit as spf
@@ -5,6 +6,7 @@ from mostools import ycorrect
 import indexTricks as iT
 import special_functions as sf
 import nirspec,crsub
+from keckcode.spectra.stack import combine
 from math import cos,sin,pi
 
 
@@ -17,6 +19,21 @@ def nirspecOpen(filename, verbose=False):
     return pyfits.open(filename,ignore_missing_end=True)
 
 
+def _asFloat(data,start,end):
+    return data.astype(numpy.float64)
+
+
+def medianStack(files,rows=256,nproc=1):
+    """
+    Median-combines the frames in files, reading a block of rows of every
+      frame at a time so that the full stack is never held in memory.
+    """
+    for filename in files:
+        print "Reading file %s" % filename
+    return combine(files,'median',rows,transform=_asFloat,nproc=nproc,
+                   ignore_missing_end=True)
+
+
 def ycor(img):
     """
     Follow star traces along the x direction to correct y-distortion
@@ -81,41 +98,101 @@ def clip(arr,nsig=3.5):
         m,s,l = a.mean(),a.std(),a.size
 
 
-y,x = iT.coords((1200,1200))
-c = cos(-84.9*pi/180.)
-s = sin(-84.9*pi/180.)
-X = (x-599.5)*c + (y-599.5)*s + 511.5
-Y = (599.5-x)*s + (y-599.5)*c + 511.5
-rotcoords = numpy.array([Y,X])
-y,x = iT.coords((1024,1024))
-c = cos(84.9*pi/180.)
-s = sin(84.9*pi/180.)
-X = (x-511.5)*c + (y-511.5)*s + 599.5
-Y = (511.5-x)*s + (y-511.5)*c + 599.5
-derotcoords = numpy.array([Y,X])
-y,x = iT.coords((2400,2400))
-c = cos(-84.9*pi/180.)
-s = sin(-84.9*pi/180.)
-X = (x-1199.5)*c + (y-1199.5)*s + 1023.5
-Y = (1199.5-x)*s + (y-1199.5)*c + 1023.5
-rotcoords2 = numpy.array([Y,X])
-y,x = iT.coords((2048,2048))
-c = cos(84.9*pi/180.)
-s = sin(84.9*pi/180.)
-X = (x-1023.5)*c + (y-1023.5)*s + 1199.5
-Y = (1023.5-x)*s + (y-1023.5)*c + 1199.5
-derotcoords2 = numpy.array([Y,X])
+"""
+The slit is rotated by ROTANGLE degrees on the detector; rotate() and
+  derotate() map between the 1024x1024 detector and a 1200x1200 frame in
+  which the slit is horizontal, and rotate2()/derotate2() do the same for
+  the 2x oversampled (2048x2048 and 2400x2400) frames. The rotations are
+  affine, so they are done with ndimage.affine_transform (and the rotated
+  coordinates are computed directly) instead of storing dense coordinate
+  grids; rotation_grid() builds (and memoizes) a grid for code that wants
+  one.
+"""
+ROTANGLE = 84.9
+DETECTOR = (1024,1024)
+ROTATED = (1200,1200)
+DETECTOR2 = (2048,2048)
+ROTATED2 = (2400,2400)
+
+# Directory for memory-mapped copies of the grids made by rotation_grid()
+GRID_CACHE = None
+_grids = {}
+
+
+def rotation(inshape,outshape,angle):
+    """
+    Returns the matrix and offset that map the pixel coordinates (y,x) of
+      the output image (with outshape) onto those of the input image (with
+      inshape) for a rotation by angle degrees about the image centres.
+    """
+    c = cos(angle*pi/180.)
+    s = sin(angle*pi/180.)
+    yc,xc = (outshape[0]-1)/2.,(outshape[1]-1)/2.
+    y0,x0 = (inshape[0]-1)/2.,(inshape[1]-1)/2.
+    matrix = numpy.array([[c,-s],[s,c]])
+    offset = numpy.array([y0-c*yc+s*xc,x0-s*yc-c*xc])
+    return matrix,offset
+
+
+def rotated_coords(y,x,inshape,outshape,angle):
+    """
+    Returns the input coordinates (Y,X) of the output coordinates (y,x)
+      (see rotation()).
+    """
+    matrix,offset = rotation(inshape,outshape,angle)
+    Y = matrix[0,0]*y + matrix[0,1]*x + offset[0]
+    X = matrix[1,0]*y + matrix[1,1]*x + offset[1]
+    return Y,X
+
+
+def rotation_grid(inshape,outshape,angle,cache=None):
+    """
+    Returns the (2,outshape) array of input coordinates (Y,X) for each
+      pixel of the rotated image. Grids are made when first asked for and
+      kept; if cache (or GRID_CACHE) is a directory, the grid is stored
+      there and memory-mapped by later calls (and sessions).
+    """
+    key = (tuple(inshape),tuple(outshape),angle)
+    if key in _grids:
+        return _grids[key]
+    if cache is None:
+        cache = GRID_CACHE
+    filename = None
+    if cache is not None:
+        filename = os.path.join(cache,'rotgrid_%dx%d_%dx%d_%g.npy' %
+                                (inshape+outshape+(angle,)))
+        if os.path.exists(filename):
+            _grids[key] = numpy.load(filename,mmap_mode='r')
+            return _grids[key]
+    y,x = numpy.indices(outshape).astype(numpy.float64)
+    grid = numpy.array(rotated_coords(y,x,inshape,outshape,angle))
+    del y,x
+    if filename is not None:
+        if not os.path.isdir(cache):
+            os.makedirs(cache)
+        tmpname = filename[:-4]+'.%d.tmp.npy' % os.getpid()
+        numpy.save(tmpname,grid)
+        os.rename(tmpname,filename)
+        grid = numpy.load(filename,mmap_mode='r')
+    _grids[key] = grid
+    return grid
+
+
+def _rotate(img,inshape,outshape,angle):
+    matrix,offset = rotation(inshape,outshape,angle)
+    return ndimage.affine_transform(img,matrix,offset,output_shape=outshape)
+
 def rotate(img):
-    return ndimage.map_coordinates(img,rotcoords)
+    return _rotate(img,DETECTOR,ROTATED,-ROTANGLE)
 
 def derotate(img):
-    return ndimage.map_coordinates(img,derotcoords)
+    return _rotate(img,ROTATED,DETECTOR,ROTANGLE)
 
 def rotate2(img):
-    return ndimage.map_coordinates(img,rotcoords2)
+    return _rotate(img,DETECTOR2,ROTATED2,-ROTANGLE)
 
 def derotate2(img):
-    return ndimage.map_coordinates(img,derotcoords2)
+    return _rotate(img,ROTATED2,DETECTOR2,ROTANGLE)
 
 
 def illumination(flat,nsig=15,nhigh=200):
@@ -138,17 +215,12 @@ def makeTraceIm(stars,nx,ny,save_output=False):
     print ""
     print "Making trace image from star exposures"
     print "--------------------------------------"
-    star = numpy.empty((len(stars),ny,nx))
-    count = 0
+    star = numpy.zeros((ny,nx))
     for img in stars:
-        star[count] = nirspecOpen(img,verbose=True)[0].data.copy()
-        count += 1
-    del img
-    bpm = numpy.median(star,0)
-
-    star = star.sum(0)
+        star += nirspecOpen(img,verbose=True)[0].data
+    count = len(stars)
     if count>2:
-        star -= bpm*count
+        star -= medianStack(stars)*count
 
     if save_output:
         pyfits.PrimaryHDU(star).writeto('star.fits',clobber=True)
@@ -188,23 +260,55 @@ def getYsoln(star,nstars,low,high):
     return yforw,yback,yforw2,yback2#,ytrue2,ymap2
 
 
-def getStraight(img,ysoln,low,resamp=True,mode='constant'):
-    yforw = ysoln[2]
-    tmp = img.repeat(2,0).repeat(2,1)
-    x = iT.coords(yforw.shape)[1]
-    c = numpy.array([yforw+low*2,x])
-    X = ndimage.map_coordinates(rotcoords2[1],c)
-    Y = ndimage.map_coordinates(rotcoords2[0],c)
-    c = numpy.array([Y,X])
-    tmp = ndimage.map_coordinates(tmp,c,mode=mode)
+def sampleOversampled(img,coords,order=3,mode='constant',resamp=True,
+                      exact=True):
+    """
+    Samples img at coords, given as (Y,X) in the 2x oversampled detector
+      frame, and (if resamp is True) averages 2x2 blocks of the output.
+
+    If exact is True the spline is fit to img.repeat(2,0).repeat(2,1), as
+      the pipeline has always done. If exact is False img is interpolated
+      directly at the native pixel coordinates (coords-0.5)/2, so the 4x
+      larger copy and its spline coefficients are never made (about 1.6x
+      faster). This is an approximation: the spline then goes through the
+      native pixel values rather than the blocky upsampled copy, so the
+      output differs by ~1.6% of the standard deviation of smooth data and
+      by up to hundreds of counts next to sharp features (bright sky
+      lines, cosmic rays), although the total flux agrees to ~5e-4.
+    """
+    if exact:
+        c = numpy.asarray(coords)
+        tmp = img.repeat(2,0).repeat(2,1)
+    else:
+        c = (numpy.asarray(coords)-0.5)/2.
+        tmp = img
+    tmp = ndimage.map_coordinates(tmp,c,order=order,mode=mode)
     if resamp==True:
-         return iT.resamp(tmp,2)
+        return iT.resamp(tmp,2)
     return tmp
 
 
-def getFlatNorm(flat,ysoln,low,high):
+def straightCoords(ysoln,low):
+    """
+    Returns the oversampled detector coordinates of the straightened (2x
+      oversampled) frame.
+    """
+    yforw = ysoln[2]
+    x = iT.coords(yforw.shape)[1]
+    return numpy.array(rotated_coords(yforw+low*2,x,DETECTOR2,ROTATED2,
+                                      -ROTANGLE))
+
+
+def getStraight(img,ysoln,low,resamp=True,mode='constant',coords=None,
+                exact=True):
+    if coords is None:
+        coords = straightCoords(ysoln,low)
+    return sampleOversampled(img,coords,3,mode,resamp,exact)
+
+
+def getFlatNorm(flat,ysoln,low,high,exact=True):
     from scipy.stats import stats
-    f = getStraight(flat,ysoln,low,False)
+    f = getStraight(flat,ysoln,low,False,exact=exact)
     ftmp = numpy.where(f==0,numpy.nan,f)
     norm = stats.nanmedian(ftmp[20:-20],0)
     norm = numpy.where((norm<=0)|numpy.isnan(norm),1.,norm)
@@ -266,7 +370,12 @@ def getWsoln(sky,x,wsolution,wmodel):
     return wsolution,rwsoln
 
 
-def resampleData(data,owgrid,low,high,ysoln,xsoln,rwsoln):
+def resampleCoords(owgrid,low,high,ysoln,xsoln,rwsoln):
+    """
+    Returns the oversampled detector coordinates of each pixel of the
+      (2x oversampled) output grid, composing the wavelength solution, the
+      x- and y-distortions, and the rotation into a single map.
+    """
     dy = (high-low)*2
     ygrid = iT.coords((dy,owgrid.size))[0]
     xgrid = sf.genfunc(owgrid,0.,rwsoln).repeat(dy)
@@ -275,13 +384,20 @@ def resampleData(data,owgrid,low,high,ysoln,xsoln,rwsoln):
     xgrid = xgrid.reshape(ygrid.shape)
     c = numpy.array([ygrid,xgrid])
     ygrid = ndimage.map_coordinates(ysoln[2],c)
-    c = numpy.array([ygrid+low*2,xgrid])
-    X = ndimage.map_coordinates(rotcoords2[1],c)
-    Y = ndimage.map_coordinates(rotcoords2[0],c)
-    c = numpy.array([Y,X])
-    d = data.repeat(2,0).repeat(2,1)
-    img = ndimage.map_coordinates(d,c,order=5)
-    return iT.resamp(img,2)
+    return numpy.array(rotated_coords(ygrid+low*2,xgrid,DETECTOR2,ROTATED2,
+                                      -ROTANGLE))
+
+
+def resampleData(data,owgrid,low,high,ysoln,xsoln,rwsoln,coords=None,
+                 exact=True):
+    """
+    Resamples data onto the output wavelength grid. The coordinates from
+      resampleCoords() can be passed in to reuse them for several frames;
+      see sampleOversampled() for exact.
+    """
+    if coords is None:
+        coords = resampleCoords(owgrid,low,high,ysoln,xsoln,rwsoln)
+    return sampleOversampled(data,coords,order=5,exact=exact)
 
 
 
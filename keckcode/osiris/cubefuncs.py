@@ -0,0 +1,779 @@
+"""
+
+cubefuncs.py - Array-level functions that operate on full OSIRIS data
+               cubes at once, rather than one wavelength slice at a time.
+
+All of the functions assume the array order produced by the OSIRIS
+ data reduction pipeline, i.e., (x, y, lambda) in numpy order, with
+ wavelength as the fastest-varying axis.
+
+"""
+
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from scipy import sparse
+from scipy.ndimage import filters
+from astropy.io import fits as pf
+
+# ===========================================================================
+
+
+def wblocks(wsize, wchunk=None):
+    """
+
+    Splits the wavelength axis into contiguous blocks of at most wchunk
+     slices.  Returns a list of (wmin, wmax) tuples, where wmax is
+     exclusive.  Setting wchunk=None (the default) returns a single block
+     that covers the full wavelength range.
+
+    """
+
+    if wchunk is None or wchunk >= wsize:
+        return [(0, wsize)]
+    wchunk = max(int(wchunk), 1)
+    return [(w, min(w + wchunk, wsize)) for w in range(0, wsize, wchunk)]
+
+# ---------------------------------------------------------------------------
+
+
+def map_blocks(worker, blockargs, blocks, nproc=1):
+    """
+
+    Generator that runs worker(blockargs(wmin, wmax)) for each of the
+     (wmin, wmax) blocks, and yields the ((wmin, wmax), result) pairs in
+     the order of the blocks.
+    If nproc>1 the blocks are distributed over a process pool, in groups
+     of nproc so that no more than nproc sets of block arguments are in
+     memory at a time.  In that case worker must be a module-level function
+     so that it can be sent to the pool.
+
+    """
+
+    ngroup = max(nproc, 1)
+    if nproc > 1:
+        pool = Pool(nproc)
+    try:
+        for g in range(0, len(blocks), ngroup):
+            group = blocks[g:g + ngroup]
+            args = [blockargs(wmin, wmax) for wmin, wmax in group]
+            if nproc > 1:
+                results = pool.map(worker, args)
+            else:
+                results = [worker(a) for a in args]
+            del args
+            for block, result in zip(group, results):
+                yield block, result
+            del results
+    finally:
+        if nproc > 1:
+            pool.close()
+            pool.join()
+
+# ---------------------------------------------------------------------------
+
+
+def cube_mask(mask):
+    """
+
+    Puts a mask into a form that broadcasts against the full data cube.
+     A 3-dimensional mask is already in the cube orientation, while a
+     2-dimensional mask is assumed to be in the standard WCS (i.e.,
+     transposed) orientation and is returned as a (x, y, 1) view.
+
+    """
+
+    if mask.ndim == 3:
+        return mask
+    else:
+        return np.transpose(mask)[:, :, np.newaxis]
+
+# ---------------------------------------------------------------------------
+
+
+def sigclip_slices(data, mask=None, nsig=3., wchunk=None, verbose=False):
+    """
+
+    Calculates a sigma-clipped mean and variance for every wavelength
+     slice of a data cube with array operations on the full cube, rather
+     than calling a sigma-clipping routine once per slice.
+
+    For each slice the algorithm is the same one that is used in
+     cdfutils.datafuncs.sigclip: starting with the good (masked and finite)
+     pixels, pixels that deviate from the mean by nsig times the rms or
+     more are rejected, and the process is repeated until no further pixels
+     are rejected.  All of the slices in a block are iterated together,
+     and each slice is dropped from the calculation once it has converged.
+
+    Inputs:
+      data   - the data cube, with shape (x, y, lambda)
+      mask   - boolean mask, where True indicates good data.  This can either
+               be a 2d mask in the standard WCS orientation or a 3d mask with
+               the same shape as the data cube.  The default (None) uses all
+               of the spaxels.
+      nsig   - clipping threshold, in units of the clipped rms
+      wchunk - maximum number of slices to process at once.  Setting this
+               bounds the memory used by the temporary arrays.  The default
+               (None) processes the full cube in one block.
+
+    Returns:
+      mean, var - the clipped mean and variance (i.e., the square of the
+                  clipped rms) for each slice
+    """
+
+    wsize = data.shape[2]
+    mean = np.zeros(wsize)
+    var = np.zeros(wsize)
+
+    """
+    With a 2d mask, only the good spaxels need to be carried through the
+     calculation
+    """
+    npix = data.shape[0] * data.shape[1]
+    if mask is not None and mask.ndim == 2:
+        spax = np.transpose(mask).ravel()
+    else:
+        spax = np.ones(npix, dtype=bool)
+
+    for wmin, wmax in wblocks(wsize, wchunk):
+        """
+        Put the block into a (lambda, spaxel) array so that the statistics
+         for each slice are reductions along the fast axis.  Bad pixels are
+         set to zero and then excluded through the good-pixel array.
+        """
+        dat = data[:, :, wmin:wmax].reshape((npix, wmax - wmin))
+        dat = np.array(np.transpose(dat[spax]), dtype=float)
+        good = np.isfinite(dat)
+        if mask is not None and mask.ndim == 3:
+            good &= np.transpose(mask[:, :, wmin:wmax].reshape(
+                (npix, wmax - wmin)))
+        dat[np.logical_not(good)] = 0.
+
+        """
+        Iterate until none of the slices reject any more pixels.  The
+         slices that have converged are dropped from subsequent iterations.
+        """
+        indx = np.arange(wmin, wmax)
+        ngood = good.sum(axis=1)
+        niter = 0
+        while indx.size > 0:
+            niter += 1
+            n = np.maximum(ngood, 1)
+            m = np.einsum('ij,ij->i', dat, good) / n
+            v = np.einsum('ij,ij,ij->i', dat, dat, good) / n - m**2
+            v = np.maximum(v, 0.)
+            s = nsig * np.sqrt(v)
+            good &= (dat > (m - s)[:, np.newaxis]) & \
+                (dat < (m + s)[:, np.newaxis])
+            newgood = good.sum(axis=1)
+
+            """ Save the statistics for the slices that have converged """
+            done = newgood == ngood
+            m[ngood == 0] = np.nan
+            v[ngood == 0] = np.nan
+            mean[indx[done]] = m[done]
+            var[indx[done]] = v[done]
+            if done.all():
+                break
+            elif done.any():
+                keep = np.logical_not(done)
+                indx = indx[keep]
+                dat = dat[keep]
+                good = good[keep]
+                newgood = newgood[keep]
+            ngood = newgood
+
+        if verbose:
+            print('Slices %d - %d: %d clipping iterations'
+                  % (wmin, wmax - 1, niter))
+        del dat, good
+
+    return mean, var
+
+# ---------------------------------------------------------------------------
+
+
+def smooth_xy(data, kwidth, smtype='median'):
+    """
+
+    Smooths a cube (or a block of slices from a cube) over the two spatial
+     dimensions, but not in wavelength.  Because each slice is smoothed
+     independently, smoothing a block of slices gives exactly the same
+     result as smoothing the full cube and then extracting the block.
+    The type of smoothing set by the smtype parameter.  This could be one
+     of the following:
+       'gauss':   a circular gaussian with sigma=kwidth
+       'median':  a median filter with side length=kwidth
+
+    Returns the smoothed data and a string describing the smoothing type
+    """
+
+    sm = smtype.lower()
+    if sm == 'gauss' or sm == 'guass' or sm == 'gaussian':
+        cube = filters.gaussian_filter(data, sigma=[kwidth, kwidth, 0])
+        smotype = 'Gaussian'
+    elif sm == 'median' or sm == 'medfilt':
+        cube = filters.median_filter(data, size=[kwidth, kwidth, 1])
+        smotype = 'Median filter'
+    else:
+        print('')
+        print('Smoothing type %s has not been implemented' % smtype)
+        print('')
+        raise NameError
+
+    return cube, smotype
+
+# ---------------------------------------------------------------------------
+
+
+def clean_block(data, mask, meanspec, rms, nsig1=5., nsig2=5.,
+                smtype='median', smsize=3, skysub=True):
+    """
+
+    Runs the OsCube bad-pixel cleaning algorithm on a block of wavelength
+     slices.  The smoothed version of the data is computed from the slices
+     in the block only, so the only full-size arrays that are needed are the
+     input block, its smoothed version, and the difference between the two.
+
+    Inputs:
+      data     - the block of slices, with shape (x, y, nslice).  This
+                 array is modified in place.
+      mask     - either a 2d mask in the standard WCS orientation or a 3d
+                 mask for the slices in the block
+      meanspec - the clipped mean for each slice in the block
+      rms      - the clipped rms for each slice in the block
+
+    Returns:
+      data  - the cleaned block
+      nflag - the number of flagged pixels in each slice
+    """
+
+    smooth = smooth_xy(data, smsize, smtype)[0]
+    diff = np.fabs(data - smooth)
+
+    """
+    Step through the slices, flagging the pixels that differ too much
+    from both the clipped mean value and the smoothed data
+    """
+    nflag = np.zeros(rms.size, dtype=int)
+    for i, r in enumerate(rms):
+        """ Subtract the sky if requested """
+        if skysub:
+            slmean = meanspec[i]
+        else:
+            slmean = 0.
+        smdat = smooth[:, :, i] - slmean
+        mdiff = np.fabs(data[:, :, i] - slmean)
+        data[:, :, i] -= slmean
+        flag = (mdiff > nsig1 * r) & (diff[:, :, i] > nsig2 * r)
+        data[:, :, i][flag] = smdat[flag]
+        nflag[i] = flag.sum()
+
+    """
+    Make sure that the regions outside the illuminated part of the
+    chip are set to zero, since they may have been set to a non-zero
+    value in the sky subtraction
+    """
+    if mask.ndim == 3:
+        data[np.logical_not(mask)] = 0.
+    else:
+        data[np.transpose(np.logical_not(mask))] = 0.
+
+    del smooth, diff
+    return data, nflag
+
+# ---------------------------------------------------------------------------
+
+
+def _clean_worker(args):
+    """
+
+    Unpacks the arguments for a clean_block call made through a
+     multiprocessing pool
+
+    """
+
+    data, mask, meanspec, rms, kwargs = args
+    return clean_block(data, mask, meanspec, rms, **kwargs)
+
+# ---------------------------------------------------------------------------
+
+
+def clean_cube(data, mask, meanspec, rms, wchunk=None, nproc=1,
+               verbose=False, **kwargs):
+    """
+
+    Runs the bad-pixel cleaning on a full cube by splitting it into blocks
+     of wavelength slices (see clean_block), which are processed
+     independently and, if nproc>1, in parallel through a process pool.
+    The result is identical to cleaning the full cube at once, but the
+     temporary arrays only ever hold nproc blocks of wchunk slices.
+
+    Inputs:
+      data     - the data cube, with shape (x, y, lambda).  This is not
+                 modified.
+      mask     - 2d or 3d mask, where True indicates good data
+      meanspec - clipped mean spectrum (e.g., from sigclip_slices)
+      rms      - clipped rms spectrum
+      wchunk   - number of slices per block.  The default (None) cleans the
+                 full cube in one block.
+      nproc    - number of processes to use
+      **kwargs - parameters passed to clean_block (nsig1, nsig2, smtype,
+                 smsize, and skysub)
+
+    Returns:
+      the cleaned cube
+    """
+
+    out = np.empty_like(data)
+    blocks = wblocks(data.shape[2], wchunk)
+
+    def blockargs(wmin, wmax):
+        if mask.ndim == 3:
+            bmask = mask[:, :, wmin:wmax]
+        else:
+            bmask = mask
+        return (np.array(data[:, :, wmin:wmax]), bmask, meanspec[wmin:wmax],
+                rms[wmin:wmax], kwargs)
+
+    """ Clean the blocks, in parallel if requested """
+    nflag = np.zeros(data.shape[2], dtype=int)
+    for (wmin, wmax), (cdat, nf) in map_blocks(_clean_worker, blockargs,
+                                               blocks, nproc):
+        out[:, :, wmin:wmax] = cdat
+        nflag[wmin:wmax] = nf
+
+    if verbose:
+        print('')
+        print('Slice N_flag')
+        print('----- ------')
+        for i, nf in enumerate(nflag):
+            print(' %3d  %5d' % (i, nf))
+
+    return out
+
+# ---------------------------------------------------------------------------
+
+
+def region_indices(reg, xsize, ysize):
+    """
+
+    Returns the indices, in the flattened (x, y) spatial plane of the cube,
+     of the spaxels in a region.  The reg parameter can be one of the
+     region types that are accepted by OsCube.make_1dspec, i.e.:
+      1. A single spaxel, designated by an (x,y) tuple or [x,y] list
+      2. A rectangular region, designated by an ((x1,x2), (y1,y2)) tuple
+         or a [[x1, x2], [y1, y2]] list, where x2 and y2 are exclusive
+      3. A boolean mask array with shape (xsize, ysize), with the spaxels
+         that are set to True designating the region to use
+
+    """
+
+    if isinstance(reg, np.ndarray):
+        return np.flatnonzero(reg.astype(bool))
+
+    x = reg[0]
+    y = reg[1]
+    if np.isscalar(x) and np.isscalar(y):
+        return np.array([int(x) * ysize + int(y)])
+    else:
+        xmin = min(max(int(x[0]), 0), xsize)
+        xmax = min(max(int(x[1]), xmin), xsize)
+        ymin = min(max(int(y[0]), 0), ysize)
+        ymax = min(max(int(y[1]), ymin), ysize)
+        xx, yy = np.meshgrid(np.arange(xmin, xmax), np.arange(ymin, ymax),
+                             indexing='ij')
+        return (xx * ysize + yy).ravel()
+
+# ---------------------------------------------------------------------------
+
+
+def region_matrix(regions, xsize, ysize):
+    """
+
+    Creates a sparse aggregation matrix, with one row per region, that
+     sums the spaxels in each region.  Applying the matrix to the cube,
+     reshaped to (xsize*ysize, nw), gives the summed spectrum of every
+     region at once.
+
+    Inputs:
+      regions - either a list of regions (see region_indices) or a
+                labelled segmentation image, i.e., an integer array with
+                shape (xsize, ysize) in which each region is designated by
+                a different positive value and 0 designates spaxels that
+                are not in any region.  For a segmentation image the
+                regions are ordered by increasing label value.
+      xsize, ysize - spatial size of the cube
+
+    Returns:
+      matrix - the (nregions, xsize*ysize) sparse matrix
+      labels - the label of each region, for a segmentation image, or the
+               index of each region in the input list
+    """
+
+    if isinstance(regions, np.ndarray) and \
+            np.issubdtype(regions.dtype, np.integer):
+        """ Labelled segmentation image """
+        flat = regions.ravel()
+        cols = np.flatnonzero(flat > 0)
+        labels, rows = np.unique(flat[cols], return_inverse=True)
+    else:
+        """ List of individual regions """
+        cols = []
+        rows = []
+        for i, reg in enumerate(regions):
+            indx = region_indices(reg, xsize, ysize)
+            cols.append(indx)
+            rows.append(np.full(indx.size, i, dtype=int))
+        cols = np.concatenate(cols)
+        rows = np.concatenate(rows)
+        labels = np.arange(len(regions))
+
+    matrix = sparse.csr_matrix((np.ones(cols.size), (rows, cols)),
+                               shape=(labels.size, xsize * ysize))
+    return matrix, labels
+
+# ---------------------------------------------------------------------------
+
+
+def extract_regions(data, matrix, wchunk=None):
+    """
+
+    Extracts the summed spectra of many regions from a cube with a single
+     sparse matrix product per block of wavelength slices.
+
+    Inputs:
+      data   - the data cube, with shape (x, y, lambda)
+      matrix - aggregation matrix from region_matrix
+      wchunk - maximum number of slices to process at once.  The default
+               (None) processes the full wavelength range at once.
+
+    Returns:
+      flux - the (nregions, lambda) array of summed spectra
+    """
+
+    """
+    Only the spaxels that are in at least one region are read from the
+     cube (and converted to double precision)
+    """
+    npix = data.shape[0] * data.shape[1]
+    used = np.unique(matrix.indices)
+    submatrix = matrix[:, used]
+    flat = data.reshape((npix, data.shape[2]))
+
+    flux = np.zeros((matrix.shape[0], data.shape[2]))
+    for wmin, wmax in wblocks(data.shape[2], wchunk):
+        dat = np.asarray(flat[used, wmin:wmax], dtype=float)
+        flux[:, wmin:wmax] = submatrix.dot(dat)
+    return flux
+
+# ---------------------------------------------------------------------------
+
+
+def moment_sums(data, wav, windows, wmin, wmax, nmom=2):
+    """
+
+    Calculates the contributions of the slices wmin:wmax of a cube to the
+     moment sums for each of a set of wavelength windows, i.e., the sums of
+     f, f*dlambda, and f*dlambda^2 (up to nmom) along the spectral axis,
+     where dlambda is measured from the first wavelength in the window to
+     avoid losing precision in the second moment.
+     Only the slices of each window that fall in wmin:wmax are used, so
+     windows that do not overlap the chunk get zero contributions.
+
+    Returns a list, with one entry per window, of lists of nmom+1 2d sums
+    """
+
+    sums = []
+    for w0, w1 in windows:
+        a = max(w0, wmin)
+        b = min(w1, wmax)
+        wsum = [np.zeros(data.shape[:2]) for i in range(nmom + 1)]
+        if b > a:
+            dat = data[:, :, a:b]
+            wsum[0] += dat.sum(axis=2, dtype=float)
+            if nmom > 0:
+                lam = wav[a:b] - wav[w0]
+                for i in range(1, nmom + 1):
+                    wsum[i] += np.dot(dat, lam**i)
+        sums.append(wsum)
+    return sums
+
+# ---------------------------------------------------------------------------
+
+
+def moment_maps(data, wav, windows, nmom=2, wchunk=None, nthreads=1):
+    """
+
+    Creates the moment maps for one or more wavelength windows, e.g., for
+     each of the emission lines in a cube, in a single pass through the
+     cube.  The cube is walked in chunks of wchunk slices and, for each
+     window, the flux-weighted sums are accumulated, so no sub-cube is
+     ever copied.  Since numpy releases the GIL in the reductions, the
+     chunks can be processed by nthreads threads.
+
+    Inputs:
+      data    - the data cube (or a spatial subset of it), with shape
+                (x, y, lambda)
+      wav     - the wavelength of each slice
+      windows - list of (wmin, wmax) slice ranges, where wmax is exclusive
+      nmom    - highest moment to calculate (0, 1, or 2)
+      wchunk  - number of slices per chunk.  The default (None) processes
+                each window in one chunk.
+      nthreads - number of threads to use
+
+    Returns:
+      a list, with one entry per window, of the moment maps:
+        mom0 - the summed flux
+        mom1 - the flux-weighted mean wavelength (if nmom>0)
+        mom2 - the flux-weighted wavelength dispersion (if nmom>1)
+      Pixels where the summed flux is not positive have mom1 and mom2 set
+      to NaN.
+    """
+
+    """ Set up the chunks that cover all of the windows """
+    wstart = min([w[0] for w in windows])
+    wend = max([w[1] for w in windows])
+    chunks = [(c0 + wstart, c1 + wstart) for c0, c1 in
+              wblocks(wend - wstart, wchunk)]
+
+    def chunksums(chunk):
+        return moment_sums(data, wav, windows, chunk[0], chunk[1], nmom)
+
+    """ Accumulate the sums, chunk by chunk """
+    total = None
+    if nthreads > 1:
+        pool = ThreadPool(nthreads)
+        results = pool.imap_unordered(chunksums, chunks)
+    else:
+        pool = None
+        results = (chunksums(c) for c in chunks)
+    try:
+        for sums in results:
+            if total is None:
+                total = sums
+            else:
+                for tot, wsum in zip(total, sums):
+                    for i in range(nmom + 1):
+                        tot[i] += wsum[i]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    """ Convert the sums into moments """
+    maps = []
+    for (w0, w1), s in zip(windows, total):
+        mom = [s[0]]
+        if nmom > 0:
+            good = s[0] > 0.
+            dlam = s[1][good] / s[0][good]
+            mom1 = np.full(s[0].shape, np.nan)
+            mom1[good] = wav[w0] + dlam
+            mom.append(mom1)
+        if nmom > 1:
+            mom2 = np.full(s[0].shape, np.nan)
+            var = s[2][good] / s[0][good] - dlam**2
+            mom2[good] = np.sqrt(np.maximum(var, 0.))
+            mom.append(mom2)
+        maps.append(mom)
+    return maps
+
+# ---------------------------------------------------------------------------
+
+
+def varcube_func(mask, var):
+    """ Variance cube: the slice variance at good spaxels, zero elsewhere """
+    return np.where(mask, var, 0.)
+
+
+def snrcube_func(data, mask, rms):
+    """ SNR cube: the data divided by the slice rms, zero at bad spaxels """
+    out = data * mask
+    out /= rms
+    return out
+
+# ---------------------------------------------------------------------------
+
+
+class LazyCube(object):
+    """
+
+    A data cube that is defined by a function of a few arrays that
+     broadcast against the full cube shape, e.g., a 2d mask and a 1d
+     variance spectrum.  The full cube is never stored.  Instead, indexing
+     the LazyCube evaluates the function only on the requested elements,
+     so that, e.g., lcube[:, :, 100] returns a single slice.
+    Use np.asarray(lcube) or lcube[...] to get the full cube as an array,
+     and the writeto method to save it to a fits file one block at a time.
+
+    """
+
+    def __init__(self, shape, func, arrays, dtype=float):
+        """
+
+        Inputs:
+          shape  - the shape of the full cube
+          func   - function that takes the broadcast, indexed arrays, in
+                   order, and returns the corresponding cube elements
+          arrays - list of arrays that broadcast against shape
+          dtype  - data type of the returned values
+        """
+
+        self.shape = tuple(shape)
+        self.ndim = len(self.shape)
+        self.size = int(np.prod(self.shape))
+        self.dtype = np.dtype(dtype)
+        self.func = func
+        self.arrays = [np.asarray(a) for a in arrays]
+
+    # ------------------------------------------------------------------------
+
+    def __getitem__(self, key):
+        """
+        The np.broadcast_to calls return read-only views, so only the
+        indexed elements are ever created
+        """
+        parts = [np.broadcast_to(a, self.shape)[key] for a in self.arrays]
+        return np.asarray(self.func(*parts), dtype=self.dtype)
+
+    # ------------------------------------------------------------------------
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[...]
+        if dtype is not None:
+            out = out.astype(dtype, copy=False)
+        return out
+
+    # ------------------------------------------------------------------------
+
+    def writeto(self, outfile, header=None, xchunk=8):
+        """
+
+        Writes the cube to a fits file through a streaming HDU, evaluating
+         xchunk planes along the first (slowest) axis at a time, so that
+         the full cube never has to be in memory.
+
+        """
+
+        """
+        Set up the output header, with the structural keywords at the top.
+         The structural and scaling keywords of the input header are
+         dropped, and all of its HISTORY and COMMENT cards are kept
+        """
+        bitpix = {'float32': -32, 'float64': -64, 'int16': 16, 'int32': 32,
+                  'uint8': 8}
+        outhdr = pf.PrimaryHDU().header
+        outhdr['bitpix'] = bitpix[self.dtype.name]
+        outhdr['naxis'] = self.ndim
+        prev = 'naxis'
+        for i in range(self.ndim):
+            key = 'naxis%d' % (i + 1)
+            outhdr.insert(prev, (key, self.shape[self.ndim - 1 - i]),
+                          after=True)
+            prev = key
+        if header is not None:
+            skip = ['SIMPLE', 'BITPIX', 'NAXIS', 'EXTEND', 'BSCALE', 'BZERO']
+            for card in header.cards:
+                key = card.keyword
+                if key in ['HISTORY', 'COMMENT', '']:
+                    outhdr.append(card, bottom=True)
+                elif key in skip or (key[:5] == 'NAXIS' and key[5:].isdigit()):
+                    continue
+                elif key not in outhdr:
+                    outhdr.append(card)
+
+        """ Write the data """
+        shdu = pf.StreamingHDU(outfile, outhdr)
+        for i in range(0, self.shape[0], xchunk):
+            shdu.write(self[i:i + xchunk])
+        shdu.close()
+
+# ---------------------------------------------------------------------------
+
+
+def bilinear_matrix(xin, yin, nx, ny):
+    """
+
+    Creates a sparse matrix that resamples a 2d (nx, ny) array onto a set
+     of output pixels through bilinear interpolation.  The input array
+     must be flattened in C order, and the matrix can then be applied to
+     all of the slices of a cube at once, i.e., for a cube with shape
+     (nx, ny, nw), M.dot(cube.reshape((nx*ny, nw))) returns the resampled
+     (nout, nw) data.
+    Output pixels that fall more than half a pixel outside of the input
+     array get no contribution from it, while those that fall within the
+     outer half pixel take the value of the edge pixel.
+
+    Inputs:
+      xin, yin - input-array pixel coordinates (zero-indexed, along the
+                 first and second array axes) of each output pixel
+      nx, ny   - shape of the input array
+
+    Returns:
+      the (nout, nx*ny) sparse resampling matrix
+    """
+
+    xin = np.ravel(xin)
+    yin = np.ravel(yin)
+    nout = xin.size
+    valid = (xin >= -0.5) & (xin <= nx - 0.5) & (yin >= -0.5) & \
+        (yin <= ny - 0.5)
+    outpix = np.arange(nout)[valid]
+    x = np.clip(xin[valid], 0, nx - 1)
+    y = np.clip(yin[valid], 0, ny - 1)
+
+    """ Lower-left input pixel and interpolation fractions """
+    x0 = np.clip(np.floor(x).astype(int), 0, max(nx - 2, 0))
+    y0 = np.clip(np.floor(y).astype(int), 0, max(ny - 2, 0))
+    fx = x - x0
+    fy = y - y0
+    x1 = np.minimum(x0 + 1, nx - 1)
+    y1 = np.minimum(y0 + 1, ny - 1)
+
+    rows = np.concatenate([outpix] * 4)
+    cols = np.concatenate([x0 * ny + y0, x1 * ny + y0, x0 * ny + y1,
+                           x1 * ny + y1])
+    vals = np.concatenate([(1. - fx) * (1. - fy), fx * (1. - fy),
+                           (1. - fx) * fy, fx * fy])
+    return sparse.csr_matrix((vals, (rows, cols)), shape=(nout, nx * ny))
+
+# ---------------------------------------------------------------------------
+
+
+def coadd_block(inputs):
+    """
+
+    Resamples and coadds a block of wavelength slices from several cubes.
+
+    Inputs:
+      inputs - list with one (matrix, data, weight, slwt) tuple per cube,
+               where:
+                 matrix is the resampling matrix from bilinear_matrix
+                 data is the (nx, ny, nslice) block of the cube
+                 weight is the spatial weight, which broadcasts against data
+                 slwt is the weight for each slice in the block
+               Non-finite data values get zero weight.
+
+    Returns:
+      sumwd, sumw - the weighted sum of the resampled data and the sum of
+                    the weights, each with shape (nout, nslice)
+    """
+
+    sumwd = None
+    sumw = None
+    for matrix, data, weight, slwt in inputs:
+        nslice = data.shape[2]
+        dat = np.asarray(data, dtype=float).reshape((-1, nslice))
+        wt = np.broadcast_to(weight, data.shape).reshape((-1, nslice)) * \
+            np.isfinite(dat)
+        dat = np.where(wt > 0., dat, 0.)
+        wd = matrix.dot(wt * dat) * slwt
+        w = matrix.dot(wt) * slwt
+        if sumwd is None:
+            sumwd = wd
+            sumw = w
+        else:
+            sumwd += wd
+            sumw += w
+    return sumwd, sumw
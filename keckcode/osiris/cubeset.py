@@ -6,11 +6,18 @@ cubeset - Defines a CubeSet class that contains code to handle operations
 """
 
 import os
+import time
+import tracemalloc
+from multiprocessing import Pool
 import numpy as np
 from matplotlib import pyplot as plt
+from astropy import wcs
 from astropy.io import ascii
 from astropy.io import fits as pf
+from specim import specfuncs as ss
+from specim.imfuncs.wcshdu import WcsHDU
 from .oscube import OsCube
+from . import cubefuncs as cf
 
 
 class CubeSet(list):
@@ -24,7 +31,7 @@ class CubeSet(list):
     # ------------------------------------------------------------------------
 
     def __init__(self, inlist, informat=None, indir=None, maskfile=None,
-                 verbose=True):
+                 lazy=False, verbose=True):
         """
 
         There are three ways to create a Cubeset instance
@@ -41,6 +48,11 @@ class CubeSet(list):
            which is either 0 or 1 and indicates whether the file is
            good (G=1) or bad (G=0)
 
+        If lazy is True, then cubes that are read from files are
+         memory-mapped rather than read into memory (see OsCube), so that
+         creating a large CubeSet is fast and the data are only read as
+         they are used.
+
         """
 
         """ Set default values """
@@ -58,7 +70,7 @@ class CubeSet(list):
             if isinstance(inlist[0], str):
                 for f in inlist:
                     try:
-                        cube = OsCube(f)
+                        cube = OsCube(f, lazy=lazy)
                     except IOError:
                         print('')
                         print('Could not open requested file: %s' % f)
@@ -108,7 +120,7 @@ class CubeSet(list):
                 else:
                     infile = f
                 try:
-                    cube = OsCube(infile)
+                    cube = OsCube(infile, lazy=lazy)
                 except IOError:
                     print('')
                     print('Could not open requested file: %s' % infile)
@@ -118,26 +130,48 @@ class CubeSet(list):
     # ------------------------------------------------------------------------
 
     def clean(self, maskfile='default', maskdir='../Clean',
-              outdir='../Clean', debug=False, **kwargs):
+              outdir='../Clean', nproc=1, reuse_varspec=False, debug=False,
+              **kwargs):
         """
 
         Runs the clean algorithm for each cube in the CubeSet
 
+        The mask file is only read once, and the other cubes share a
+         read-only view of the first cube's mask.
+        If nproc>1, the cubes are cleaned concurrently by a pool of worker
+         processes.  The workers are forked after the CubeSet has been
+         made available to them, so they work on the cubes that are
+         already loaded (including any changes made to them) rather than
+         reading the input files again.  The cleaned cubes are then
+         attached to the cubes in the CubeSet as memory-mapped views of
+         the output files, so each cube ends up with a 'clean' data set
+         as in the serial case.
+        If reuse_varspec is True, then cubes that already have a mean and
+         variance spectrum (e.g., from an earlier make_varspec call) use
+         them rather than recomputing them.
+        The time taken and the peak memory used for each cube are reported
+         at the end, and returned as a list of (filename, time, memory)
+         tuples.  The peak memory is the largest amount of memory, in MB,
+         allocated by the cleaning of that cube (on top of what was in use
+         when it started), as traced by tracemalloc.  It counts the arrays
+         made while cleaning, but not the memory-mapped input data.
+
+        Any additional keyword arguments are passed to OsCube.clean
+
         """
 
         """
-        Read the mask file into the first cube, and then copy it to the
+        Read the mask file into the first cube, and then share it with the
         subsequent cubes
         """
         self[0].read_maskfile(maskfile, maskdir)
+        mask = self[0].mask.view()
+        mask.flags.writeable = False
         for i in range(1, len(self)):
-            self[i].mask = self[0].mask.copy()
+            self[i].mask = mask
 
-        """
-        Loop through the files, cleaning each one and saving to the
-        designated directory
-        """
-        print('')
+        """ Set up the input and output information for each cube """
+        jobs = []
         for f in self:
             basename = os.path.basename(f.infile)
             outfile = os.path.join(outdir, basename)
@@ -146,25 +180,97 @@ class CubeSet(list):
                 print('Input file:   %s' % f.infile)
                 print('Output file:  %s' % outfile)
                 print('Varspec file: %s' % varfile)
-            f.make_varspec(outfile=varfile)
-            f.clean(**kwargs)
-            f.save_drp('clean', outfile)
-
-    # ------------------------------------------------------------------------
+            if reuse_varspec and f.varspec is not None and \
+                    f.meanspec is not None:
+                stats = (f.meanspec, np.asarray(f.varspec['flux']))
+            else:
+                stats = None
+            jobs.append((outfile, varfile, stats, kwargs))
 
-    def coadd(self, configfile, outfile, wlim=None, testslice='default',
-              testonly=False, slroot='slice', verbose=True, **kwargs):
         """
+        Loop through the files, cleaning each one and saving to the
+        designated directory
+        """
+        print('')
+        if nproc > 1:
+            """
+            The workers are forked after _clean_set is set, so they inherit
+            the loaded cubes (and the shared mask) without pickling them
+            """
+            global _clean_set
+            _clean_set = self
+            pool = Pool(nproc)
+            try:
+                results = pool.map(_clean_worker, enumerate(jobs),
+                                   chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+                _clean_set = None
+            info = []
+            for f, res in zip(self, results):
+                outfile, dt, mem, meanspec, varflux = res
+                f.meanspec = meanspec
+                f.varspec = ss.Spec1d(wav=f.wav, flux=varflux)
+                f['clean'] = WcsHDU(pf.getdata(outfile, memmap=True),
+                                    f.header)
+                info.append((outfile, dt, mem))
+        else:
+            info = []
+            for f, job in zip(self, jobs):
+                info.append(_clean_cube(f, *job))
+
+        """ Report the timing and memory usage """
+        print('')
+        print('File                                  Time (s)  Peak mem (MB)')
+        print('------------------------------------  --------  -------------')
+        for fname, dt, mem in info:
+            print('%-36s  %8.2f  %13.1f' % (os.path.basename(fname), dt, mem))
+        print('')
+        return info
 
-        Coadd the cubes through calls to swarp
-        (NOT YET IMPLEMENTED)
+    # ------------------------------------------------------------------------
 
+    def coadd(self, outfile=None, wlim=None, wtmode='mask', wchunk=None,
+              nproc=1, verbose=True):
         """
 
+        Coadds the cubes onto a common spatial grid.
+
+        The output grid is set once from the member headers: it has the
+         pixel scale and orientation of the first cube, and is large enough
+         to contain the footprints of all of the cubes.  If the CubeSet was
+         created with informat='coadd', the CRVAL and CRPIX values in the
+         input table are used for the spatial WCS of each cube.
+        Each cube is then resampled onto the output grid with bilinear
+         interpolation, through a sparse matrix that is computed once per
+         cube and applied to all of its wavelength slices at once, and the
+         weighted sums of the data and of the weights are accumulated.
+         This is done in blocks of wchunk slices, which can be distributed
+         over nproc processes.
+
+        Inputs:
+          outfile - name of the output fits file.  A file with the summed
+                    weights is also written, with '_wht' inserted before
+                    '.fits'.  The default (None) does not write any files.
+          wlim    - range of wavelength slices to coadd, as (wmin, wmax).
+                    The default (None) uses the full wavelength range.
+          wtmode  - weighting of each cube:
+                     'mask'    - the cube mask, if it exists (otherwise all
+                                 spaxels get the same weight)
+                     'exptime' - the mask times the exposure time
+                     'ivar'    - the mask divided by the variance spectrum,
+                                 which requires that make_varspec has been
+                                 run for each cube
+          wchunk  - number of wavelength slices per block.  The default
+                    (None) coadds the full wavelength range at once.
+          nproc   - number of processes to use
+
+        Returns:
+          an OsCube containing the coadded cube
         """
-        Get the range of wavelength slices to extract from the cube.
-        The default is to use the full wavelength range.
-        """
+
+        """ Set the range of wavelength slices to coadd """
         if wlim is not None:
             wmin = wlim[0]
             wmax = wlim[1]
@@ -172,49 +278,188 @@ class CubeSet(list):
             wmin = 0
             wmax = self[0].wsize
 
+        """ Check that all of the cubes share the same wavelength grid """
+        hdr0 = self[0].header
+        for c in self[1:]:
+            if c.wsize != self[0].wsize or \
+                    not np.isclose(c.header['crval1'], hdr0['crval1']) or \
+                    not np.isclose(c.header['cdelt1'], hdr0['cdelt1']):
+                raise ValueError('Cubes do not have matching wavelength '
+                                 'solutions')
+
         """
-        Make a test file, with the swarped coadd of a single slice.
-        This is used to set the size of the output array
+        Get the spatial WCS of each cube, applying the corrections from the
+        input table if they exist
         """
-        if testslice == 'default':
-            testslice = int((wmin + wmax) / 2.)
-
+        wcslist = []
         for i, c in enumerate(self):
-            c.set_imslice(testslice, display=False)
-            outname = '%s_%02d.fits' % (slroot, i)
-            outwht = outname.replace('.fits', '_wht.fits')
-            hdr = c['slice'].header
-            if 'ELAPTIME' in hdr.keys():
-                hdr['exptime'] = hdr['elaptime']
-            elif 'ITIME' in hdr.keys():
-                hdr['exptime'] = hdr['itime'] / 1000.
-            c['slice'].writeto(outname, overwrite=True)
-            pf.PrimaryHDU(c.mask.astype(int),
-                          hdr).writeto(outwht, overwrite=True)
-        os.system('swarp %s*fits -c swarp_coseye.config' % slroot)
-
-        """ If the testonly mode has been requested, quit here """
-        if testonly:
-            return
-
-        """
-        Get the relevent information out of the test file, and then delete
-        the temporary files.
-        The reason for using the WCS call is to get the WCS information in 
-         the header of the swarped file into a standard format
-        """
-        tmphdu = pf.open('coadd.fits')
-        hdr2d = (wcs.WCS(tmphdu[0].header)).to_header()
-        dim2d = tmphdu[0].data.shape
-        if testonly:
-            return
+            w2d = wcs.WCS(c.make_wcs2dhdr())
+            if self.info is not None and 'CRVAL1' in self.info.colnames:
+                w2d.wcs.crval = [self.info['CRVAL1'][i],
+                                 self.info['CRVAL2'][i]]
+                w2d.wcs.crpix = [self.info['CRPIX1'][i],
+                                 self.info['CRPIX2'][i]]
+                w2d.wcs.set()
+            wcslist.append(w2d)
+        wref = wcslist[0]
+
+        """
+        Find the footprint of each cube in the pixel frame of the first cube,
+        and set the size of the output grid
+        """
+        xlist = []
+        ylist = []
+        for c, w2d in zip(self, wcslist):
+            cx = np.array([0, c.xsize - 1, 0, c.xsize - 1])
+            cy = np.array([0, 0, c.ysize - 1, c.ysize - 1])
+            ra, dec = w2d.all_pix2world(cx, cy, 0)
+            rx, ry = wref.all_world2pix(ra, dec, 0)
+            xlist.append(rx)
+            ylist.append(ry)
+        x0 = int(np.floor(np.concatenate(xlist).min() + 0.5))
+        y0 = int(np.floor(np.concatenate(ylist).min() + 0.5))
+        nxout = int(np.floor(np.concatenate(xlist).max() + 0.5)) - x0 + 1
+        nyout = int(np.floor(np.concatenate(ylist).max() + 0.5)) - y0 + 1
+        if verbose:
+            print('')
+            print('Coadding %d cubes onto a %d x %d x %d grid'
+                  % (len(self), nxout, nyout, wmax - wmin))
+
+        """
+        For each cube, compute the resampling matrix and the weights
+        """
+        xout, yout = np.indices((nxout, nyout))
+        ra, dec = wref.all_pix2world(xout.ravel() + x0, yout.ravel() + y0, 0)
+        matrices = []
+        weights = []
+        slwts = []
+        for c, w2d in zip(self, wcslist):
+            xin, yin = w2d.all_world2pix(ra, dec, 0)
+            matrices.append(cf.bilinear_matrix(xin, yin, c.xsize, c.ysize))
+            if c.mask is not None:
+                wt = cf.cube_mask(c.mask).astype(float)
+            else:
+                wt = np.ones((c.xsize, c.ysize, 1))
+            slwt = np.ones(c.wsize)
+            if wtmode == 'exptime':
+                hdr = c.header
+                if 'ELAPTIME' in hdr.keys():
+                    wt *= hdr['elaptime']
+                elif 'ITIME' in hdr.keys():
+                    wt *= hdr['itime'] / 1000.
+            elif wtmode == 'ivar':
+                if c.varspec is None:
+                    raise ValueError('wtmode="ivar" requires that '
+                                     'make_varspec is run for each cube')
+                slwt = 1. / np.asarray(c.varspec['flux'])
+                slwt[np.logical_not(np.isfinite(slwt))] = 0.
+            elif wtmode != 'mask':
+                raise ValueError('wtmode must be one of "mask", "exptime", '
+                                 'or "ivar"')
+            weights.append(wt)
+            slwts.append(slwt)
+
+        def blockargs(bmin, bmax):
+            inputs = []
+            for c, m, wt, slwt in zip(self, matrices, weights, slwts):
+                if wt.shape[2] > 1:
+                    bwt = wt[:, :, bmin:bmax]
+                else:
+                    bwt = wt
+                inputs.append((m, np.array(c.data[:, :, bmin:bmax]), bwt,
+                               slwt[bmin:bmax]))
+            return inputs
+
+        """ Accumulate the weighted sums, one block of slices at a time """
+        outcube = np.zeros((nxout, nyout, wmax - wmin), dtype=np.float32)
+        outwht = np.zeros((nxout, nyout, wmax - wmin), dtype=np.float32)
+        blocks = [(b0 + wmin, b1 + wmin) for b0, b1 in
+                  cf.wblocks(wmax - wmin, wchunk)]
+        for (bmin, bmax), (sumwd, sumw) in cf.map_blocks(cf.coadd_block,
+                                                         blockargs, blocks,
+                                                         nproc):
+            good = sumw > 0.
+            sumwd[good] /= sumw[good]
+            sumwd[np.logical_not(good)] = 0.
+            shape = (nxout, nyout, bmax - bmin)
+            outcube[:, :, bmin-wmin:bmax-wmin] = sumwd.reshape(shape)
+            outwht[:, :, bmin-wmin:bmax-wmin] = sumw.reshape(shape)
+            if verbose:
+                print('  Coadded slices %d - %d' % (bmin, bmax - 1))
+
+        """ Create the output header """
+        outhdr = hdr0.copy()
+        outhdr['crpix1'] -= wmin
+        outhdr['crval3'] = wref.wcs.crval[0]
+        outhdr['crval2'] = wref.wcs.crval[1]
+        outhdr['crpix3'] = wref.wcs.crpix[0] - x0
+        outhdr['crpix2'] = wref.wcs.crpix[1] - y0
+        outhdr['ncombine'] = (len(self), 'Number of coadded cubes')
+        outhdr['history'] = 'Coadded with CubeSet.coadd (wtmode=%s)' % wtmode
+        outhdu = pf.PrimaryHDU(outcube, outhdr)
+
+        """ Save the output if requested """
+        if outfile is not None:
+            outhdu.writeto(outfile, overwrite=True)
+            whtfile = outfile.replace('.fits', '_wht.fits')
+            pf.PrimaryHDU(outwht, outhdu.header).writeto(whtfile,
+                                                         overwrite=True)
+            if verbose:
+                print('Wrote coadded cube to %s' % outfile)
+                print('Wrote coadd weights to %s' % whtfile)
+
+        return OsCube(outhdu, verbose=verbose)
+
+# ============================================================================
+
+
+def _clean_cube(cube, outfile, varfile, stats, kwargs):
+    """
+
+    Cleans a single cube and saves the result.  Returns the output file
+    name, the time taken, and the peak memory allocated while cleaning it,
+    in MB.
+
+    """
+
+    t0 = time.time()
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    try:
+        if stats is not None:
+            cube.meanspec = stats[0]
+            cube.varspec = ss.Spec1d(wav=cube.wav, flux=stats[1])
         else:
-            os.system('rm %s*fits' % slroot)
-            os.system('rm coadd*fits')
+            cube.make_varspec(outfile=varfile)
+        cube.clean(**kwargs)
+        cube.save_drp('clean', outfile)
+        mem = (tracemalloc.get_traced_memory()[1] - base) / 1024. / 1024.
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    return outfile, time.time() - t0, mem
 
-        """ Split all the cubes into their slices """
-        if(verbose):
-            print('Splitting the cubes into slices')
-        for i, c in enumerate(self):
-            outroot = '%s_%i' % (slroot, i)
-            c.slice_cube(wlim=wlim, outroot=outroot)
+# ----------------------------------------------------------------------------
+
+
+_clean_set = None
+
+
+def _clean_worker(job):
+    """
+
+    Cleans one of the cubes of the CubeSet that the worker process
+    inherited when it was forked, and returns the timing and memory
+    information along with the mean and variance spectra, which are small
+    enough to send back to the parent process
+
+    """
+
+    i, (outfile, varfile, stats, kwargs) = job
+    cube = _clean_set[i]
+    outfile, dt, mem = _clean_cube(cube, outfile, varfile, stats, kwargs)
+    return outfile, dt, mem, cube.meanspec, np.asarray(cube.varspec['flux'])
@@ -6,13 +6,13 @@ oscube.py
 
 from os import path
 import numpy as np
-from scipy.ndimage import filters
 from astropy import wcs
 from astropy.io import fits as pf
 from cdfutils import datafuncs as df
 from specim import imfuncs as imf
 from specim import specfuncs as ss
 from specim.imfuncs.wcshdu import WcsHDU
+from . import cubefuncs as cf
 
 # ===========================================================================
 
@@ -22,7 +22,7 @@ class OsCube(imf.Image):
     A class used to visualize and analyze OSIRIS data
     """
 
-    def __init__(self, indat, maskfile=None, verbose=True):
+    def __init__(self, indat, maskfile=None, lazy=False, verbose=True):
         """
         Loads in an OSIRIS data cube that was processed through the
         standard data reduction pipeline and, possibly, has had some
@@ -30,32 +30,43 @@ class OsCube(imf.Image):
 
         Inputs:
           indat - either the name of an input fits file or a HDU
+
+        Optional inputs:
+          lazy  - if True and indat is a filename, then the data cube is
+                  memory-mapped rather than read into memory, so that only
+                  the parts of the file that are actually used (e.g., a
+                  single spaxel or a sub-cube) get read from disk.  The
+                  additional DRP HDUs are also not read until they are
+                  needed (e.g., by save_drp).  Note that astropy can not
+                  memory-map a cube that has BSCALE/BZERO scaling.
         """
 
         """ Read the data into an Image structure """
-        super(OsCube, self).__init__(indat, verbose=verbose)  # Python 2.7
-        # super().__init__(indat, verbose=verbose) # Python 3 syntax
+        self._drphdus = None
+        self._xycoords = None
+        if lazy and isinstance(indat, str):
+            self._hdulist = pf.open(indat, memmap=True)
+            super(OsCube, self).__init__(self._hdulist[0], verbose=verbose)
+            self.infile = indat
+        else:
+            self._hdulist = None
+            super(OsCube, self).__init__(indat, verbose=verbose)  # Python 2.7
+            # super().__init__(indat, verbose=verbose) # Python 3 syntax
         print('Number of wavelength slices: %d' % self.header['naxis1'])
 
         """
         If indat is a file that has come out of the OSIRIS DRP, it will
-        contain additional HDUs.  Read those in if they exist
+        contain additional HDUs.  Read those in if they exist, unless the
+        lazy mode has been requested, in which case they will be read
+        the first time that they are used.
         """
         if isinstance(indat, str):
-            try:
-                test = pf.open(indat)
-            except IOError:
-                self.drphdu1 = None
-                self.drphdu2 = None
-                test.close()
-            else:
-                if len(test) == 3:
-                    self.drphdu1 = test[1].copy()
-                    self.drphdu2 = test[2].copy()
-                else:
-                    self.drphdu1 = None
-                    self.drphdu2 = None
-                test.close()
+            self._drpfile = indat
+            if not lazy:
+                self.read_drphdus()
+        else:
+            self._drpfile = None
+            self._drphdus = (None, None)
 
         """ Set up the wavelength vector based on the header information """
         hdr = self.header
@@ -82,9 +93,6 @@ class OsCube(imf.Image):
         self.ysize = self.data.shape[1]
         self.wsize = self.data.shape[2]
 
-        """ Create arrays of (x,y) coordinate values """
-        self.xcoords, self.ycoords = np.indices((self.xsize, self.ysize))
-
         """ Get information about the observations """
         self.obsinfo()
 
@@ -92,6 +100,7 @@ class OsCube(imf.Image):
         self.cube = None
         self.mask = None
         self.moment0 = None
+        self.moments = None
         self.meanspec = None
         self.varspec = None
 
@@ -108,6 +117,67 @@ class OsCube(imf.Image):
 
     # -----------------------------------------------------------------------
 
+    def read_drphdus(self):
+        """
+
+        Reads in the two additional HDUs that are contained in a file that
+        has come out of the OSIRIS DRP, if they exist.
+
+        """
+
+        self._drphdus = (None, None)
+        if self._drpfile is None:
+            return
+        try:
+            test = pf.open(self._drpfile, memmap=True)
+        except IOError:
+            return
+        if len(test) == 3:
+            self._drphdus = (test[1].copy(), test[2].copy())
+        test.close()
+
+    # -----------------------------------------------------------------------
+
+    @property
+    def drphdu1(self):
+        if self._drphdus is None:
+            self.read_drphdus()
+        return self._drphdus[0]
+
+    @drphdu1.setter
+    def drphdu1(self, hdu):
+        self._drphdus = (hdu, self.drphdu2)
+
+    @property
+    def drphdu2(self):
+        if self._drphdus is None:
+            self.read_drphdus()
+        return self._drphdus[1]
+
+    @drphdu2.setter
+    def drphdu2(self, hdu):
+        self._drphdus = (self.drphdu1, hdu)
+
+    # -----------------------------------------------------------------------
+
+    @property
+    def xcoords(self):
+        """
+        Arrays of (x,y) coordinate values, which are only created when
+        they are first used
+        """
+        if self._xycoords is None:
+            self._xycoords = np.indices((self.xsize, self.ysize))
+        return self._xycoords[0]
+
+    @property
+    def ycoords(self):
+        if self._xycoords is None:
+            self._xycoords = np.indices((self.xsize, self.ysize))
+        return self._xycoords[1]
+
+    # -----------------------------------------------------------------------
+
     def obsinfo(self):
         """
 
@@ -397,8 +467,8 @@ class OsCube(imf.Image):
     # -----------------------------------------------------------------------
 
     def compress_spec(self, wlim=None, xlim=None, ylim=None, wmode='slice',
-                      dmode='input', combmode='sum', display=True,
-                      verbose=True, **kwargs):
+                      dmode='input', combmode='sum', wchunk=None,
+                      nthreads=1, display=True, verbose=True, **kwargs):
         """
 
         Compresses the data cube along the spectral dimension, but only
@@ -409,6 +479,8 @@ class OsCube(imf.Image):
         Setting wlim=None (the default) will use the full wavelength range
 
         The compression can be done either as a sum or as a median.
+        The sum is done in chunks of wchunk slices, optionally spread over
+        nthreads threads.
 
         The result is a 2-dimensional spatial image, which is stored in the
         data container and, thus, can be easily displayed.
@@ -433,7 +505,10 @@ class OsCube(imf.Image):
             print('  Corresponding wavelength range: %8.2f - %8.2f'
                   % (wavmin, wavmax))
 
-        """ Create a temporary cube container """
+        """
+        Select the region of the cube to compress.  Note that the sub-cube
+        is a view into the full cube, not a copy.
+        """
         cube, cubehdr = self.select_cube(wlim, xlim, ylim, dmode=dmode,
                                          verbose=verbose)
 
@@ -444,12 +519,19 @@ class OsCube(imf.Image):
         """
         w2dhdr = self.make_wcs2dhdr(hdr=cubehdr)
 
-        """ Compress the temporary cube along the spectral axis """
+        """
+        Compress the cube along the spectral axis.  A sum is accumulated
+        in chunks of wchunk slices (see cubefuncs.moment_maps), while a
+        median needs all of the slices at once
+        """
         if combmode == 'median':
             self['slice'] = WcsHDU(np.transpose(np.median(cube, axis=2)),
                                    w2dhdr)
         else:
-            self['slice'] = WcsHDU(np.transpose(cube.sum(axis=2)), w2dhdr)
+            wsum = cf.moment_maps(cube, self.wav, [(0, cube.shape[2])],
+                                  nmom=0, wchunk=wchunk,
+                                  nthreads=nthreads)[0][0]
+            self['slice'] = WcsHDU(np.transpose(wsum), w2dhdr)
 
         """ Display the result if requested """
         if display:
@@ -501,6 +583,69 @@ class OsCube(imf.Image):
 
     # -----------------------------------------------------------------------
 
+    def make_moments(self, wlims, xlim=None, ylim=None, wmode='slice',
+                     lamref=None, dmode='input', wchunk=None, nthreads=1,
+                     verbose=True):
+        """
+
+        Makes moment 0, 1, and 2 maps (flux, velocity, and velocity
+        dispersion) for one or more wavelength windows, e.g., one for each
+        emission line in the cube, with a single pass through the cube.
+        See cubefuncs.moment_maps for the details.
+
+        Inputs:
+          wlims  - list of (wmin, wmax) windows, one per line.  These are
+                   slice numbers (wmax is exclusive) if wmode='slice' or
+                   wavelengths in Angstrom if wmode='wavelength'
+          xlim, ylim - spatial region to use, as in select_cube
+          lamref - reference (e.g., redshifted line) wavelength for each
+                   window, used to convert the first and second moments
+                   into velocities in km/s.  If None, the moment 1 and 2
+                   maps are given as wavelengths in Angstrom.
+          wchunk - number of slices per chunk
+          nthreads - number of threads to use
+
+        Returns: a list, with one entry per window, of WcsHDU containers
+          for the (mom0, mom1, mom2) maps, which are also stored in the
+          moments attribute.
+        """
+
+        """ Convert the windows into slice numbers if required """
+        windows = []
+        for wl in wlims:
+            if wmode == 'wavelength':
+                windows.append((int(np.searchsorted(self.wav, wl[0])),
+                                int(np.searchsorted(self.wav, wl[1]))))
+            else:
+                windows.append((int(wl[0]), int(wl[1])))
+
+        if verbose:
+            print('')
+            print('Making moment maps for %d wavelength windows'
+                  % len(windows))
+
+        """ Select the spatial region, but keep the full wavelength axis """
+        cube, cubehdr = self.select_cube(None, xlim, ylim, dmode=dmode)
+        w2dhdr = self.make_wcs2dhdr(hdr=cubehdr)
+
+        """ Calculate the moment maps """
+        maps = cf.moment_maps(cube, self.wav, windows, nmom=2, wchunk=wchunk,
+                              nthreads=nthreads)
+
+        """ Convert to velocities if requested and save the results """
+        ckms = 299792.458
+        self.moments = []
+        for i, (mom0, mom1, mom2) in enumerate(maps):
+            if lamref is not None:
+                mom1 = ckms * (mom1 - lamref[i]) / lamref[i]
+                mom2 = ckms * mom2 / lamref[i]
+            self.moments.append([WcsHDU(np.transpose(m), w2dhdr,
+                                        wcsverb=False)
+                                 for m in (mom0, mom1, mom2)])
+        return self.moments
+
+    # -----------------------------------------------------------------------
+
     def smooth_xy(self, kwidth, smtype='median', outfile=None):
         """
         Smooths the cube over the two spatial dimensions.
@@ -513,19 +658,7 @@ class OsCube(imf.Image):
         """
 
         """ Smooth the data """
-        data = self.data
-        sm = smtype.lower()
-        if sm == 'gauss' or sm == 'guass' or sm == 'gaussian':
-            cube = filters.gaussian_filter(data, sigma=[kwidth, kwidth, 0])
-            smotype = 'Gaussian'
-        elif sm == 'median' or sm == 'medfilt':
-            cube = filters.median_filter(data, size=[kwidth, kwidth, 1])
-            smotype = 'Median filter'
-        else:
-            print('')
-            print('Smoothing type %s has not been implemented' % smtype)
-            print('')
-            raise NameError
+        cube, smotype = cf.smooth_xy(self.data, kwidth, smtype)
 
         """ Put the smoothed data into a new WcsHDU """
         hdr = self.header.copy()
@@ -635,14 +768,21 @@ class OsCube(imf.Image):
     # -----------------------------------------------------------------------
 
     def make_varspec(self, maskfile=None, outfile=None, outformat='text',
-                     verbose=False):
+                     nsig=3., wchunk=None, verbose=False):
         """
-        Steps through the spectral slices and computes the statistics of
-        the illuminated region and stores the clipped mean and variance
-        for each slice.
+        Computes the statistics of the illuminated region of each spectral
+        slice and stores the clipped mean and variance for each slice.
+        The statistics for all of the slices are calculated together by
+        the cubefuncs.sigclip_slices function, which gives the same
+        results as running slice_stats on each slice in turn.
 
         If requested, this method also saves the variance spectrum in
         an external file, for later use.
+
+        Optional inputs:
+          wchunk - maximum number of wavelength slices to process at once,
+                   which limits the memory used by the calculation.
+                   The default (None) processes the full cube at once.
         """
 
         """ Get the mask info """
@@ -654,14 +794,13 @@ class OsCube(imf.Image):
         else:
             raise ValueError('No mask info has been provided')
 
-        """ Set up the containers to store the info """
-        mean = np.zeros(self.wsize)
-        var = np.zeros(self.wsize)
-
-        """ Loop through the slices, calculating the statistics of each """
-        print('Calculating variance spectrum.  Be patient.')
-        for i in range(self.wsize):
-            mean[i], var[i] = self.slice_stats(i, verbose=verbose)
+        """ Calculate the statistics of all of the slices """
+        print('Calculating variance spectrum.')
+        mean, var = cf.sigclip_slices(self.data, maskdat, nsig=nsig,
+                                      wchunk=wchunk)
+        if verbose:
+            for i in range(self.wsize):
+                print(i, mean[i], np.sqrt(var[i]))
 
         self.meanspec = mean
         self.varspec = ss.Spec1d(wav=self.wav, flux=var)
@@ -672,7 +811,7 @@ class OsCube(imf.Image):
 
     # -----------------------------------------------------------------------
 
-    def make_varcube(self, maskfile=None, **kwargs):
+    def make_varcube(self, maskfile=None, lazy=False, **kwargs):
         """
 
         Takes the 1-dimensional variance spectrum and converts it into a
@@ -682,33 +821,36 @@ class OsCube(imf.Image):
         This method requires that the make_varspec method has been run
          first.
 
+        The cube is built by broadcasting the mask against the variance
+         spectrum.  If lazy is True, then the full cube is not created.
+         Instead, a cubefuncs.LazyCube is returned, which only evaluates
+         the slices or spaxels that are requested from it and which can be
+         written to disk with its writeto method.  Otherwise the cube is
+         saved as the 'var' data set.
+
         """
 
         """ Make the variance spectrum if it has not already been done """
         if self.varspec is None:
             self.make_varspec(maskfile, **kwargs)
 
-        """ Create the container for the variance cube """
-        self['var'] = WcsHDU(self.data, self.header)
-        self['var'].data *= 0.
-
-        """ Step through the slices, making each one a 2d variance slice """
-        for imslice, var in enumerate(self.varspec['flux']):
-            """
-            Get the 2-dimensional mask that is appropriate for this slice
-            """
-            if self.mask.ndim == 3:
-                mask2d = self.mask[:, :, imslice]
-            else:
-                mask2d = np.transpose(self.mask)
-
-            """ Set the good pixels to the variance value for the slice """
-            self['var'].data[:, :, imslice][mask2d] = var
+        """
+        Set the good pixels to the variance value for the slice and the bad
+         pixels to zero
+        """
+        varcube = cf.LazyCube(self.data.shape, cf.varcube_func,
+                              [cf.cube_mask(self.mask),
+                               np.asarray(self.varspec['flux'])],
+                              dtype=self.data.dtype)
+        if lazy:
+            return varcube
+        else:
+            self['var'] = WcsHDU(varcube[...], self.header)
 
     # -----------------------------------------------------------------------
 
     def clean(self, nsig1=5., nsig2=5., smtype='median', smsize=3,
-              skysub=True, verbose=False):
+              skysub=True, wchunk=None, nproc=1, verbose=False):
         """
 
         Does a bad-pixel cleaning, slice by slice.  The basic algorithm
@@ -727,6 +869,12 @@ class OsCube(imf.Image):
            3. Replace the flagged pixels with the corresponding value in
               the smooth data
 
+        Since each slice is treated independently, the cube can be cleaned
+        in blocks of wchunk slices, which bounds the memory used by the
+        smoothed and difference cubes, and the blocks can be distributed
+        over nproc processes.  The result does not depend on the values of
+        wchunk or nproc.
+
         """
 
         """ Make sure that the variance spectrum exists """
@@ -737,53 +885,25 @@ class OsCube(imf.Image):
             print('')
             return
 
-        """
-        Create a smoothed version of the data and subtract it from the
-        input data
-        """
-        data = self.data.copy()
-        self.smooth_xy(smsize, smtype)
-        diff = np.fabs(data - self['smooth'].data)
-
-        """
-        Step through the slices, flagging the pixels that differ too much
-        from both the clipped mean value and the smoothed data
-        """
-        if verbose:
-            print('')
-            print('Slice N_flag')
-            print('----- ------')
+        """ Clean the data, one block of slices at a time """
         rms = np.sqrt(self.varspec['flux'])
-        for i, r in enumerate(rms):
-            """ Subtract the sky if requested """
-            if skysub:
-                slmean = self.meanspec[i]
-            else:
-                slmean = 0.
-            smdat = self['smooth'].data[:, :, i] - slmean
-            mdiff = np.fabs(data[:, :, i] - slmean)
-            data[:, :, i] -= slmean
-            mask = (mdiff > nsig1 * r) & (diff[:, :, i] > nsig2 * r)
-            data[:, :, i][mask] = smdat[mask]
-            if verbose:
-                print(' %3d  %5d' % (i, mask.sum()))
-
-            """
-            Make sure that the regions outside the illuminated part of the
-            chip are set to zero, since they may have been set to a non-zero
-            value in the sky subtraction
-            """
-            data[np.transpose(np.logical_not(self.mask))] = 0.
+        data = cf.clean_cube(self.data, self.mask, self.meanspec, rms,
+                             wchunk=wchunk, nproc=nproc, verbose=verbose,
+                             nsig1=nsig1, nsig2=nsig2, smtype=smtype,
+                             smsize=smsize, skysub=skysub)
 
         """ Save the cleaned cube """
         self['clean'] = WcsHDU(data, self.header)
 
     # -----------------------------------------------------------------------
 
-    def make_snrcube(self, maskfile=None):
+    def make_snrcube(self, maskfile=None, lazy=False):
         """
 
-        Use the information in the variance spectrum to make a SNR cube
+        Use the information in the variance spectrum to make a SNR cube.
+        As with make_varcube, setting lazy=True returns a cubefuncs.LazyCube
+         that evaluates the SNR only where it is requested, rather than
+         saving the full cube as the 'snr' data set.
 
         """
 
@@ -796,18 +916,19 @@ class OsCube(imf.Image):
             return
 
         """
-        Make a copy of the data cube and step through the slices, dividing
-        each by the associated rms value
+        Divide the data cube by the rms value associated with each slice,
+        setting the bad spaxels to zero
         """
-        cube = self.data.copy()
         rms = np.sqrt(self.varspec['flux'])
-        mask = (np.transpose(self.mask)).astype(float)
-        for i, r in enumerate(rms):
-            cube[:, :, i] *= (mask / r)
+        mask = cf.cube_mask(self.mask).astype(self.data.dtype)
+        snrcube = cf.LazyCube(self.data.shape, cf.snrcube_func,
+                              [self.data, mask, rms], dtype=self.data.dtype)
 
         """ Save the result """
-        self['snr'] = WcsHDU(cube, self.header)
-        del(cube)
+        if lazy:
+            return snrcube
+        else:
+            self['snr'] = WcsHDU(snrcube[...], self.header)
 
     # -----------------------------------------------------------------------
 
@@ -841,7 +962,10 @@ class OsCube(imf.Image):
 
         """ Parse the reg parameter """
         mask = None
-        if isinstance(reg, tuple) or isinstance(reg, list):
+        if isinstance(reg, np.ndarray):
+            mask = reg.astype(bool)
+
+        elif isinstance(reg, tuple) or isinstance(reg, list):
             x = reg[0]
             y = reg[1]
 
@@ -856,19 +980,23 @@ class OsCube(imf.Image):
                 xmax = int(x[1])
                 ymin = int(y[0])
                 ymax = int(y[1])
-                # flux = cube[xmin:xmax, ymin:ymax, :].sum(axis=0)
-                # flux = flux.sum(axis=0)
-                # npix = (xmax - xmin) * (ymax - ymin)
-                mask = (self.xcoords >= xmin) & (self.xcoords < xmax) \
-                    & (self.ycoords >= ymin) & (self.ycoords < ymax)
-
-            if mask is not None:
-                xx = self.xcoords[mask].flatten()
-                yy = self.ycoords[mask].flatten()
-                flux = np.zeros(self.wsize)
-                for i, j in zip(xx, yy):
-                    flux += cube[i, j, :]
-                npix = len(xx)
+                """
+                Sum over the region through a slice of the cube, so that
+                only the spaxels in the region are read when the cube is
+                memory-mapped
+                """
+                xmin = min(max(xmin, 0), self.xsize)
+                xmax = min(max(xmax, 0), self.xsize)
+                ymin = min(max(ymin, 0), self.ysize)
+                ymax = min(max(ymax, 0), self.ysize)
+                flux = cube[xmin:xmax, ymin:ymax, :].sum(axis=(0, 1),
+                                                        dtype=float)
+                npix = (xmax - xmin) * (ymax - ymin)
+
+        if mask is not None:
+            matrix = cf.region_matrix([mask], self.xsize, self.ysize)[0]
+            flux = cf.extract_regions(cube, matrix)[0]
+            npix = int(mask.sum())
 
         if debug:
             print('npix: %d' % npix)
@@ -901,14 +1029,65 @@ class OsCube(imf.Image):
 
     # -----------------------------------------------------------------------
 
+    def make_1dspecs(self, regions, maskfile=None, wchunk=None,
+                     asspec=False):
+        """
+
+        Extracts the 1d spectra of many spatial regions at once, through a
+        single sparse matrix product over the cube (see
+        cubefuncs.region_matrix and cubefuncs.extract_regions).
+
+        Inputs:
+          regions - either a list of regions, each of which can be any of
+                    the reg types accepted by make_1dspec, or a labelled
+                    segmentation image, i.e., an integer array with the
+                    same (x, y) orientation as the cube, in which each
+                    region has a different positive value and spaxels that
+                    are in no region are set to 0.
+          wchunk  - maximum number of wavelength slices to process at once
+          asspec  - if True, return a list of Spec1d containers rather than
+                    arrays
+
+        Returns: flux, var, labels
+          flux   - (nregions, nwav) array of summed spectra
+          var    - (nregions, nwav) array of variance spectra, i.e., the
+                   variance spectrum times the number of spaxels in the
+                   region
+          labels - the segmentation-image label (or the list index) of
+                   each region
+          or, if asspec is True, a list of Spec1d containers
+        """
+
+        """ Make the variance spectrum if it doesn't exist """
+        if self.varspec is None:
+            if maskfile is None:
+                print('')
+                raise ValueError('No maskfile given for make_varspec call')
+            self.make_varspec(maskfile)
+
+        """ Extract the spectra """
+        matrix, labels = cf.region_matrix(regions, self.xsize, self.ysize)
+        flux = cf.extract_regions(self.data, matrix, wchunk=wchunk)
+        npix = np.asarray(matrix.sum(axis=1)).ravel()
+        var = np.outer(npix, self.varspec['flux'])
+
+        if asspec:
+            return [ss.Spec1d(wav=self.wav, flux=f, var=v)
+                    for f, v in zip(flux, var)]
+        else:
+            return flux, var, labels
+
+    # -----------------------------------------------------------------------
+
     def click_1dspec(self, xysmooth=1, **kwargs):
         """
-        An interactive interface to set_1dspec.  Produces the 1D spectrum
+        An interactive interface to make_1dspec.  Produces the 1D spectrum
         associated with the spaxel that is clicked.
         """
 
         self.start_interactive()
-        self.set_1dspec(int(self.xclick), int(self.yclick), **kwargs)
+        return self.make_1dspec((int(self.xclick), int(self.yclick)),
+                                **kwargs)
 
     # -----------------------------------------------------------------------
 
@@ -3,4 +3,4 @@ Tools for reducing, analyzing, and viewing spectra.
 """
 
 from . import ycorrect,offset,id_slits,extract,skysub
-from . import measure_width,spectools
+from . import measure_width,spectools,stack,calcache,cosmics,taskgraph
@@ -0,0 +1,306 @@
+"""
+Cosmic-ray rejection shared by the ESI and NIRSPEC reductions.
+
+Cosmic rays are found with a detector (lacosmic_mask, an L.A.Cosmic-style
+  detector [van Dokkum 2001], or derivative_mask), and the flagged pixels
+  are replaced by the median of the unflagged pixels around them; this is
+  repeated until no new pixels are flagged. The replacement median is only
+  evaluated at the flagged pixels, and the subsampled Laplacian of
+  L.A.Cosmic is computed without making the subsampled image. lacosmic()
+  also splits the frame into tiles that are processed in parallel, and
+  after the first iteration only the tiles near newly cleaned pixels are
+  searched again.
+"""
+
+import numpy
+from scipy import ndimage
+from multiprocessing import Pool
+
+# clean(data,detect,niter,size)
+# lacosmic(data,sky,niter,...)
+# lacosmic_mask(data,sky,...)
+# derivative_mask(img,var,...)
+# replace(data,mask,size)
+# subsampled_laplacian(data)
+
+# Distance over which lacosmic_mask() depends on the data (the 5x5 median
+#   of the significance map, then two 3x3 growing steps)
+LACOSMIC_HALO = 8
+
+
+def subsampled_laplacian(data):
+	"""
+	The L.A.Cosmic Laplacian: the data are subsampled by 2, convolved with
+	  the Laplacian (-0.5*ndimage.laplace), negative values are set to
+	  zero, and the result is block-averaged back to the original pixels.
+
+	Each subsampled pixel has one neighbour in the same original pixel and
+	  one in the adjacent pixel along each axis, so the Laplacians of the
+	  four subpixels of a pixel are sums of its differences with the
+	  pixels above/below and left/right.
+	"""
+	d = numpy.pad(numpy.asarray(data,dtype=numpy.float64),1,mode='edge')
+	c = d[1:-1,1:-1]
+	dy = [d[:-2,1:-1]-c,d[2:,1:-1]-c]
+	dx = [d[1:-1,:-2]-c,d[1:-1,2:]-c]
+	out = numpy.zeros(c.shape)
+	for ly in dy:
+		for lx in dx:
+			out += numpy.maximum(-(ly+lx),0.)
+	return 0.125*out
+
+
+def _box_median(data,y,x,size,chunk=65536):
+	"""
+	Returns ndimage.median_filter(data,size)[y,x], evaluating the median
+	  only at the given pixels (or over the whole image if they are a large
+	  fraction of it).
+	"""
+	if y.size>data.size//8:
+		return ndimage.median_filter(data,size)[y,x]
+	h = size//2
+	pad = numpy.pad(data,h,mode='symmetric')
+	dy,dx = numpy.mgrid[0:size,0:size]
+	dy,dx = dy.ravel(),dx.ravel()
+	out = numpy.empty(y.size)
+	for start in range(0,y.size,chunk):
+		yy = y[start:start+chunk,None]+dy
+		xx = x[start:start+chunk,None]+dx
+		out[start:start+chunk] = numpy.median(pad[yy,xx],1)
+	return out
+
+
+def lacosmic_mask(data,sky=0.,nsig=5.,contrast=2.,sigfrac=0.3,gain=5.,rn=25.):
+	"""
+	lacosmic_mask(data,sky=0.,nsig=5.,contrast=2.,sigfrac=0.3,gain=5.,rn=25.)
+
+	Returns a boolean mask of the cosmic rays in a (sky-subtracted) image.
+
+	Inputs:
+	  data     - sky-subtracted image
+	  sky      - sky level (or image), used for the noise model
+	  nsig     - detection threshold, in sigma
+	  contrast - minimum contrast between the Laplacian and the fine
+	               structure image (rejects compact sources)
+	  sigfrac  - threshold for neighbouring pixels, as a fraction of nsig
+	  gain     - gain (e-/DN)
+	  rn       - read noise (e-)
+
+	The result is the same as evaluating the median-filtered images over
+	  the whole frame, but they are only evaluated near pixels that can be
+	  cosmic rays. The Laplacian and its 5x5 median are non-negative, so a
+	  cosmic ray must have a Laplacian of at least nsig times the minimum
+	  noise; the significance map is then only needed within 4 pixels of
+	  these candidates, and the fine structure image at the candidates.
+	"""
+	data = numpy.asarray(data,dtype=numpy.float64)
+	shape = data.shape
+	sky = numpy.asarray(sky,dtype=numpy.float64)
+	lap = subsampled_laplacian(data)
+
+	def noise(y,x):
+		med5 = _box_median(data,y,x,5)
+		med5 += sky[y,x] if sky.ndim==2 else sky
+		med5[med5<=0.] = 0.0001
+		return (med5*gain+rn**2)**0.5/gain
+
+	# Candidates (sigmap>=nsig before subtracting its median)
+	minnoise = (0.0001*gain+rn**2)**0.5/gain
+	y,x = numpy.nonzero(lap>=nsig*minnoise)
+	ok = lap[y,x]>=nsig*noise(y,x)
+	cand = numpy.zeros(shape,dtype=bool)
+	cand[y[ok],x[ok]] = True
+	if not cand.any():
+		return cand
+
+	# The significance map, with its 5x5 median subtracted, is needed
+	#   within 2 pixels of the candidates (where the mask is grown)
+	near = ndimage.maximum_filter(cand,5)
+	region = ndimage.maximum_filter(near,5)
+	y,x = numpy.nonzero(region)
+	noisemap = numpy.ones(shape)
+	noisemap[y,x] = noise(y,x)
+	rawsig = numpy.zeros(shape)
+	rawsig[y,x] = lap[y,x]/noisemap[y,x]
+	y,x = numpy.nonzero(near)
+	sigmap = numpy.full(shape,-numpy.inf)
+	sigmap[y,x] = rawsig[y,x]-_box_median(rawsig,y,x,5)
+	del rawsig,lap
+	crs = cand&(sigmap>=nsig)
+
+	# The fine structure image rejects stars and other compact sources
+	y,x = numpy.nonzero(crs)
+	if y.size==0:
+		return crs
+	yy,xx = numpy.nonzero(ndimage.maximum_filter(crs,7))
+	med3 = numpy.zeros(shape)
+	med3[yy,xx] = _box_median(data,yy,xx,3)
+	fine = (med3[y,x]-_box_median(med3,y,x,7))/noisemap[y,x]
+	fine[fine<0.01] = 0.01
+	crs[y,x] = sigmap[y,x]/fine>=contrast
+	del med3,noisemap
+
+	# Grow the cosmic rays into their (fainter) neighbours
+	crs = ndimage.maximum_filter(crs,3)&(sigmap>=nsig)
+	crs = ndimage.maximum_filter(crs,3)&(sigmap>=nsig*sigfrac)
+	return crs
+
+
+def _clipped_std(arr,nsig=3.5):
+	a = arr[numpy.isfinite(arr)]
+	m,s,l = a.mean(),a.std(),a.size
+	while 1:
+		a = a[abs(a-m)<nsig*s]
+		if a.size==l:
+			return s
+		m,s,l = a.mean(),a.std(),a.size
+
+
+def derivative_mask(img,var,nstd=15.,snr=5.):
+	"""
+	derivative_mask(img,var,nstd=15.,snr=5.)
+
+	Returns a boolean mask of cosmic rays found from the derivatives
+	  (Prewitt then Sobel) of the S/N image img/sqrt(var). Pixels with
+	  derivatives more than nstd times the clipped standard deviation of
+	  the derivatives (grown by one pixel) and with S/N>snr are flagged.
+	"""
+	simg = img/var**0.5
+	deriv = ndimage.sobel(ndimage.prewitt(abs(simg)))
+	std = _clipped_std(deriv[deriv!=0.])
+	crs = ndimage.maximum_filter(abs(deriv)>nstd*std,3)
+	return crs&(simg>snr)
+
+
+def replace(data,mask,size=7,chunk=65536):
+	"""
+	replace(data,mask,size=7,chunk=65536)
+
+	Replaces the masked pixels of data (in place) by the median of the
+	  unmasked pixels in the size x size box around them (the edges of the
+	  image are reflected, as in ndimage.median_filter). Pixels with no
+	  unmasked neighbours are unchanged.
+	"""
+	y,x = numpy.nonzero(mask)
+	if y.size==0:
+		return data
+	h = size//2
+	pad = numpy.pad(data,h,mode='symmetric')
+	good = numpy.pad(~mask,h,mode='symmetric')
+	dy,dx = numpy.mgrid[0:size,0:size]
+	dy,dx = dy.ravel(),dx.ravel()
+	for start in range(0,y.size,chunk):
+		yy = y[start:start+chunk,None]+dy
+		xx = x[start:start+chunk,None]+dx
+		vals = numpy.where(good[yy,xx],pad[yy,xx],numpy.nan)
+		ok = numpy.isfinite(vals).any(1)
+		med = numpy.nanmedian(vals[ok],1)
+		data[y[start:start+chunk][ok],x[start:start+chunk][ok]] = med
+	return data
+
+
+def clean(data,detect,niter=4,size=7,verbose=False):
+	"""
+	clean(data,detect,niter=4,size=7,verbose=False)
+
+	Iteratively finds and replaces cosmic rays, stopping early once no new
+	  pixels are flagged.
+
+	Inputs:
+	  data    - image
+	  detect  - function returning a boolean mask of the cosmic rays in
+	              the (partly cleaned) image it is given
+	  niter   - maximum number of iterations
+	  size    - size of the box used to replace flagged pixels
+	  verbose - print the number of pixels flagged in each iteration
+
+	Outputs:
+	  cleaned image, boolean mask of all flagged pixels
+	"""
+	data = numpy.array(data,dtype=numpy.float64)
+	crmask = numpy.zeros(data.shape,dtype=bool)
+	for i in range(niter):
+		new = detect(data)
+		if verbose:
+			print('CR iteration %d ... %d pixels flagged'%(i+1,new.sum()))
+		if not new.any():
+			break
+		replace(data,new,size)
+		crmask |= new
+	return data,crmask
+
+
+def _tiles(shape,tile,halo):
+	"""
+	Returns a list of (core,padded) slices covering an image; the padded
+	  slices extend the cores by halo pixels (within the image).
+	"""
+	out = []
+	for y0 in range(0,shape[0],tile):
+		for x0 in range(0,shape[1],tile):
+			y1,x1 = min(y0+tile,shape[0]),min(x0+tile,shape[1])
+			py0,px0 = max(y0-halo,0),max(x0-halo,0)
+			py1,px1 = min(y1+halo,shape[0]),min(x1+halo,shape[1])
+			out.append(((slice(y0,y1),slice(x0,x1)),(slice(py0,py1),slice(px0,px1))))
+	return out
+
+
+def _tile_mask(args):
+	data,sky,core,kwargs = args
+	return lacosmic_mask(data,sky,**kwargs)[core]
+
+
+def lacosmic(data,sky=0.,niter=4,nsig=5.,contrast=2.,sigfrac=0.3,gain=5.,rn=25.,size=7,tile=512,nproc=1,verbose=False):
+	"""
+	lacosmic(data,sky=0.,niter=4,nsig=5.,contrast=2.,sigfrac=0.3,gain=5.,
+	         rn=25.,size=7,tile=512,nproc=1,verbose=False)
+
+	Iterative L.A.Cosmic-style cleaning (see lacosmic_mask for the
+	  detection parameters). The image is processed in tiles of tile x tile
+	  pixels (in parallel if nproc>1); the tiles overlap by LACOSMIC_HALO
+	  pixels, so the result does not depend on the tiling. After the first
+	  iteration only tiles within LACOSMIC_HALO pixels of newly cleaned
+	  pixels are searched again, since the rest of the image has not
+	  changed.
+
+	Outputs:
+	  cleaned image, boolean mask of all flagged pixels
+	"""
+	data = numpy.array(data,dtype=numpy.float64)
+	sky = numpy.asarray(sky)
+	kwargs = {'nsig':nsig,'contrast':contrast,'sigfrac':sigfrac,'gain':gain,'rn':rn}
+	if tile is None:
+		tile = max(data.shape)
+	tiles = _tiles(data.shape,tile,LACOSMIC_HALO)
+	active = list(range(len(tiles)))
+	crmask = numpy.zeros(data.shape,dtype=bool)
+	pool = None
+	if nproc>1 and len(tiles)>1:
+		pool = Pool(nproc)
+	try:
+		for i in range(niter):
+			jobs = []
+			for t in active:
+				core,pad = tiles[t]
+				local = tuple([slice(c.start-p.start,c.stop-p.start) for c,p in zip(core,pad)])
+				s = sky[pad] if sky.ndim==2 else sky
+				jobs.append((data[pad],s,local,kwargs))
+			if pool is not None:
+				masks = pool.map(_tile_mask,jobs)
+			else:
+				masks = [_tile_mask(job) for job in jobs]
+			new = numpy.zeros(data.shape,dtype=bool)
+			for t,m in zip(active,masks):
+				new[tiles[t][0]] = m
+			if verbose:
+				print('CR iteration %d ... %d pixels flagged'%(i+1,new.sum()))
+			if not new.any():
+				break
+			replace(data,new,size)
+			crmask |= new
+			active = [t for t in range(len(tiles)) if new[tiles[t][1]].any()]
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
+	return data,crmask
@@ -5,6 +5,7 @@ except:
 	from astropy.io import fits as pyfits
 
 # resample1d(data,coeffs,axis,const)
+# solution_grid(shape,coeffs,axis,offset)
 # array_coords(shape)
 # resampley(data,ycoords,yoffset,cval,mode)
 # get_slit(2ddata,slit#)
@@ -13,21 +14,48 @@ except:
 
 
 
+_grid_cache = {}
+GRID_CACHE_SIZE = 4
+
 # Resample an image along the axis specified
 def resample1d(data,coeffs,axis,const=0.0,offset=0.):
-	from special_functions import genfunc
 	coords = array_coords(data.shape)
-	y = coords[0].flatten()
-	x = coords[1].flatten()
+	grid = solution_grid(data.shape,coeffs,axis,offset)
 	if axis=="Y" or axis=="y" or axis==1:
-		y += offset
-		coords[0] = genfunc(x,y,coeffs).reshape(data.shape)-offset
+		coords[0] = grid-offset
 	else:
-		x += offset
-		coords[1] = genfunc(x,y,coeffs).reshape(data.shape)-offset
-	del x,y
+		coords[1] = grid-offset
 	return scipy.ndimage.map_coordinates(data,coords,cval=const,output=scipy.float64,order=5)
 
+def solution_grid(shape,coeffs,axis,offset=0.):
+	"""
+	solution_grid(shape,coeffs,axis,offset=0.)
+
+	Evaluates a polynomial solution on every pixel of an image of the given
+	  shape, with the x (axis="x") or y (axis="y") pixel coordinates offset.
+	  The most recent grids are cached, keyed on the shape, axis, offset,
+	  and solution, so resampling several images with the same solution
+	  only evaluates it once. The returned array is read-only.
+	"""
+	from special_functions import genfunc
+	import hashlib
+	coeff = scipy.ascontiguousarray(coeffs['coeff'],dtype=scipy.float64)
+	key = (tuple(shape),str(axis),float(offset),coeffs['type'],coeff.shape,hashlib.md5(coeff).hexdigest())
+	if key not in _grid_cache:
+		y = scipy.arange(shape[0],dtype='f8')
+		x = scipy.arange(shape[1],dtype='f8')
+		if axis=="Y" or axis=="y" or axis==1:
+			y += offset
+		else:
+			x += offset
+		x,y = scipy.meshgrid(x,y)
+		grid = genfunc(x.ravel(),y.ravel(),coeffs).reshape(shape)
+		grid.setflags(write=False)
+		if len(_grid_cache)>=GRID_CACHE_SIZE:
+			_grid_cache.clear()
+		_grid_cache[key] = grid
+	return _grid_cache[key]
+
 def array_coords(shape):
 	y = shape[0]
 	x = shape[1]
@@ -43,15 +71,10 @@ def resampley(data,ycoords,yoffset=0.,cval=0.,mode="constant",slice=None):
 	try:
 		coords = array_coords(ycoords.shape)
 	except:
-		from special_functions import genfunc
-		coords = array_coords(data.shape)
-		x = coords[1].flatten()
-		y = coords[0].flatten()+yoffset
-		ycoords = genfunc(x,y,ycoords).reshape(coords[0].shape)
+		ycoords = solution_grid(data.shape,ycoords,"y",yoffset)
 		if slice is not None:
-			ycoords = ycoords[slice].copy()
+			ycoords = ycoords[slice]
 		coords = array_coords(ycoords.shape)
-		del x,y
 	coords[0] = ycoords.astype(scipy.float64)-yoffset
 	return ndimage.map_coordinates(data,coords,output=scipy.float64,mode=mode,cval=cval,order=5)
 
@@ -0,0 +1,157 @@
+"""
+Combine a stack of images (bias, flat, or science frames) without holding
+  the full stack in memory. Only a block of rows of each frame is read from
+  the FITS files at a time, so peak memory is one block of rows times the
+  number of frames (plus the output image).
+"""
+
+import numpy
+from multiprocessing import Pool
+try:
+	import pyfits
+except:
+	from astropy.io import fits as pyfits
+
+# combine(frames,method,...)
+# combine_block(block,method,...)
+# row_blocks(nrows,rows)
+
+
+def row_blocks(nrows,rows=256):
+	"""
+	Returns a list of (start,end) row ranges covering nrows rows.
+	"""
+	if rows is None or rows<1:
+		rows = nrows
+	return [(i,min(i+rows,nrows)) for i in range(0,nrows,rows)]
+
+
+def combine_block(block,method='median',nsig=3.,niter=5,nlow=1,nhigh=1):
+	"""
+	combine_block(block,method='median',nsig=3.,niter=5,nlow=1,nhigh=1)
+
+	Combines a (nframes,...) array along the first axis.
+
+	Inputs:
+	  block  - stack of data to combine
+	  method - 'median', 'clipmean' (sigma-clipped mean; the clipping is
+	             about the median and NaNs are ignored), or 'minmax' (mean
+	             after rejecting the nlow lowest and nhigh highest values)
+	  nsig   - clipping threshold for 'clipmean'
+	  niter  - maximum number of clipping iterations for 'clipmean'
+	  nlow   - number of low values rejected by 'minmax'
+	  nhigh  - number of high values rejected by 'minmax'
+
+	Outputs:
+	  combined array
+	"""
+	if method=='median':
+		return numpy.median(block,0)
+	elif method=='clipmean':
+		data = numpy.array(block,dtype=numpy.float64)
+		for i in range(niter):
+			med = numpy.nanmedian(data,0)
+			std = numpy.nanstd(data,0)
+			bad = abs(data-med)>nsig*std
+			if not bad.any():
+				break
+			data[bad] = numpy.nan
+		return numpy.nanmean(data,0)
+	elif method=='minmax':
+		n = block.shape[0]
+		if nlow+nhigh>=n:
+			raise ValueError('Cannot reject %d values from %d frames'%(nlow+nhigh,n))
+		data = numpy.sort(block,0)
+		return data[nlow:n-nhigh].mean(0)
+	raise ValueError('Unknown combine method: %s'%method)
+
+
+_shared = {}
+
+
+def _read_block(frame,start,end,ext,transform,norm,ignore_missing_end):
+	if isinstance(frame,str):
+		# Only the requested rows are read from the file. The files are
+		#   not memory-mapped because raw frames are usually scaled
+		#   (BZERO) integers, which astropy cannot memory-map.
+		hdulist = pyfits.open(frame,memmap=False,ignore_missing_end=ignore_missing_end)
+		block = numpy.asarray(hdulist[ext].section[start:end])
+		hdulist.close()
+	else:
+		block = numpy.asarray(frame[start:end])
+	if transform is not None:
+		block = transform(block,start,end)
+	if norm is not None:
+		block = block/norm
+	return block
+
+
+def _init_combine(frames,ext,transform,norms,ignore_missing_end,kwargs):
+	# The frames and transform (which may hold large arrays, eg a bad
+	#   pixel mask) are passed to each worker once, rather than with
+	#   every block of rows
+	global _shared
+	_shared = {'frames':frames,'ext':ext,'transform':transform,'norms':norms,'ignore_missing_end':ignore_missing_end,'kwargs':kwargs}
+
+
+def _combine_rows(args):
+	start,end = args
+	frames = _shared['frames']
+	norms = _shared['norms']
+	block = numpy.array([_read_block(frames[i],start,end,_shared['ext'],_shared['transform'],norms[i],_shared['ignore_missing_end']) for i in range(len(frames))])
+	return combine_block(block,**_shared['kwargs'])
+
+
+def combine(frames,method='median',rows=256,ext=0,transform=None,axis=0,norms=None,nproc=1,nsig=3.,niter=5,nlow=1,nhigh=1,ignore_missing_end=False):
+	"""
+	combine(frames,method='median',rows=256,ext=0,transform=None,axis=0,
+	        norms=None,nproc=1,nsig=3.,niter=5,nlow=1,nhigh=1,
+	        ignore_missing_end=False)
+
+	Combines a list of frames, reading and combining rows at a time.
+
+	Inputs:
+	  frames    - list of FITS filenames (or of 2d arrays, which can be
+	                memory-mapped numpy arrays)
+	  method    - 'median', 'clipmean', or 'minmax' (see combine_block)
+	  rows      - number of input rows to read at a time
+	  ext       - FITS extension holding the data
+	  transform - optional function called as transform(block,start,end)
+	                on each block of input rows [start:end] of each frame,
+	                eg to trim or overscan-subtract the data. It must be
+	                a module-level function (or functools.partial of one)
+	                if nproc>1.
+	  axis      - axis of the (transformed) output that the input rows
+	                map onto (1 if the transform transposes the data)
+	  norms     - optional list of values to divide each frame by (eg the
+	                exposure times)
+	  nproc     - number of processes to combine blocks in parallel
+	  nsig,niter,nlow,nhigh - parameters of the combine method
+	  ignore_missing_end - passed to pyfits.open (needed for some Keck
+	                headers)
+
+	Outputs:
+	  combined image
+	"""
+	if isinstance(frames[0],str):
+		nrows = pyfits.getheader(frames[0],ext,ignore_missing_end=ignore_missing_end)['NAXIS2']
+	else:
+		nrows = frames[0].shape[0]
+	if norms is None:
+		norms = [None]*len(frames)
+	kwargs = {'method':method,'nsig':nsig,'niter':niter,'nlow':nlow,'nhigh':nhigh}
+	shared = (frames,ext,transform,norms,ignore_missing_end,kwargs)
+	jobs = row_blocks(nrows,rows)
+	if nproc>1:
+		pool = Pool(nproc,initializer=_init_combine,initargs=shared)
+		out = pool.map(_combine_rows,jobs)
+		pool.close()
+		pool.join()
+	else:
+		global _shared
+		_init_combine(*shared)
+		try:
+			out = [_combine_rows(job) for job in jobs]
+		finally:
+			_shared = {}
+	return numpy.concatenate(out,axis)
@@ -0,0 +1,201 @@
+"""
+Build a set of calibration products as a graph of tasks.
+
+Each task makes one or more output files from raw input files and from the
+  outputs of the tasks it depends on. A task is rebuilt only when its key
+  changes or its outputs are missing; the key is a hash of the contents of
+  its raw inputs, the keys of the tasks it depends on, the source code of
+  the modules that do the work, and any extra parameters, so changing a
+  raw frame (or the code) invalidates everything downstream of it. The keys
+  are recorded in a manifest file. Tasks whose dependencies are complete
+  are run in parallel in a pool of processes, so the total time is set by
+  the longest chain of dependent tasks rather than the sum of all tasks.
+"""
+
+import os,sys,time,hashlib,pickle
+from multiprocessing import Pool
+
+from .calcache import file_hash,code_version
+
+# TaskGraph(manifest)
+#   .add(name,func,args,deps,inputs,outputs,code,extra)
+#   .run(nproc,force)
+
+
+def message(string):
+	sys.stdout.write(string)
+	sys.stdout.flush()
+
+
+def _run_task(args):
+	func,fargs = args
+	start = time.time()
+	func(*fargs)
+	return time.time()-start
+
+
+class Task(object):
+	def __init__(self,name,func,args,deps,inputs,outputs,code,extra):
+		self.name = name
+		self.func = func
+		self.args = args
+		self.deps = deps
+		self.inputs = inputs
+		self.outputs = outputs
+		self.code = code
+		self.extra = extra
+
+
+class TaskGraph(object):
+	"""
+	TaskGraph(manifest=None)
+
+	A graph of tasks. manifest is the file in which the keys of completed
+	  tasks are recorded (if None, tasks are rebuilt whenever their outputs
+	  are missing).
+	"""
+	def __init__(self,manifest=None):
+		self.manifest = manifest
+		self.tasks = {}
+		self.order = []
+		self.keys = {}
+		self.times = {}
+
+	def add(self,name,func,args=(),deps=[],inputs=[],outputs=[],code=[],extra=None):
+		"""
+		add(name,func,args=(),deps=[],inputs=[],outputs=[],code=[],
+		    extra=None)
+
+		Adds a task that makes the files in outputs by calling func(*args).
+		  func must be a module-level function (it is run in another
+		  process if nproc>1) and must read the products of the tasks in
+		  deps from their output files. inputs are the raw files used by
+		  the task, code is a list of modules whose source determines the
+		  products, and extra holds any other parameters (with a stable
+		  repr).
+		"""
+		for dep in deps:
+			if dep not in self.tasks:
+				raise ValueError('Task %s depends on unknown task %s'%(name,dep))
+		self.tasks[name] = Task(name,func,tuple(args),list(deps),list(inputs),list(outputs),list(code),extra)
+		self.order.append(name)
+
+	def key(self,name):
+		"""
+		Returns the key of a task (its dependencies must already have
+		  keys, which is the case when tasks are taken in the order they
+		  were added).
+		"""
+		task = self.tasks[name]
+		h = hashlib.sha1()
+		for filename in task.inputs:
+			h.update(file_hash(filename).encode())
+		for dep in task.deps:
+			h.update(self.keys[dep].encode())
+		h.update(code_version(*task.code).encode())
+		h.update(repr(task.extra).encode())
+		return h.hexdigest()
+
+	def _load_manifest(self):
+		if self.manifest is None or not os.path.exists(self.manifest):
+			return None
+		try:
+			f = open(self.manifest,'rb')
+			done = pickle.load(f)
+			f.close()
+		except Exception:
+			return None
+		return done
+
+	def _save_manifest(self,done):
+		if self.manifest is None:
+			return
+		tmpname = self.manifest+'.%d.tmp'%os.getpid()
+		f = open(tmpname,'wb')
+		pickle.dump(done,f,2)
+		f.close()
+		os.rename(tmpname,self.manifest)
+
+	def stale(self,force=[]):
+		"""
+		Returns the list of tasks that need to be (re)built: those whose
+		  outputs are missing or whose keys have changed, and the tasks in
+		  force along with everything that depends on them. If there is no
+		  manifest yet, existing outputs are accepted as they are (so
+		  products from earlier reductions are adopted rather than
+		  rebuilt).
+		"""
+		done = self._load_manifest()
+		out = []
+		forced_tasks = []
+		for name in self.order:
+			task = self.tasks[name]
+			self.keys[name] = self.key(name)
+			exists = all([os.path.exists(f) for f in task.outputs])
+			forced = name in force or len([d for d in task.deps if d in forced_tasks])>0
+			if forced:
+				forced_tasks.append(name)
+			if forced or not exists:
+				out.append(name)
+			elif done is not None and done.get(name)!=self.keys[name]:
+				out.append(name)
+		return out
+
+	def run(self,nproc=1,force=[]):
+		"""
+		run(nproc=1,force=[])
+
+		Builds the stale tasks (see stale()), running up to nproc tasks at
+		  a time. Each task is timed and logged. Returns a dictionary of the
+		  run time of each task that was built.
+		"""
+		start = time.time()
+		todo = self.stale(force)
+		done = self._load_manifest() or {}
+		for name in self.order:
+			if name not in todo:
+				done[name] = self.keys[name]
+				message('%s ... up to date.\n'%name)
+		self._save_manifest(done)
+
+		waiting = list(todo)
+		running = {}
+		pool = None
+		if nproc>1 and len(todo)>1:
+			pool = Pool(nproc)
+		try:
+			while len(waiting)>0 or len(running)>0:
+				ready = [n for n in waiting if all([d not in waiting and d not in running for d in self.tasks[n].deps])]
+				for name in ready:
+					if pool is None and len(running)>0:
+						break
+					waiting.remove(name)
+					task = self.tasks[name]
+					message('%s ... started.\n'%name)
+					if pool is None:
+						running[name] = _run_task((task.func,task.args))
+					else:
+						running[name] = pool.apply_async(_run_task,((task.func,task.args),))
+				finished = []
+				for name in list(running.keys()):
+					result = running[name]
+					if pool is None:
+						finished.append((name,result))
+					elif result.ready():
+						finished.append((name,result.get()))
+				if len(finished)==0:
+					time.sleep(0.05)
+					continue
+				for name,elapsed in finished:
+					del running[name]
+					self.times[name] = elapsed
+					done[name] = self.keys[name]
+					self._save_manifest(done)
+					message('%s ... created in %.1f s.\n'%(name,elapsed))
+		finally:
+			if pool is not None:
+				pool.close()
+				pool.join()
+		if len(todo)>0:
+			message('Built %d tasks in %.1f s (%.1f s of work).\n'%(len(todo),time.time()-start,sum([self.times[n] for n in todo])))
+		return dict([(n,self.times[n]) for n in todo])